@@ -0,0 +1,514 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import numpy as np
+
+
+###############################################################################
+#       Ring buffer
+###############################################################################
+class RingBuffer(object):
+    '''
+    Preallocated, timestamped ring buffer of float samples.
+
+    One thread appends samples while any number of threads read them. The
+    arrays are allocated once, so appending never touches the Python heap.
+    Timestamps come from time.perf_counter() and must be increasing.
+
+    Args
+    ------
+    capacity : int.
+            The maximum number of samples kept. Older samples are overwritten.
+    '''
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self._times = np.zeros(self.capacity)
+        self._values = np.zeros(self.capacity)
+        # Total number of samples ever appended. The next write goes to
+        # index self._count % self.capacity.
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    @property
+    def count(self):
+        '''Total number of samples appended since creation.'''
+        return self._count
+
+    def append(self, t, value):
+        with self._lock:
+            i = self._count % self.capacity
+            self._times[i] = t
+            self._values[i] = value
+            self._count += 1
+
+    def clear(self):
+        with self._lock:
+            self._count = 0
+
+    def latest(self):
+        '''Return the newest sample as a (time, value) tuple or None.'''
+        with self._lock:
+            if self._count == 0:
+                return None
+            i = (self._count - 1) % self.capacity
+            return self._times[i], self._values[i]
+
+    def snapshot(self, n=None):
+        '''Return copies of the newest n samples in chronological order.
+
+        Args
+        -------
+        n : int (optional).
+                Number of samples. All the stored samples if None.
+
+        Returns
+        -------
+        times, values : numpy arrays.
+        '''
+        with self._lock:
+            return self._snapshot(n)
+
+    def _snapshot(self, n):
+        # Must be called with self._lock held
+        size = min(self._count, self.capacity)
+        if n is None or n > size:
+            n = size
+        end = self._count % self.capacity
+        start = end - n
+        if start >= 0:
+            return self._times[start:end].copy(), self._values[start:end].copy()
+        # The requested window wraps around the end of the arrays
+        times = np.concatenate((self._times[start:], self._times[:end]))
+        values = np.concatenate((self._values[start:], self._values[:end]))
+        return times, values
+
+    def since(self, t):
+        '''Return copies of all the stored samples taken after time t.
+
+        Returns
+        -------
+        times, values : numpy arrays in chronological order.
+        '''
+        with self._lock:
+            size = min(self._count, self.capacity)
+            end = self._count % self.capacity
+            if self._count <= self.capacity:
+                segments = [(0, size)]
+            else:
+                segments = [(end, self.capacity), (0, end)]
+            # Count the samples newer than t, segment by segment
+            n = 0
+            for lo, hi in segments:
+                n += hi - lo - np.searchsorted(self._times[lo:hi], t, side='right')
+            return self._snapshot(n)
+
+
+###############################################################################
+#       Background sampler
+###############################################################################
+class Sampler(threading.Thread):
+    '''
+    Thread that calls a read function at a fixed rate and stores the
+    results in a RingBuffer.
+
+    The sampling instants are scheduled on an absolute time grid, so the
+    rate does not drift when a read is slow. If a read overruns its slot
+    the missed slots are skipped and counted in self.overruns.
+
+    Args
+    ------
+    read : callable.
+            Function without arguments that returns a float.
+
+    rate : float.
+            The sampling rate in Hz.
+
+    buffer : RingBuffer.
+            The buffer that receives the samples.
+
+    policy : PollingPolicy (optional).
+            If given, the sampling interval follows the policy, with rate
+            as the fastest rate.
+    '''
+    def __init__(self, read, rate, buffer, policy=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.read = read
+        self.rate = float(rate)
+        self.buffer = buffer
+        self.policy = policy
+        self.overruns = 0
+        self.errors = 0
+        self.last_error = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        policy = self.policy
+        fastest = 1.0 / self.rate
+        next_time = time.perf_counter()
+        while not self._stop_event.is_set():
+            period = fastest if policy is None else policy.interval(fastest)
+            try:
+                value = self.read()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+            else:
+                self.buffer.append(time.perf_counter(), value)
+                if policy is not None:
+                    policy.polled('sampler', fastest, value)
+            next_time += period
+            delay = next_time - time.perf_counter()
+            if delay < 0:
+                # Skip the slots we already missed instead of bursting
+                missed = int(-delay // period) + 1
+                self.overruns += missed
+                next_time += missed * period
+                delay += missed * period
+            if policy is None:
+                self._stop_event.wait(delay)
+            elif policy.wait(delay):
+                if period > fastest:
+                    # Woken up by a command, sample now on a new grid
+                    next_time = time.perf_counter()
+                else:
+                    # Already at full rate, keep the grid regular
+                    self._stop_event.wait(next_time - time.perf_counter())
+
+    def stop(self, timeout=1.0):
+        self._stop_event.set()
+        if self.policy is not None:
+            self.policy.wake()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
+
+###############################################################################
+#       Adaptive polling
+###############################################################################
+class PollingPolicy(object):
+    '''
+    Polling interval of a device that follows its motion state.
+
+    The interval is fast while the device is active: for hold seconds after
+    kick() (e.g. a move command) and while the observed readings move by
+    more than tolerance. Once the device is quiet the interval is
+    multiplied by backoff every stable_time seconds, up to slow.
+
+    The consumers (the sampler of a reader, the GUI poller) ask interval()
+    before every poll, sleep with wait() so that a kick wakes them up, and
+    count their polls with polled(). stats() compares the polls with those
+    of polling at the fastest interval all the time.
+
+    on_change(interval) is called whenever the interval changes, one call
+    at a time. A kick applies the fast interval at once, and a background
+    thread steps it back to slow afterwards, so the device polling follows
+    the moves also without any consumer.
+
+    Args
+    ------
+    fast, slow : float.
+            The bounds of the interval in seconds.
+
+    tolerance : float.
+            The change of the readings that counts as motion.
+
+    hold : float.
+            The time in seconds the interval stays fast after a kick.
+
+    stable_time : float.
+            The time in seconds between two backoff steps.
+
+    backoff : float.
+            The factor of every backoff step.
+    '''
+    def __init__(self, fast=0.01, slow=0.25, tolerance=0.02, hold=0.5,
+                 stable_time=0.5, backoff=2.0):
+        self.fast = fast
+        self.slow = slow
+        self.tolerance = tolerance
+        self.hold = hold
+        self.stable_time = stable_time
+        self.backoff = backoff
+        # Called as on_change(interval) when the interval changes, e.g. to
+        # set the polling of the device. The calls are serialized by
+        # _change_lock.
+        self.on_change = None
+        self.changes = 0
+        # Start quiet, at the slow interval
+        self._active_until = -np.inf
+        self._reference = None
+        self._last_interval = None
+        self._generation = 0
+        self._consumers = {}
+        self._condition = threading.Condition()
+        self._change_lock = threading.Lock()
+        self._backoff_thread = None
+
+    def kick(self, hold=None):
+        '''Poll fast for hold seconds from now and wake the consumers.'''
+        with self._condition:
+            until = time.perf_counter() + (self.hold if hold is None else hold)
+            self._active_until = max(self._active_until, until)
+            self._generation += 1
+            self._condition.notify_all()
+        self._apply()
+        self._start_backoff()
+
+    def keep_fast(self, hold):
+        '''Poll fast for hold seconds from now without waking the consumers,
+        e.g. to keep a regular full rate sampling.'''
+        with self._condition:
+            until = time.perf_counter() + hold
+            self._active_until = max(self._active_until, until)
+        self._apply()
+        self._start_backoff()
+
+    def wake(self):
+        with self._condition:
+            self._generation += 1
+            self._condition.notify_all()
+
+    def observe(self, value, t=None):
+        '''Record a reading. A change beyond tolerance counts as motion.'''
+        if self._reference is not None and abs(value - self._reference) <= self.tolerance:
+            return
+        self._reference = value
+        t = time.perf_counter() if t is None else t
+        self._active_until = max(self._active_until, t)
+
+    def interval(self, minimum=None):
+        '''Return the current interval, at least minimum seconds.'''
+        interval = self._current()
+        if interval != self._last_interval:
+            interval = self._apply()
+        return interval if minimum is None else max(interval, minimum)
+
+    def _current(self):
+        quiet = time.perf_counter() - self._active_until
+        if quiet < 0:
+            return self.fast
+        steps = int(min(quiet/self.stable_time, 64))
+        return min(self.slow, self.fast*self.backoff**steps)
+
+    def _apply(self):
+        # Record the current interval and report a change. Serialized, so
+        # that two threads never interleave the device calls of on_change
+        # with different intervals.
+        with self._change_lock:
+            interval = self._current()
+            if interval != self._last_interval:
+                self._last_interval = interval
+                self.changes += 1
+                if self.on_change is not None:
+                    self.on_change(interval)
+            return interval
+
+    def _start_backoff(self):
+        with self._change_lock:
+            if self.on_change is None or self._backoff_thread is not None:
+                return
+            self._backoff_thread = threading.Thread(target=self._run_backoff)
+            self._backoff_thread.daemon = True
+            self._backoff_thread.start()
+
+    def _run_backoff(self):
+        # Apply every backoff step until the interval is slow again
+        while True:
+            with self._change_lock:
+                if self._last_interval is not None and self._last_interval >= self.slow:
+                    self._backoff_thread = None
+                    return
+            quiet = time.perf_counter() - self._active_until
+            steps = int(quiet/self.stable_time) + 1 if quiet >= 0 else 0
+            delay = self._active_until + steps*self.stable_time - time.perf_counter()
+            time.sleep(max(delay, 0.0) + 1e-3)
+            self._apply()
+
+    def last_interval(self):
+        '''Return the interval of the last interval() call, which the device
+        polling follows, or slow before the first call.'''
+        return self.slow if self._last_interval is None else self._last_interval
+
+    def wait(self, timeout):
+        '''Sleep for timeout seconds or until a kick.
+
+        Returns True if it was woken up before the timeout.
+        '''
+        with self._condition:
+            generation = self._generation
+            if timeout > 0:
+                self._condition.wait(timeout)
+            return self._generation != generation
+
+    def polled(self, name, minimum, value=None):
+        '''Count a poll of the consumer name, whose fastest interval is
+        minimum, and observe its reading.'''
+        now = time.perf_counter()
+        consumer = self._consumers.get(name)
+        if consumer is None:
+            consumer = self._consumers[name] = [now, 0, minimum]
+        consumer[1] += 1
+        consumer[2] = minimum
+        if value is not None:
+            self.observe(value, now)
+
+    def stats(self):
+        '''Return the polls of every consumer with the achieved rate and
+        the polls saved against polling at its fastest interval.'''
+        now = time.perf_counter()
+        result = {'interval': self.interval(), 'changes': self.changes}
+        for name, (start, polls, minimum) in self._consumers.items():
+            elapsed = now - start
+            baseline = elapsed/max(minimum, self.fast)
+            result[name] = {'polls': polls,
+                            'elapsed': elapsed,
+                            'rate': polls/elapsed if elapsed > 0 else None,
+                            'saved': max(int(baseline) - polls, 0),
+                            'saved_fraction': (1 - polls/baseline) if baseline > 0 else 0.0}
+        return result
+
+    def reset_stats(self):
+        self._consumers.clear()
+
+
+###############################################################################
+#       Multi-resolution history
+###############################################################################
+class MinMaxRing(object):
+    '''Preallocated ring of (time, min, max) entries.'''
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self.times = np.zeros(self.capacity)
+        self.lows = np.zeros(self.capacity)
+        self.highs = np.zeros(self.capacity)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, t, low, high):
+        i = self.count % self.capacity
+        self.times[i] = t
+        self.lows[i] = low
+        self.highs[i] = high
+        self.count += 1
+
+    def oldest(self):
+        if self.count == 0:
+            return None
+        return self.times[self.count % self.capacity if self.count > self.capacity else 0]
+
+    def _ordered(self, array):
+        if self.count <= self.capacity:
+            return array[:self.count]
+        end = self.count % self.capacity
+        return np.concatenate((array[end:], array[:end]))
+
+    def window(self, t0, t1):
+        '''Return copies of the entries with t0 <= time <= t1.'''
+        times = self._ordered(self.times)
+        lo = np.searchsorted(times, t0, side='left')
+        hi = np.searchsorted(times, t1, side='right')
+        return (times[lo:hi].copy(), self._ordered(self.lows)[lo:hi].copy(),
+                self._ordered(self.highs)[lo:hi].copy())
+
+
+class MultiResolutionHistory(object):
+    '''
+    Bounded history of a signal at several resolutions.
+
+    Level 0 keeps the newest samples at full rate. Every entry of level i+1
+    holds the min and max of factor consecutive entries of level i, so each
+    level reaches factor times further back at the same memory. With the
+    defaults and 100 samples per second, level 0 covers 1 minute and
+    level 4 almost a week, in less than 1 MB.
+
+    Args
+    ------
+    capacity : int.
+            The number of entries of each level.
+
+    factor : int.
+            The number of entries of a level summarized by one entry of the
+            next level.
+
+    levels : int.
+            The number of levels.
+    '''
+    def __init__(self, capacity=6000, factor=10, levels=5):
+        self.factor = int(factor)
+        self.levels = [MinMaxRing(capacity) for i in range(levels)]
+        # The partial summary of every level above 0: [count, t, min, max]
+        self._pending = [[0, 0.0, 0.0, 0.0] for i in range(levels)]
+        self._lock = threading.Lock()
+
+    def append(self, t, value):
+        with self._lock:
+            self._add(0, t, value, value)
+
+    def extend(self, times, values):
+        with self._lock:
+            for t, v in zip(times.tolist(), values.tolist()):
+                self._add(0, t, v, v)
+
+    def _add(self, level, t, low, high):
+        self.levels[level].append(t, low, high)
+        level += 1
+        if level == len(self.levels):
+            return
+        pending = self._pending[level]
+        if pending[0] == 0:
+            pending[1:] = [t, low, high]
+        else:
+            pending[2] = min(pending[2], low)
+            pending[3] = max(pending[3], high)
+        pending[0] += 1
+        if pending[0] == self.factor:
+            pending[0] = 0
+            self._add(level, pending[1], pending[2], pending[3])
+
+    def decimate(self, t0, t1, n):
+        '''Return the min and max of the signal in n equal time bins.
+
+        The finest level that reaches back to t0 with at most 4 entries per
+        bin is used, so the cost depends on n and not on the number of
+        samples in the time range.
+
+        Returns
+        -------
+        bins, lows, highs : numpy arrays.
+                The index of every non-empty bin and its min and max.
+        '''
+        with self._lock:
+            ring = self.levels[0]
+            for level in self.levels:
+                if level.count == 0:
+                    break
+                ring = level
+                # A level that never wrapped still holds the whole history
+                complete = level.oldest() <= t0 or level.count <= level.capacity
+                if complete and _count_between(level, t0, t1) <= 4*n:
+                    break
+            times, lows, highs = ring.window(t0, t1)
+        if times.size == 0:
+            return np.empty(0, int), times, times
+        bins = np.clip(((times - t0)/(t1 - t0)*n).astype(int), 0, n - 1)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+        return (bins[starts], np.minimum.reduceat(lows, starts),
+                np.maximum.reduceat(highs, starts))
+
+
+def _count_between(ring, t0, t1):
+    # Estimate of the entries of a ring in [t0, t1], from its mean spacing
+    size = len(ring)
+    if size < 2:
+        return size
+    newest = ring.times[(ring.count - 1) % ring.capacity]
+    spacing = (newest - ring.oldest())/(size - 1)
+    if spacing <= 0:
+        return size
+    return min(size, (min(t1, newest) - max(t0, ring.oldest()))/spacing + 1)
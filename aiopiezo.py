@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+'''
+asyncio interface for piezo.py.
+
+Every blocking call of a device runs on a small executor that belongs to
+that device, so the event loop never waits for the USB bus and the calls
+to one device stay in order. Many stages can then be driven concurrently
+with asyncio.gather.
+
+Example
+-------
+import asyncio
+import aiopiezo
+
+async def main():
+    stages, results = await aiopiezo.bring_up([(81858318, 84858066),
+                                               (81858319, 84858067)])
+    for stage in stages:
+        await stage.set_closed_loop()
+        await stage.calibrate(use_cache=True)
+    await asyncio.gather(*(s.move_to_pos(5.0, wait=True) for s in stages))
+    async for t, value in stages[0].reader.samples(duration=1.0):
+        print(t, value)
+    for stage in stages:
+        stage.close()
+
+asyncio.run(main())
+'''
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import piezo
+
+
+class _AsyncDevice(object):
+    '''Base class with the executor of one device.'''
+    def __init__(self, device, max_workers=1):
+        self.device = device
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def call(self, function, *args, **kwargs):
+        '''Run a blocking function on the executor of the device.'''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(function, *args, **kwargs))
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+###############################################################################
+#       Strain reader
+###############################################################################
+class AsyncStrainReader(_AsyncDevice):
+    '''
+    asyncio interface of a StrainReader.
+
+    While the reader samples in the background the readings come from its
+    buffer without any device call.
+
+    Args
+    ------
+    reader : piezo.StrainReader.
+            The wrapped reader.
+
+    max_workers : int.
+            The number of threads of the executor of the device.
+    '''
+    def __init__(self, reader, max_workers=1):
+        _AsyncDevice.__init__(self, reader, max_workers)
+        self.reader = reader
+
+    async def read(self):
+        '''Return the current reading.'''
+        if self.reader.is_sampling():
+            sample = self.reader.latest()
+            if sample is not None:
+                return sample[1]
+        return await self.call(self.reader.get_pos)
+
+    async def settled(self, tolerance=0.02, window=0.1, timeout=5.0):
+        '''Wait until the readings settle, see StrainReader.wait_settled.'''
+        return await self.call(self.reader.wait_settled, tolerance, window,
+                               timeout)
+
+    async def samples(self, interval=0.01, duration=None, rate=100):
+        '''Iterate over the readings as (time, value) tuples.
+
+        Background sampling at rate (Hz) is started if it is not running.
+        The buffer is checked every interval seconds and every reading is
+        yielded once, in order.
+
+        Args
+        -------
+        duration : float (optional).
+                Stop after this many seconds, otherwise iterate forever.
+        '''
+        if not self.reader.is_sampling():
+            await self.call(self.reader.start_sampling, rate)
+        start = time.perf_counter()
+        last_t = start
+        # The elapsed time, not the newest sample, ends the iteration, so
+        # that it also ends when the reader stops delivering samples
+        while duration is None or time.perf_counter() - start < duration:
+            times, values = self.reader.since(last_t)
+            for t, value in zip(times.tolist(), values.tolist()):
+                if duration is not None and t - start >= duration:
+                    return
+                yield t, value
+            if times.size:
+                last_t = times[-1]
+            await asyncio.sleep(interval)
+
+    def __aiter__(self):
+        return self.samples()
+
+    async def get_units(self):
+        return await self.call(self.reader.get_units)
+
+
+###############################################################################
+#       Piezo controller
+###############################################################################
+class AsyncPiezoController(_AsyncDevice):
+    '''
+    asyncio interface of a PiezoController.
+
+    The blocking methods of the controller run on the executor of the
+    controller and those of its reader on the executor of the reader
+    (self.reader, an AsyncStrainReader).
+
+    Args
+    ------
+    controller : piezo.PiezoController.
+            The wrapped controller.
+
+    max_workers : int.
+            The number of threads of the executor of each device.
+    '''
+    def __init__(self, controller, max_workers=1):
+        _AsyncDevice.__init__(self, controller, max_workers)
+        self.controller = controller
+        self.reader = None
+        if controller.reader is not None:
+            self.reader = AsyncStrainReader(controller.reader, max_workers)
+
+    @classmethod
+    async def create(cls, serial_controller, serial_reader='Empty',
+                     max_workers=1):
+        '''Create and connect a PiezoController without blocking the loop.'''
+        loop = asyncio.get_running_loop()
+        controller = await loop.run_in_executor(
+            None, piezo.PiezoController, serial_controller, serial_reader)
+        return cls(controller, max_workers)
+
+    async def get_value(self):
+        return await self.call(self.controller.get_value)
+
+    async def set_value(self, value):
+        return await self.call(self.controller.set_value, value)
+
+    async def get_units(self):
+        return await self.call(self.controller.get_units)
+
+    async def set_closed_loop(self):
+        return await self.call(self.controller.set_closed_loop)
+
+    async def set_open_loop(self):
+        return await self.call(self.controller.set_open_loop)
+
+    async def move_to_pos(self, value, wait=False):
+        '''Move to a position in um, see PiezoController.move_to_pos.
+
+        With wait=True the coroutine completes once the stage has settled
+        (or is on target with the servo) and returns the settle time.
+        '''
+        return await self.call(self.controller.move_to_pos, value, wait)
+
+    async def settled(self, tolerance=None, window=None, timeout=None):
+        '''Wait until the stage settles, see PiezoController.wait_settled.'''
+        return await self.call(self.controller.wait_settled, tolerance, window,
+                               timeout)
+
+    async def calibrate(self, **kwargs):
+        '''Calibrate the stage, see PiezoController.calibrate_pos for the
+        keyword arguments. Returns the calibration report.'''
+        return await self.call(self.controller.calibrate_pos, **kwargs)
+
+    async def scan(self, positions, acquire, process=None, workers=1):
+        return await self.call(self.controller.scan, positions, acquire,
+                               process, workers)
+
+    async def stream(self, trajectory, rate, units='um'):
+        return await self.call(self.controller.stream, trajectory, rate, units)
+
+    def close(self):
+        _AsyncDevice.close(self)
+        if self.reader is not None:
+            self.reader.close()
+
+
+async def bring_up(serials, max_workers=8):
+    '''Connect many controllers concurrently, see piezo.bring_up.
+
+    Returns
+    -------
+    stages : list.
+            An AsyncPiezoController for every controller, or None where
+            the construction failed, in the order of serials.
+
+    results : list of dict.
+            The bring-up results of piezo.bring_up.
+    '''
+    loop = asyncio.get_running_loop()
+    controllers, results = await loop.run_in_executor(
+        None, piezo.bring_up, serials, max_workers)
+    stages = [AsyncPiezoController(c) if c is not None else None
+              for c in controllers]
+    return stages, results
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+'''
+Incremental noise and drift statistics of the strain reader readings.
+
+Example
+-------
+analytics = mypiezo.reader.start_analytics()
+time.sleep(60)
+print(analytics.summary())
+'''
+import math
+import threading
+import time
+import numpy as np
+
+
+###############################################################################
+#       Statistics
+###############################################################################
+class StreamAnalytics(object):
+    '''
+    Running statistics of a regularly sampled signal.
+
+    Every sample updates, in constant time and memory:
+    - the mean and standard deviation of all the samples (Welford),
+    - the rms noise (standard deviation) of the newest window samples,
+    - the drift rate, the least squares slope of the newest drift_window
+      samples,
+    - the overlapping Allan deviation at the taus m*tau0 for m = 1, 2, 4,
+      ... max_m, from a ring of 2*max_m + 1 cumulative sums.
+
+    The Allan deviation assumes one sample every tau0 seconds.
+
+    Args
+    ------
+    tau0 : float.
+            The sampling interval in seconds.
+
+    window : int.
+            The number of samples of the rms noise window.
+
+    drift_window : int.
+            The number of samples of the drift window.
+
+    max_m : int.
+            The longest Allan tau in samples, rounded down to a power of 2.
+    '''
+    # Number of updates of a window between two exact recomputations of its
+    # running sums, which limits the accumulated rounding errors
+    resum_every = 1 << 16
+
+    def __init__(self, tau0, window=100, drift_window=6000, max_m=4096):
+        self.tau0 = float(tau0)
+        self.window = int(window)
+        self.drift_window = int(drift_window)
+        self.ms = [1 << i for i in range(int(max_m).bit_length())]
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.first_time = None
+        self.last_time = None
+        self._ref = None
+        # Noise window: values and running sums of (v - ref)
+        self._noise = np.zeros(self.window)
+        self._noise_sum = 0.0
+        self._noise_sq = 0.0
+        # Drift window: times, values and running sums
+        self._drift_t = np.zeros(self.drift_window)
+        self._drift_v = np.zeros(self.drift_window)
+        self._drift_sums = [0.0, 0.0, 0.0, 0.0]  # t, v, t*t, t*v
+        self._t_ref = None
+        # Allan deviation: ring of cumulative sums and, per tau, the sum of
+        # the squared differences and their count
+        self._cumsum = 0.0
+        self._ring = [0.0]*(2*self.ms[-1] + 1)
+        self._allan_sum = [0.0]*len(self.ms)
+        self._allan_count = [0]*len(self.ms)
+
+    def add(self, t, value):
+        '''Add one sample taken at time t.'''
+        if self._ref is None:
+            self._ref = value
+            self._t_ref = t
+            self.first_time = t
+        self.last_time = t
+        n = self.n = self.n + 1
+        # Welford
+        delta = value - self.mean
+        self.mean += delta/n
+        self._m2 += delta*(value - self.mean)
+
+        x = value - self._ref
+        # Noise window
+        i = (n - 1) % self.window
+        old = self._noise[i] if n > self.window else 0.0
+        self._noise[i] = x
+        self._noise_sum += x - old
+        self._noise_sq += x*x - old*old
+
+        # Drift window
+        dt = t - self._t_ref
+        i = (n - 1) % self.drift_window
+        sums = self._drift_sums
+        if n > self.drift_window:
+            old_t = self._drift_t[i]
+            old_v = self._drift_v[i]
+            sums[0] -= old_t
+            sums[1] -= old_v
+            sums[2] -= old_t*old_t
+            sums[3] -= old_t*old_v
+        self._drift_t[i] = dt
+        self._drift_v[i] = x
+        sums[0] += dt
+        sums[1] += x
+        sums[2] += dt*dt
+        sums[3] += dt*x
+
+        if n % self.resum_every == 0:
+            self._resum()
+
+        # Allan deviation. S_n is the sum of the first n samples and the
+        # averages over m samples are (S_k+m - S_k)/m.
+        self._cumsum += x
+        ring = self._ring
+        size = len(ring)
+        s = ring[n % size] = self._cumsum
+        for k, m in enumerate(self.ms):
+            if n < 2*m:
+                break
+            d = (s - 2*ring[(n - m) % size] + ring[(n - 2*m) % size])/m
+            self._allan_sum[k] += d*d
+            self._allan_count[k] += 1
+
+    def extend(self, times, values):
+        '''Add arrays of samples.'''
+        for t, v in zip(np.asarray(times).tolist(), np.asarray(values).tolist()):
+            self.add(t, v)
+
+    def _resum(self):
+        # The unused slots of the windows are zeros
+        self._noise_sum = float(self._noise.sum())
+        self._noise_sq = float(np.square(self._noise).sum())
+        t = self._drift_t
+        v = self._drift_v
+        self._drift_sums = [float(t.sum()), float(v.sum()),
+                            float((t*t).sum()), float((t*v).sum())]
+
+    # ### Queries ##############################################################
+    def std(self):
+        return math.sqrt(self._m2/(self.n - 1)) if self.n > 1 else None
+
+    def window_rms(self):
+        '''Standard deviation of the newest window samples.'''
+        size = min(self.n, self.window)
+        if size < 2:
+            return None
+        mean = self._noise_sum/size
+        return math.sqrt(max(self._noise_sq/size - mean*mean, 0.0))
+
+    def drift_rate(self):
+        '''Slope in units per second of the newest drift_window samples.'''
+        size = min(self.n, self.drift_window)
+        if size < 2:
+            return None
+        st, sv, stt, stv = self._drift_sums
+        denominator = size*stt - st*st
+        if denominator <= 0:
+            return None
+        return (size*stv - st*sv)/denominator
+
+    def allan(self):
+        '''Return the overlapping Allan deviation as a list of
+        (tau in seconds, deviation, number of terms), for the taus with at
+        least one term.'''
+        return [(m*self.tau0, math.sqrt(total/(2*count)), count)
+                for m, total, count in zip(self.ms, self._allan_sum, self._allan_count)
+                if count]
+
+    def summary(self):
+        '''Return all the statistics as a dictionary.'''
+        return {'samples': self.n,
+                'duration': (self.last_time - self.first_time) if self.n else 0.0,
+                'mean': self.mean if self.n else None,
+                'std': self.std(),
+                'window_rms': self.window_rms(),
+                'drift_rate': self.drift_rate(),
+                'allan': self.allan()}
+
+
+###############################################################################
+#       Background consumer
+###############################################################################
+class AnalyticsConsumer(threading.Thread):
+    '''
+    Thread that feeds the new samples of a StrainReader buffer to a
+    StreamAnalytics every interval seconds.
+
+    The polling policy of the reader is kept at full rate while it runs,
+    since the statistics need regular samples. Query the statistics from
+    any thread with summary().
+    '''
+    def __init__(self, reader, analytics, interval=0.1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.reader = reader
+        self.analytics = analytics
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        last_t = time.perf_counter()
+        while not self._stop_event.is_set():
+            # Fast without waking the sampler, whose grid must stay regular
+            self.reader.polling.keep_fast(2*self.interval)
+            times, values = self.reader.since(last_t)
+            if times.size:
+                last_t = times[-1]
+                with self._lock:
+                    self.analytics.extend(times, values)
+            self._stop_event.wait(self.interval)
+
+    def summary(self):
+        with self._lock:
+            return self.analytics.summary()
+
+    def reset(self):
+        with self._lock:
+            self.analytics.reset()
+
+    def stop(self):
+        self._stop_event.set()
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark suite for piezo.py.
+
+By default it runs on the simulated backend of kinesis_sim.py, so it needs
+no hardware. The results are printed and can be written as JSON to track
+them between versions.
+
+Usage
+-------
+python bench_piezo.py --output bench.json
+python bench_piezo.py --latency 0.001 --noise 0.005
+python bench_piezo.py --backend kinesis --controller 81858318 --reader 84858066
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+
+def _stats(durations):
+    d = np.asarray(durations)
+    return {'n': int(d.size),
+            'mean': float(d.mean()),
+            'median': float(np.median(d)),
+            'min': float(d.min()),
+            'max': float(d.max()),
+            'p95': float(np.percentile(d, 95))}
+
+
+###############################################################################
+#       Benchmarks
+###############################################################################
+def bench_import(modules, repeats, budget):
+    '''Import time of each module in a fresh interpreter, against a budget.
+
+    The minimum over the repeats is compared with the budget, as it is the
+    least affected by the load of the machine.
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for module in modules:
+        code = ('import time; t = time.perf_counter(); import ' + module +
+                '; print(time.perf_counter() - t)')
+        durations = []
+        for i in range(repeats):
+            out = subprocess.check_output([sys.executable, '-c', code], cwd=here)
+            durations.append(float(out.decode().split()[-1]))
+        results[module] = _stats(durations)
+        results[module]['budget'] = budget
+        results[module]['within_budget'] = min(durations) <= budget
+    return results
+
+
+def bench_connect(piezo, serials, repeats, sim):
+    '''Time from nothing to an enabled controller/reader pair.'''
+    durations = []
+    controller = None
+    for i in range(repeats if sim else 1):
+        if sim:
+            # A fresh registry and bus for every repetition
+            import kinesis_sim
+            kinesis_sim.reset()
+            piezo.set_backend(kinesis_sim)
+        t = time.perf_counter()
+        controller = piezo.PiezoController(*serials)
+        durations.append(time.perf_counter() - t)
+    return _stats(durations), controller
+
+
+def bench_throughput(call, duration):
+    '''Calls per second of a function without arguments.'''
+    n = 0
+    start = time.perf_counter()
+    end = start + duration
+    while time.perf_counter() < end:
+        call()
+        n += 1
+    elapsed = time.perf_counter() - start
+    return {'calls': n, 'calls_per_second': n/elapsed,
+            'mean_latency': elapsed/n}
+
+
+def gui_tick(controller):
+    '''The device work of one poll of the StagePiezo and StageStrainReader
+    pollers of piezogui.py (read_state), without the Tk widgets.'''
+    piezo_state = {'value': controller.get_value(),
+                   'units': controller.get_units(),
+                   'closed_loop': controller.is_closed_loop()}
+    times, values = controller.reader.since(time.perf_counter() - 0.1)
+    reader_state = {'value': values[-1] if values.size else None,
+                    'samples': (times, values),
+                    'closed_loop': controller.is_closed_loop(),
+                    'zeroing': controller.reader.is_zeroing()}
+    return piezo_state, reader_state
+
+
+def bench_gui_tick(controller, repeats):
+    durations = []
+    for i in range(repeats):
+        t = time.perf_counter()
+        gui_tick(controller)
+        durations.append(time.perf_counter() - t)
+    return _stats(durations)
+
+
+def bench_calibration(controller, repeats):
+    '''Duration of a full calibration and of a cached restore.'''
+    from calibration import CalibrationCache
+    controller.calibration_cache = CalibrationCache(
+        os.path.join(tempfile.mkdtemp(), 'calibration.json'))
+    controller.set_closed_loop()
+    full = []
+    cached = []
+    residuals = []
+    for i in range(repeats):
+        t = time.perf_counter()
+        report = controller.calibrate_pos()
+        full.append(time.perf_counter() - t)
+        residuals.append(report['rms_um'])
+        t = time.perf_counter()
+        report = controller.calibrate_pos(use_cache=True)
+        cached.append(time.perf_counter() - t)
+    return {'full': _stats(full), 'cached': _stats(cached),
+            'rms_residual_um': float(np.mean(residuals))}
+
+
+def bench_move_settle(controller, repeats):
+    '''Latency from a move command to the detected settle.'''
+    durations = []
+    settle_times = []
+    errors = []
+    targets = np.random.RandomState(0).uniform(2, 18, repeats)
+    for target in targets:
+        t = time.perf_counter()
+        settle_time = controller.move_to_pos(target, wait=True)
+        durations.append(time.perf_counter() - t)
+        if settle_time is not None:
+            settle_times.append(settle_time)
+        errors.append(controller.reader.get_pos() - target)
+    return {'move_to_settled': _stats(durations),
+            'settle_time': _stats(settle_times) if settle_times else None,
+            'timeouts': repeats - len(settle_times),
+            'rms_error_um': float(np.sqrt(np.mean(np.square(errors))))}
+
+
+def bench_servo(controller, repeats):
+    '''Convergence time and final error of moves with the software servo.'''
+    servo = controller.start_servo()
+    try:
+        durations = []
+        errors = []
+        targets = np.random.RandomState(0).uniform(2, 18, repeats)
+        for target in targets:
+            t = time.perf_counter()
+            controller.move_to_pos(target, wait=True)
+            durations.append(time.perf_counter() - t)
+            errors.append(servo.position - target)
+        report = servo.report()
+    finally:
+        controller.stop_servo()
+    return {'move_on_target': _stats(durations),
+            'missed_targets': report['missed_targets'],
+            'overruns': report['overruns'],
+            'rms_error_um': float(np.sqrt(np.mean(np.square(errors))))}
+
+
+def bench_polling(controller, duration):
+    '''Sample rate and saved polls of the adaptive sampler, over an idle
+    period followed by a period with a move every half second.'''
+    reader = controller.reader
+    reader.start_sampling()
+    reader.polling.reset_stats()
+    time.sleep(duration)
+    idle = reader.polling.stats()['sampler']
+    reader.polling.reset_stats()
+    for target in np.linspace(4, 16, int(2*duration)):
+        controller.move_to_pos(target)
+        time.sleep(0.5)
+    active = reader.polling.stats()['sampler']
+    return {'idle': idle, 'active': active}
+
+
+def bench_analytics(n):
+    '''Update cost per sample of the noise and drift statistics.'''
+    from analytics import StreamAnalytics
+    values = np.random.RandomState(0).normal(0, 0.002, n)
+    stats = StreamAnalytics(0.01)
+    t = time.perf_counter()
+    stats.extend(0.01*np.arange(n), values)
+    elapsed = time.perf_counter() - t
+    return {'samples': n, 'per_sample': elapsed/n}
+
+
+###############################################################################
+#       Main
+###############################################################################
+def run(args):
+    sim = args.backend == 'sim'
+    os.environ['KINESIS_BACKEND'] = args.backend
+    if sim:
+        import kinesis_sim
+        kinesis_sim.configure(latency=args.latency, noise=args.noise,
+                              pairs=[(args.controller, args.reader)])
+    import piezo
+    results = {'meta': {'timestamp': time.time(),
+                        'backend': args.backend,
+                        'python': sys.version.split()[0],
+                        'numpy': np.__version__,
+                        'platform': platform.platform(),
+                        'latency': args.latency if sim else None,
+                        'noise': args.noise if sim else None}}
+
+    results['import'] = bench_import(('piezo', 'piezogui'), args.repeats,
+                                     args.import_budget)
+    serials = (args.controller, args.reader)
+    results['connect'], controller = bench_connect(piezo, serials,
+                                                   args.repeats, sim)
+    results['get_value'] = bench_throughput(controller.get_value, args.duration)
+    results['get_pos'] = bench_throughput(controller.reader.get_pos, args.duration)
+    results['gui_tick'] = bench_gui_tick(controller, 10*args.repeats)
+    results['calibration'] = bench_calibration(controller, args.repeats)
+    results['move_settle'] = bench_move_settle(controller, 5*args.repeats)
+    results['servo'] = bench_servo(controller, 5*args.repeats)
+    results['polling'] = bench_polling(controller, 2*args.duration)
+    results['analytics'] = bench_analytics(100000)
+    controller.set_open_loop()
+    return results
+
+
+def summary(results):
+    lines = []
+    for module, d in sorted(results['import'].items()):
+        lines.append('import {0:<11} {1:9.1f} ms{2}'.format(
+            module, 1e3*d['min'], '' if d['within_budget'] else '  OVER BUDGET'))
+    lines.append('connect            {0:9.1f} ms'.format(1e3*results['connect']['median']))
+    lines.append('get_value          {0:9.0f} calls/s'.format(results['get_value']['calls_per_second']))
+    lines.append('get_pos            {0:9.0f} calls/s'.format(results['get_pos']['calls_per_second']))
+    lines.append('gui tick           {0:9.3f} ms'.format(1e3*results['gui_tick']['median']))
+    lines.append('calibration        {0:9.1f} ms'.format(1e3*results['calibration']['full']['median']))
+    lines.append('cached calibration {0:9.1f} ms'.format(1e3*results['calibration']['cached']['median']))
+    lines.append('move to settled    {0:9.1f} ms'.format(1e3*results['move_settle']['move_to_settled']['median']))
+    lines.append('servo move         {0:9.1f} ms'.format(1e3*results['servo']['move_on_target']['median']))
+    lines.append('idle sample rate   {0:9.1f} Hz ({1:.0%} of the polls saved)'.format(
+        results['polling']['idle']['rate'], results['polling']['idle']['saved_fraction']))
+    lines.append('active sample rate {0:9.1f} Hz'.format(results['polling']['active']['rate']))
+    lines.append('analytics update   {0:9.2f} us/sample'.format(1e6*results['analytics']['per_sample']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of piezo.py')
+    parser.add_argument('--backend', default='sim', choices=('sim', 'kinesis'))
+    parser.add_argument('--controller', default='81858318')
+    parser.add_argument('--reader', default='84858066')
+    parser.add_argument('--latency', type=float, default=0.0002,
+                        help='simulated interop latency in s')
+    parser.add_argument('--noise', type=float, default=0.002,
+                        help='simulated reading noise in um')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--duration', type=float, default=1.0,
+                        help='duration of the throughput benchmarks in s')
+    parser.add_argument('--import-budget', type=float, default=0.25,
+                        help='maximum import time of piezo and piezogui in s')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    print(summary(results))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    return results
+
+
+if __name__ == "__main__":
+    main()
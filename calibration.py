@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+import time
+import numpy as np
+
+
+###############################################################################
+#       Position calibration model
+###############################################################################
+class PositionCalibration(object):
+    '''
+    Model that translates stage position (um) to percentage travel and back.
+
+    The model is fitted to (position, percentage) pairs recorded with the
+    strain reader while the controller is in closed loop. Both directions of
+    the transform accept scalars or numpy arrays of any shape.
+
+    Args
+    ------
+    positions : array like.
+            The positions read by the strain reader at each calibration point.
+
+    percentages : array like.
+            The percentage travel commanded at each calibration point.
+
+    model : str.
+            'poly' for a least-squares polynomial or 'table' for a monotone
+            lookup table with linear interpolation between the points. The
+            polynomial is tabulated densely over the calibration range and
+            made monotone, so both models map through one monotone table and
+            to_position(to_percentage(x)) == x. The readings may rise or
+            fall with the percentage, the table follows the sign of the
+            best straight line through the points.
+
+    degree : int.
+            The degree of the polynomial. It is reduced if there are not
+            enough points.
+
+    Example
+    -------
+    cal = PositionCalibration([1.9, 8.1, 14.2], [10, 40, 70], degree=1)
+    cal.to_percentage(np.linspace(2, 14, 1000))
+    '''
+    # Points and margin (fraction of the calibration range) of the table of
+    # the polynomial model
+    table_size = 2001
+    table_margin = 0.1
+
+    def __init__(self, positions, percentages, model='poly', degree=3):
+        self.positions = np.asarray(positions, dtype=float)
+        self.percentages = np.asarray(percentages, dtype=float)
+        if self.positions.size < 2 or self.positions.shape != self.percentages.shape:
+            raise ValueError('At least two matching calibration points are required')
+        if model not in ('poly', 'table'):
+            raise ValueError('Unknown calibration model: ' + str(model))
+        self.model = model
+        self.degree = int(min(degree, self.positions.size - 1))
+        self.forward = None  # position -> percentage polynomial coefficients
+        self.sign = None  # 1 if the readings rise with the percentage, else -1
+        self._table_pos = None
+        self._table_pct = None
+        self.fit()
+
+    def fit(self):
+        # The readings against the percentages, well defined for any data
+        slope = np.polyfit(self.percentages, self.positions, 1)[0]
+        span = slope*np.ptp(self.percentages)
+        if not abs(span) > 1e-9*(1.0 + np.abs(self.positions).max()):
+            raise ValueError('The calibration positions do not change with the percentage')
+        self.sign = 1.0 if slope > 0 else -1.0
+        if self.model == 'poly':
+            self.forward = np.polyfit(self.positions, self.percentages, self.degree)
+            # Tabulate the polynomial over the calibration range with a
+            # margin and flatten the parts that go against the sign. The
+            # table is inverted exactly by swapping its axes.
+            lo = self.positions.min()
+            hi = self.positions.max()
+            margin = self.table_margin*(hi - lo)
+            self._table_pos = np.linspace(lo - margin, hi + margin, self.table_size)
+            pct = np.polyval(self.forward, self._table_pos)
+            self._table_pct = self.sign*np.maximum.accumulate(self.sign*pct)
+        else:
+            self._table_pos, self._table_pct = _monotone_table(
+                self.positions, self.percentages, self.sign)
+
+    # ### Transforms ##########################################################
+    def to_percentage(self, positions):
+        '''Translate position(s) in um to percentage travel.'''
+        x = np.asarray(positions, dtype=float)
+        y = _interp_extrapolate(x, self._table_pos, self._table_pct)
+        return y if y.ndim else float(y)
+
+    def to_position(self, percentages):
+        '''Translate percentage travel to position(s) in um.'''
+        y = np.asarray(percentages, dtype=float)
+        # np.interp needs increasing percentages
+        step = 1 if self.sign > 0 else -1
+        x = _interp_extrapolate(y, self._table_pct[::step], self._table_pos[::step])
+        return x if x.ndim else float(x)
+
+    def linear_terms(self):
+        '''Return the slope a and the constant b of the best straight line
+        percentage = a*position + b through the calibration points.'''
+        a, b = np.polyfit(self.positions, self.percentages, 1)
+        return float(a), float(b)
+
+    # ### Serialization #######################################################
+    def to_dict(self):
+        '''Return a JSON serializable description of the calibration.'''
+        return {'model': self.model,
+                'degree': self.degree,
+                'positions': self.positions.tolist(),
+                'percentages': self.percentages.tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['positions'], d['percentages'], model=d['model'],
+                   degree=d['degree'])
+
+    # ### Quality of the fit ##################################################
+    def residuals(self):
+        '''Return the residuals of the fit in um at the calibration points.
+
+        They are the errors of to_percentage, the map used to move, turned
+        into um with its local slope: the position error of a move to each
+        calibration point. The table passes through its points, so for the
+        table model they are leave-one-out errors: the error at each point
+        of the table made without it (nan with fewer than 3 points).
+        '''
+        x = self.positions
+        y = self.percentages
+        if self.model == 'poly':
+            return self._errors(self.to_percentage, x, y)
+        r = np.full(x.size, np.nan)
+        if x.size < 3:
+            return r
+        for i in range(x.size):
+            keep = np.arange(x.size) != i
+            pos, pct = _monotone_table(x[keep], y[keep], self.sign)
+            r[i] = self._errors(lambda v: _interp_extrapolate(v, pos, pct),
+                                x[i], y[i])
+        return r
+
+    def _errors(self, to_percentage, x, y):
+        h = 1e-3*(self.positions.max() - self.positions.min())
+        slope = (to_percentage(x + h) - to_percentage(x - h))/(2*h)
+        return (to_percentage(x) - y)/slope
+
+    def report(self):
+        '''Return a dictionary with a summary of the fit quality.'''
+        r = self.residuals()
+        return {'model': self.model,
+                'degree': self.degree if self.model == 'poly' else None,
+                'points': int(self.positions.size),
+                'rms_um': float(np.sqrt(np.mean(r**2))),
+                'max_abs_um': float(np.max(np.abs(r))),
+                'range_um': (float(self.positions.min()),
+                             float(self.positions.max()))}
+
+
+###############################################################################
+#       Open loop hysteresis model
+###############################################################################
+class HysteresisModel(object):
+    '''
+    Prandtl-Ishlinskii model of the open loop voltage to position response,
+    with its inverse for open loop positioning.
+
+    The position is x = g(p), with p a weighted sum of play operators of
+    the voltage v with widths r_i,
+
+    p = b + sum_i w_i*F_ri[v],  F_r[v] = min(max(y, v - r), v + r)
+
+    (y is the previous output of the operator) and g a monotone polynomial
+    for the static nonlinearity of the piezo. The weights are fitted with
+    non-negative least squares, so p never decreases when v increases.
+
+    The model remembers the state of the operators. apply(v) must be called
+    for every voltage sent to the stage, and inverse(x) returns the voltage
+    that moves the stage to x from the current state.
+
+    Args
+    ------
+    voltages : array like.
+            Every voltage applied during the sweep, in order.
+
+    positions : array like.
+            The position measured after each voltage, nan where it was not
+            measured (e.g. for the initial moves to the ends of the range).
+
+    v_max : float.
+            The maximum output voltage.
+
+    n_operators : int.
+            The number of play operators.
+
+    max_width : float.
+            The width of the widest play operator, as a fraction of v_max.
+
+    degree : int.
+            The degree of g.
+    '''
+    def __init__(self, voltages, positions, v_max, n_operators=10,
+                 max_width=0.25, degree=3):
+        self.voltages = np.asarray(voltages, dtype=float)
+        self.positions = np.asarray(positions, dtype=float)
+        if self.voltages.shape != self.positions.shape:
+            raise ValueError('The voltages and positions do not match')
+        self.v_max = float(v_max)
+        self.widths = np.linspace(0.0, max_width*self.v_max, int(n_operators))
+        self.degree = int(degree)
+        self.weights = None
+        self.offset = None
+        self.output = None  # coefficients of g
+        self.state = None
+        self.voltage = None
+        self._table_p = None
+        self._table_x = None
+        self.fit()
+
+    def operators(self, voltages, state=None):
+        '''Return the outputs of the play operators for a voltage sequence,
+        as an array of shape (len(voltages), n_operators), and the final
+        state.'''
+        r = self.widths
+        y = voltages[0] - r if state is None else state.copy()
+        out = np.empty((len(voltages), r.size))
+        for k, v in enumerate(voltages):
+            y = np.minimum(np.maximum(y, v - r), v + r)
+            out[k] = y
+        return out, y
+
+    def fit(self):
+        ok = ~np.isnan(self.positions)
+        F, self.state = self.operators(self.voltages)
+        self.voltage = float(self.voltages[-1])
+        F = F[ok]
+        x = self.positions[ok]
+        # Alternate between the operator weights with g fixed and g with
+        # the weights fixed. The first pass uses g(p) = p.
+        target = x
+        for i in range(3):
+            self.weights, self.offset = _nonnegative_lstsq(F, target)
+            p = F.dot(self.weights) + self.offset
+            self.output = np.polyfit(p, x, self.degree)
+            # Dense table of g, for the inversion
+            span = p.max() - p.min()
+            self._table_p = np.linspace(p.min() - 0.1*span, p.max() + 0.1*span, 2001)
+            self._table_x = np.maximum.accumulate(np.polyval(self.output, self._table_p))
+            target = _interp_extrapolate(x, self._table_x, self._table_p)
+
+    # ### Forward model and inverse ###########################################
+    def predict(self, voltages, state=None):
+        '''Return the positions for a voltage sequence, starting from state
+        (by default the state at the start of the fitted sweep).'''
+        voltages = np.asarray(voltages, dtype=float)
+        if state is None:
+            state = voltages[0] - self.widths
+        F, y = self.operators(voltages, state)
+        return np.polyval(self.output, F.dot(self.weights) + self.offset)
+
+    def apply(self, voltage):
+        '''Update the state for a voltage sent to the stage.'''
+        r = self.widths
+        self.state = np.minimum(np.maximum(self.state, voltage - r), voltage + r)
+        self.voltage = float(voltage)
+
+    def position(self):
+        '''Return the position predicted for the current state.'''
+        return float(np.polyval(self.output, self.state.dot(self.weights) + self.offset))
+
+    def inverse(self, position):
+        '''Return the voltage that moves the stage to position (um) from
+        the current state, within 0 and v_max. The state is not changed.'''
+        p = float(_interp_extrapolate(position, self._table_x, self._table_p))
+        r = self.widths
+        y = self.state
+        v0 = self.voltage
+        if p >= self.state.dot(self.weights) + self.offset:
+            # Going up every operator follows v - r once v passes y + r, so
+            # p is piecewise linear in v with corners at y + r
+            v = np.concatenate(([v0], np.clip(y + r, v0, self.v_max), [self.v_max]))
+            v.sort()
+            ps = np.maximum(v[:, None] - r, y).dot(self.weights) + self.offset
+        else:
+            v = np.concatenate(([0.0], np.clip(y - r, 0.0, v0), [v0]))
+            v.sort()
+            ps = np.minimum(v[:, None] + r, y).dot(self.weights) + self.offset
+        return float(np.interp(p, ps, v))
+
+    # ### Quality of the fit ##################################################
+    def residuals(self):
+        '''Return the residuals of the model in um over the fitted sweep.'''
+        ok = ~np.isnan(self.positions)
+        return self.predict(self.voltages)[ok] - self.positions[ok]
+
+    def report(self, inversions=1000):
+        '''Return a dictionary with the fit quality and the inversion cost.
+
+        The error of a single-valued voltage to position polynomial on the
+        same sweep is given for comparison (no hysteresis model).
+        '''
+        r = self.residuals()
+        ok = ~np.isnan(self.positions)
+        v = self.voltages[ok]
+        x = self.positions[ok]
+        static = np.polyval(np.polyfit(v, x, self.degree), v) - x
+        targets = np.random.RandomState(0).uniform(x.min(), x.max(), inversions)
+        start = time.perf_counter()
+        for target in targets:
+            self.inverse(target)
+        duration = time.perf_counter() - start
+        return {'operators': int(self.widths.size),
+                'points': int(ok.sum()),
+                'rms_um': float(np.sqrt(np.mean(r**2))),
+                'max_abs_um': float(np.max(np.abs(r))),
+                'static_rms_um': float(np.sqrt(np.mean(static**2))),
+                'static_max_abs_um': float(np.max(np.abs(static))),
+                'inversion_us': 1e6*duration/inversions,
+                'range_um': (float(x.min()), float(x.max()))}
+
+
+def _nonnegative_lstsq(A, b, iterations=None):
+    # Least squares of A.w + offset = b with w >= 0 (the offset is free).
+    # Active set: drop the most negative weight and solve again.
+    n = A.shape[1]
+    active = np.ones(n, dtype=bool)
+    for i in range(n if iterations is None else iterations):
+        M = np.column_stack((A[:, active], np.ones(len(b))))
+        solution = np.linalg.lstsq(M, b, rcond=None)[0]
+        w = np.zeros(n)
+        w[active] = solution[:-1]
+        if w.min() >= 0 or active.sum() == 1:
+            break
+        active[np.argmin(w)] = False
+    return np.maximum(w, 0.0), float(solution[-1])
+
+
+###############################################################################
+#       Calibration cache
+###############################################################################
+class CalibrationCache(object):
+    '''
+    Small on-disk cache of calibrations, keyed by the serial numbers of the
+    piezo controller and the strain reader.
+
+    The cache is a single JSON file. Each entry holds the calibration points,
+    the time it was made and the device state it is valid for (maximum
+    output voltage and reader display mode).
+
+    Args
+    ------
+    path : str (optional).
+            The location of the cache file. Defaults to
+            ~/.kinesis-piezo/calibration.json
+
+    max_age : float.
+            The age in seconds after which an entry is considered stale.
+    '''
+    # Shared by all the instances, as the controllers of one rig normally
+    # use the same file
+    _lock = threading.Lock()
+
+    def __init__(self, path=None, max_age=7*24*3600):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.kinesis-piezo',
+                                'calibration.json')
+        self.path = path
+        self.max_age = max_age
+
+    @staticmethod
+    def key(serial_controller, serial_reader):
+        return str(serial_controller) + '/' + str(serial_reader)
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write(self, data):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Write to a temporary file first so that a crash never leaves
+        # a half written cache behind
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def load(self, serial_controller, serial_reader, max_voltage=None,
+             display_mode=None):
+        '''Return the cached entry if it is still valid, otherwise None.
+
+        An entry is valid if it is younger than self.max_age and was made
+        with the same maximum output voltage and display mode.
+        '''
+        with self._lock:
+            entry = self._read().get(self.key(serial_controller, serial_reader))
+        if entry is None:
+            return None
+        if time.time() - entry.get('timestamp', 0) > self.max_age:
+            return None
+        if max_voltage is not None and entry.get('max_voltage') != max_voltage:
+            return None
+        if display_mode is not None and entry.get('display_mode') != display_mode:
+            return None
+        return entry
+
+    def store(self, serial_controller, serial_reader, calibration,
+              max_voltage=None, display_mode=None):
+        '''Store a PositionCalibration and return the new entry.'''
+        entry = {'serial_controller': str(serial_controller),
+                 'serial_reader': str(serial_reader),
+                 'timestamp': time.time(),
+                 'max_voltage': max_voltage,
+                 'display_mode': display_mode,
+                 'calibration': calibration.to_dict()}
+        with self._lock:
+            data = self._read()
+            data[self.key(serial_controller, serial_reader)] = entry
+            self._write(data)
+        return entry
+
+    def remove(self, serial_controller, serial_reader):
+        with self._lock:
+            data = self._read()
+            if data.pop(self.key(serial_controller, serial_reader), None) is not None:
+                self._write(data)
+
+
+def _monotone_table(positions, percentages, sign):
+    '''Return the (positions, percentages) table of the points, sorted by
+    increasing position. Noisy points that go against the sign are
+    flattened, so that the table can be inverted.'''
+    order = np.argsort(percentages)
+    pct = percentages[order]
+    pos = sign*np.maximum.accumulate(sign*positions[order])
+    if sign < 0:
+        pos = pos[::-1]
+        pct = pct[::-1]
+    return pos, pct
+
+
+def _interp_extrapolate(x, xp, fp):
+    '''np.interp with linear extrapolation from the end segments.'''
+    y = np.interp(x, xp, fp)
+    lo_slope = (fp[1] - fp[0]) / ((xp[1] - xp[0]) or 1.0)
+    hi_slope = (fp[-1] - fp[-2]) / ((xp[-1] - xp[-2]) or 1.0)
+    y = np.where(x < xp[0], fp[0] + (x - xp[0])*lo_slope, y)
+    y = np.where(x > xp[-1], fp[-1] + (x - xp[-1])*hi_slope, y)
+    return y
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+'''
+Binary logging of stage data to memory-mapped files.
+
+A log is a directory with one sub-directory per stream (e.g. 'reading',
+'percentage', 'voltage', 'target') and a meta.json file. Every stream is a
+sequence of chunk files of fixed size records (time, value), written
+through numpy.memmap. The records live in the page cache of the operating
+system, not on the Python heap, and the chunk headers are updated on every
+flush, so a log can be read while it is written and survives a crash up to
+the last flush.
+
+Example
+-------
+mypiezo.start_logging('run1')
+...
+mypiezo.stop_logging()
+log = datalog.LogReader('run1')
+records = log.slice('reading', t0, t1)
+plot(records['time'], records['value'])
+'''
+import json
+import os
+import threading
+import time
+import numpy as np
+
+# Record and chunk header of the chunk files, little endian
+RECORD_DTYPE = np.dtype([('time', '<f8'), ('value', '<f8')])
+HEADER_DTYPE = np.dtype([('magic', 'S8'),
+                         ('capacity', '<u8'),   # records of the chunk
+                         ('count', '<u8'),      # records written
+                         ('t_first', '<f8'),
+                         ('t_last', '<f8'),
+                         ('reserved', 'V24')])
+HEADER_SIZE = HEADER_DTYPE.itemsize
+MAGIC = b'PZLOG001'
+
+
+###############################################################################
+#       Writer
+###############################################################################
+class _ChunkedStream(object):
+    '''The chunk files of one stream. Not thread safe, see DataLogger.'''
+    def __init__(self, directory, chunk_records):
+        self.directory = directory
+        self.chunk_records = int(chunk_records)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Continue after the chunks of a previous run, with times sorted
+        # after its last one
+        chunks = _chunk_files(directory)
+        self.index = len(chunks)
+        self.count = 0
+        self.total = 0
+        self.last_time = _last_time(chunks)
+        self._header = None
+        self._times = None
+        self._values = None
+        self._records = None
+
+    def _open_chunk(self):
+        path = os.path.join(self.directory, '{0:06d}.bin'.format(self.index))
+        with open(path, 'wb') as f:
+            f.truncate(HEADER_SIZE + self.chunk_records*RECORD_DTYPE.itemsize)
+        self._header = np.memmap(path, HEADER_DTYPE, 'r+', 0, (1,))
+        self._header['magic'] = MAGIC
+        self._header['capacity'] = self.chunk_records
+        self._header['t_first'] = np.nan
+        self._header['t_last'] = np.nan
+        self._records = np.memmap(path, RECORD_DTYPE, 'r+', HEADER_SIZE,
+                                  (self.chunk_records,))
+        self._times = self._records['time']
+        self._values = self._records['value']
+        self.count = 0
+
+    def _close_chunk(self):
+        self.flush()
+        self._header = self._records = self._times = self._values = None
+        self.index += 1
+
+    def append(self, t, value):
+        if self._records is None:
+            self._open_chunk()
+        elif self.count == self.chunk_records:
+            self._close_chunk()
+            self._open_chunk()
+        # Keep the times sorted for the searches of the reader
+        if t < self.last_time:
+            t = self.last_time
+        self._times[self.count] = t
+        self._values[self.count] = value
+        self.count += 1
+        self.total += 1
+        self.last_time = t
+
+    def extend(self, times, values):
+        done = 0
+        n = len(times)
+        while done < n:
+            if self._records is None:
+                self._open_chunk()
+            elif self.count == self.chunk_records:
+                self._close_chunk()
+                self._open_chunk()
+            k = min(n - done, self.chunk_records - self.count)
+            # Keep the times sorted after the previous ones
+            self._times[self.count:self.count + k] = np.maximum(
+                times[done:done + k], self.last_time)
+            self._values[self.count:self.count + k] = values[done:done + k]
+            self.count += k
+            done += k
+        if n:
+            self.total += n
+            self.last_time = max(self.last_time, times[-1])
+
+    def flush(self):
+        if self._records is None or self.count == 0:
+            return
+        self._records.flush()
+        header = self._header
+        header['t_first'] = self._times[0]
+        header['t_last'] = self._times[self.count - 1]
+        header['count'] = self.count
+        header.flush()
+
+    def close(self):
+        if self._records is not None:
+            self._close_chunk()
+
+
+class DataLogger(object):
+    '''
+    Writes timestamped streams of values to a log directory.
+
+    Values are added with record (single events such as a setpoint) and
+    extend (blocks of samples), or pulled from sources: functions called as
+    since(t) that return the (times, values) arrays after time t, e.g.
+    StrainReader.since. A background thread drains the sources and flushes
+    the files every flush_interval seconds, so the writers only copy into
+    the mapped memory.
+
+    The times are given as time.perf_counter() values. meta.json holds the
+    offset to convert the logged times to time.time(). An existing log is
+    continued: its metadata are kept, every run is added to meta['runs']
+    and the times of a new run are shifted to the time base of the first
+    one, so that the streams stay sorted and share one time_offset.
+
+    Args
+    ------
+    path : str.
+            The log directory.
+
+    chunk_records : int.
+            The number of records of every chunk file (16 bytes each).
+
+    flush_interval : float.
+            The time between flushes in seconds.
+    '''
+    def __init__(self, path, chunk_records=1 << 20, flush_interval=0.5,
+                 metadata=None):
+        self.path = path
+        self.chunk_records = chunk_records
+        self.flush_interval = flush_interval
+        self.streams = {}
+        self.sources = {}
+        self.flushes = 0
+        self.errors = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        now = time.time()
+        offset = now - time.perf_counter()
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+        else:
+            meta = {'created': now,
+                    'time_offset': offset,
+                    'record_dtype': RECORD_DTYPE.descr,
+                    'chunk_records': chunk_records,
+                    'runs': []}
+        meta.setdefault('runs', [])
+        meta['runs'].append({'started': now, 'time_offset': offset})
+        meta.update(metadata or {})
+        # Added to the perf_counter() times of this run to get the logged
+        # times, in the time base of the first run
+        self.time_shift = offset - meta['time_offset']
+        self.meta = meta
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f, indent=1, sort_keys=True)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _stream(self, name):
+        # Must be called with self._lock held
+        stream = self.streams.get(name)
+        if stream is None:
+            stream = _ChunkedStream(os.path.join(self.path, name),
+                                    self.chunk_records)
+            self.streams[name] = stream
+        return stream
+
+    def record(self, name, value, t=None):
+        '''Append one value to a stream, at time t or now.'''
+        with self._lock:
+            if t is None:
+                t = time.perf_counter()
+            self._stream(name).append(t + self.time_shift, value)
+
+    def extend(self, name, times, values):
+        '''Append arrays of increasing times and values to a stream.'''
+        with self._lock:
+            self._stream(name).extend(np.asarray(times) + self.time_shift, values)
+
+    def add_source(self, name, since):
+        '''Pull the values of a stream from since(t) on every flush.'''
+        with self._lock:
+            self.sources[name] = [since, time.perf_counter()]
+
+    def remove_source(self, name):
+        self.drain()
+        with self._lock:
+            self.sources.pop(name, None)
+
+    def drain(self):
+        '''Copy the new values of the sources into their streams.'''
+        with self._lock:
+            sources = list(self.sources.items())
+        for name, source in sources:
+            times, values = source[0](source[1])
+            if times.size:
+                source[1] = times[-1]
+                self.extend(name, times, values)
+
+    def flush(self):
+        self.drain()
+        with self._lock:
+            for stream in self.streams.values():
+                stream.flush()
+            self.flushes += 1
+
+    def stats(self):
+        '''Return the records written and the bytes used per stream.'''
+        with self._lock:
+            return dict((name, {'records': s.total,
+                                'chunks': s.index + (s._records is not None),
+                                'bytes': s.total*RECORD_DTYPE.itemsize})
+                        for name, s in self.streams.items())
+
+    def close(self):
+        self._stop_event.set()
+        self._thread.join()
+        self.drain()
+        with self._lock:
+            for stream in self.streams.values():
+                stream.close()
+
+    def _run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+                print('Data logger flush failed: ', e)
+
+
+class LoggedDevice(object):
+    '''
+    Wraps a piezo controller device and records the setpoints sent with
+    SetPercentageTravel and SetOutputVoltage in the 'percentage' and
+    'voltage' streams of a DataLogger. Everything else is passed through.
+    '''
+    def __init__(self, device, logger):
+        self.__dict__['wrapped'] = device
+        self.__dict__['logger'] = logger
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.wrapped, name, value)
+
+    def SetPercentageTravel(self, value):
+        self.logger.record('percentage', _to_double(value))
+        return self.wrapped.SetPercentageTravel(value)
+
+    def SetOutputVoltage(self, value):
+        self.logger.record('voltage', _to_double(value))
+        return self.wrapped.SetOutputVoltage(value)
+
+
+def _to_double(value):
+    # The setpoints are System.Decimal values, converted like in piezo.py
+    import piezo
+    return piezo.Decimal.ToDouble(value)
+
+
+###############################################################################
+#       Reader
+###############################################################################
+def _chunk_files(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.endswith('.bin'))
+
+
+def _last_time(paths):
+    # The newest time flushed to the chunk files, -inf if none
+    for path in reversed(paths):
+        header = np.memmap(path, HEADER_DTYPE, 'r', 0, (1,))[0]
+        if header['magic'] == MAGIC and header['count']:
+            return float(header['t_last'])
+    return -np.inf
+
+
+class LogReader(object):
+    '''
+    Reads a log directory without copying: the records are numpy views of
+    the memory-mapped chunk files. A log that is still being written can be
+    read, up to its last flush.
+
+    Args
+    ------
+    path : str.
+            The log directory.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.time_offset = self.meta['time_offset']
+
+    def streams(self):
+        return sorted(name for name in os.listdir(self.path)
+                      if os.path.isdir(os.path.join(self.path, name)))
+
+    def chunks(self, name):
+        '''Return the records of every chunk of a stream, as read-only
+        structured arrays with the fields 'time' and 'value'.'''
+        chunks = []
+        for path in _chunk_files(os.path.join(self.path, name)):
+            header = np.memmap(path, HEADER_DTYPE, 'r', 0, (1,))[0]
+            if header['magic'] != MAGIC:
+                raise ValueError('Not a log chunk: ' + path)
+            count = int(header['count'])
+            if count:
+                records = np.memmap(path, RECORD_DTYPE, 'r', HEADER_SIZE,
+                                    (int(header['capacity']),))
+                chunks.append(records[:count])
+        return chunks
+
+    def slice(self, name, t0=None, t1=None):
+        '''Return the records of a stream with t0 <= time <= t1.
+
+        The result is a view of the file when the range lies in one chunk,
+        otherwise the parts are concatenated into a new array.
+        '''
+        parts = []
+        for records in self.chunks(name):
+            times = records['time']
+            if (t0 is not None and times[-1] < t0) or (t1 is not None and times[0] > t1):
+                continue
+            lo = 0 if t0 is None else np.searchsorted(times, t0, side='left')
+            hi = len(times) if t1 is None else np.searchsorted(times, t1, side='right')
+            parts.append(records[lo:hi])
+        if not parts:
+            return np.empty(0, RECORD_DTYPE)
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+    def to_wall_time(self, times):
+        '''Convert logged times to time.time() values.'''
+        return times + self.time_offset
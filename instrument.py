@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+
+
+###############################################################################
+#       Latency statistics
+###############################################################################
+class LatencyHistogram(object):
+    '''
+    Constant memory histogram of call latencies in nanoseconds.
+
+    Latencies below 8 ns have their own buckets. Above that every power of
+    two is split in 4 buckets, so a bucket is at most 25% wide and 248
+    buckets cover any duration.
+    '''
+    nbuckets = 8 + 60*4
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+        self.buckets = [0]*self.nbuckets
+
+    @staticmethod
+    def bucket(ns):
+        if ns < 8:
+            return ns
+        bits = ns.bit_length()
+        # The two bits after the leading one select the sub-bucket
+        return min(8 + (bits - 4)*4 + ((ns >> (bits - 3)) & 3),
+                   LatencyHistogram.nbuckets - 1)
+
+    @staticmethod
+    def upper_bound(i):
+        '''The largest latency in ns that falls in bucket i.'''
+        if i < 8:
+            return i
+        bits, sub = divmod(i - 8, 4)
+        return ((5 + sub) << (bits + 1)) - 1
+
+    def add(self, ns):
+        self.count += 1
+        self.total += ns
+        if self.min is None or ns < self.min:
+            self.min = ns
+        if ns > self.max:
+            self.max = ns
+        self.buckets[self.bucket(ns)] += 1
+
+    def percentile(self, q):
+        '''Upper bound in ns of the q-th percentile (0 < q <= 100).'''
+        if self.count == 0:
+            return None
+        rank = q/100.0*self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(self.upper_bound(i), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count,
+                'total_ns': self.total,
+                'mean_ns': self.total/self.count if self.count else None,
+                'min_ns': self.min,
+                'max_ns': self.max,
+                'p50_ns': self.percentile(50),
+                'p99_ns': self.percentile(99),
+                'buckets': dict((self.upper_bound(i), n)
+                             for i, n in enumerate(self.buckets) if n)}
+
+
+class CallStats(object):
+    '''
+    Per method call counts and latency histograms.
+
+    The module creates one instance, instrument.stats, that is used by
+    default by all the instrumented devices.
+    '''
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, ns):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.add(ns)
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+
+    def dump(self):
+        '''Return the statistics as a dictionary, name -> summary.'''
+        with self._lock:
+            return dict((name, h.to_dict()) for name, h in self.histograms.items())
+
+    def to_json(self, path=None):
+        '''Return the statistics as JSON and optionally write them to path.'''
+        text = json.dumps(self.dump(), indent=1, sort_keys=True)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+    def table(self):
+        '''Return a text table of the statistics, sorted by total time.'''
+        rows = sorted(self.dump().items(), key=lambda x: -x[1]['total_ns'])
+        lines = ['{0:<40} {1:>9} {2:>11} {3:>10} {4:>10} {5:>10} {6:>10}'.format(
+            'call', 'count', 'total ms', 'mean us', 'p50 us', 'p99 us', 'max us')]
+        for name, d in rows:
+            lines.append('{0:<40} {1:>9d} {2:>11.3f} {3:>10.1f} {4:>10.1f} '
+                         '{5:>10.1f} {6:>10.1f}'.format(
+                             name, d['count'], d['total_ns']/1e6,
+                             d['mean_ns']/1e3, d['p50_ns']/1e3,
+                             d['p99_ns']/1e3, d['max_ns']/1e3))
+        return '\n'.join(lines)
+
+
+stats = CallStats()
+
+
+###############################################################################
+#       Instrumented proxy
+###############################################################################
+class InstrumentedProxy(object):
+    '''
+    Wraps an interop object and times every method call made through it.
+
+    Attributes listed in nested (e.g. 'Status') are wrapped in turn, so
+    device.Status.get_Reading() is recorded as 'prefix.Status.get_Reading'.
+    Calling the proxy itself (e.g. Decimal(1)) is recorded as 'prefix()'.
+
+    Args
+    ------
+    obj : object.
+            The wrapped object.
+
+    stats : CallStats.
+            Where the latencies are recorded.
+
+    prefix : str.
+            The name of the object in the statistics.
+    '''
+    __slots__ = ('_obj', '_stats', '_prefix', '_nested', '_cache')
+
+    def __init__(self, obj, stats, prefix, nested=()):
+        object.__setattr__(self, '_obj', obj)
+        object.__setattr__(self, '_stats', stats)
+        object.__setattr__(self, '_prefix', prefix)
+        object.__setattr__(self, '_nested', nested)
+        object.__setattr__(self, '_cache', {})
+
+    def __getattr__(self, name):
+        cache = self._cache
+        if name in cache:
+            return cache[name]
+        full_name = self._prefix + '.' + name
+        if name in self._nested:
+            # A property that returns a new object on every access
+            stats = self._stats
+            start = time.perf_counter_ns()
+            value = getattr(self._obj, name)
+            stats.record(full_name, time.perf_counter_ns() - start)
+            return InstrumentedProxy(value, stats, full_name)
+        value = getattr(self._obj, name)
+        if not callable(value):
+            return value
+        wrapper = _timed(value, self._stats, full_name)
+        cache[name] = wrapper
+        return wrapper
+
+    def __setattr__(self, name, value):
+        setattr(self._obj, name, value)
+
+    def __call__(self, *args):
+        stats = self._stats
+        start = time.perf_counter_ns()
+        try:
+            return self._obj(*args)
+        finally:
+            stats.record(self._prefix + '()', time.perf_counter_ns() - start)
+
+
+def _timed(method, stats, name):
+    perf_counter_ns = time.perf_counter_ns
+    record = stats.record
+
+    def wrapper(*args):
+        start = perf_counter_ns()
+        try:
+            return method(*args)
+        finally:
+            record(name, perf_counter_ns() - start)
+    return wrapper
+
+
+def unwrap(obj):
+    '''Return the object wrapped by an InstrumentedProxy, or obj itself.'''
+    if isinstance(obj, InstrumentedProxy):
+        return object.__getattribute__(obj, '_obj')
+    return obj
@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+'''
+Simulated Kinesis backend for the TPZ001 piezo controller (TCubePiezo) and
+the TSG001 strain gauge reader (TCubeStrainGauge).
+
+The classes imitate the parts of the Kinesis .NET API that piezo.py uses,
+with configurable interop latency, reading noise, settle dynamics and
+open loop hysteresis, so that piezo.py can be benchmarked and developed
+without the hardware. Select it before importing piezo with the
+environment variable KINESIS_BACKEND=sim, or at runtime with
+piezo.set_backend(kinesis_sim).
+
+Example
+-------
+import kinesis_sim
+kinesis_sim.configure(latency=0.0005, noise=0.003)
+import piezo
+piezo.set_backend(kinesis_sim)
+mypiezo = piezo.PiezoController(81858318, 84858066)
+'''
+import math
+import random
+import threading
+import time
+
+
+###############################################################################
+#       Configuration
+###############################################################################
+class SimConfig(object):
+    '''Parameters of the simulation. Change them with configure().'''
+    def __init__(self):
+        # (controller, reader) serial number pairs on the simulated bus
+        self.pairs = [('81858318', '84858066')]
+        # Duration in seconds of every interop call, plus a uniform jitter
+        self.latency = 0.0002
+        self.jitter = 0.0001
+        # Duration of BuildDeviceList and of the connection steps
+        self.enumerate_time = 0.05
+        self.connect_time = 0.05
+        self.settings_time = 0.1
+        self.enable_time = 0.05
+        # Stage travel in um at the maximum output voltage
+        self.travel = 20.0
+        # Rms noise of the strain gauge readings in um
+        self.noise = 0.002
+        # Settle time constants of the stage in seconds
+        self.tau_open = 0.01
+        self.tau_closed = 0.05
+        # Closed loop transfer, position = travel*(gain*f + curvature*f**2)
+        # with f the percentage travel / 100
+        self.closed_loop_gain = 0.97
+        self.closed_loop_curvature = 0.02
+        # Open loop hysteresis. Prandtl-Ishlinskii sum of play operators
+        # with these widths (fraction of the maximum voltage) and weights.
+        self.play_widths = (0.0, 0.03, 0.08, 0.15)
+        self.play_weights = (0.55, 0.2, 0.15, 0.1)
+        # Open loop nonlinearity, x = f + curvature*f*(1 - f)
+        self.open_loop_curvature = 0.1
+        # Duration of the strain gauge zeroing
+        self.zeroing_time = 0.2
+
+
+config = SimConfig()
+_stages = {}
+_lock = threading.Lock()
+
+
+def configure(**kwargs):
+    '''Change the simulation parameters, e.g. configure(latency=0.001).
+
+    Changing the parameters resets the simulated stages.
+    '''
+    for key, value in kwargs.items():
+        if not hasattr(config, key):
+            raise AttributeError('Unknown simulation parameter: ' + key)
+        setattr(config, key, value)
+    reset()
+
+
+def reset():
+    '''Forget the state of all the simulated stages.'''
+    with _lock:
+        _stages.clear()
+
+
+def _interop(duration=None):
+    # The cost of one round trip through pythonnet and the USB bus
+    if duration is None:
+        duration = config.latency + random.random()*config.jitter
+    if duration > 0:
+        time.sleep(duration)
+
+
+def _stage(serial):
+    # The stage driven by a controller or read by a reader, shared by both
+    serial = str(serial)
+    for controller, reader in config.pairs:
+        if serial in (str(controller), str(reader)):
+            serial = str(controller)
+            break
+    with _lock:
+        if serial not in _stages:
+            _stages[serial] = SimStage()
+        return _stages[serial]
+
+
+###############################################################################
+#       System and device manager
+###############################################################################
+class Decimal(float):
+    '''Stand-in for System.Decimal.'''
+    @staticmethod
+    def ToDouble(value):
+        return float(value)
+
+
+class _List(object):
+    '''Stand-in for a .NET List.'''
+    def __init__(self, items):
+        self._items = list(items)
+
+    @property
+    def Count(self):
+        return len(self._items)
+
+    def __getitem__(self, i):
+        return self._items[i]
+
+
+class DeviceManagerCLI(object):
+    @staticmethod
+    def BuildDeviceList():
+        _interop(config.enumerate_time)
+
+    @staticmethod
+    def GetDeviceList():
+        _interop()
+        serials = []
+        for pair in config.pairs:
+            serials.extend(str(s) for s in pair if s is not None)
+        return _List(serials)
+
+
+###############################################################################
+#       Stage model
+###############################################################################
+class SimStage(object):
+    '''
+    Physical model of a piezo stage with its strain gauge.
+
+    The position relaxes exponentially to the target set by the last
+    command. In closed loop the target follows the percentage travel
+    through a slightly nonlinear transfer. In open loop it follows the
+    voltage through a Prandtl-Ishlinskii hysteresis model.
+    '''
+    def __init__(self):
+        self.closed_loop = False
+        self.max_voltage = 75.0
+        self.voltage = 0.0
+        self.percentage = 0.0
+        self.offset = 0.0
+        self.zeroing_until = 0.0
+        self._plays = [0.0]*len(config.play_widths)
+        self._start = 0.0
+        self._target = 0.0
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def _position(self, now):
+        dt = now - self._t0
+        tau = config.tau_closed if self.closed_loop else config.tau_open
+        return self._target + (self._start - self._target)*math.exp(-dt/tau)
+
+    def _move(self, target):
+        now = time.perf_counter()
+        self._start = self._position(now)
+        self._t0 = now
+        self._target = target
+
+    def _open_loop_target(self, voltage):
+        u = voltage/self.max_voltage
+        for i, r in enumerate(config.play_widths):
+            self._plays[i] = min(max(self._plays[i], u - r), u + r)
+        f = (sum(w*p for w, p in zip(config.play_weights, self._plays)) /
+             sum(config.play_weights))
+        return config.travel*(f + config.open_loop_curvature*f*(1 - f))
+
+    def _closed_loop_target(self, percentage):
+        f = percentage/100.0
+        return config.travel*(config.closed_loop_gain*f +
+                              config.closed_loop_curvature*f**2)
+
+    def set_voltage(self, voltage):
+        with self._lock:
+            self.voltage = min(max(voltage, 0.0), self.max_voltage)
+            self._move(self._open_loop_target(self.voltage))
+
+    def set_percentage(self, percentage):
+        with self._lock:
+            self.percentage = min(max(percentage, 0.0), 100.0)
+            self.voltage = self.max_voltage*self.percentage/100.0
+            self._move(self._closed_loop_target(self.percentage))
+
+    def set_closed_loop(self, closed):
+        with self._lock:
+            if closed == self.closed_loop:
+                return
+            self.closed_loop = closed
+            # The stage holds its position through the mode switch
+            position = self._position(time.perf_counter())
+            f = max(position, 0.0)/config.travel
+            self.percentage = min(100.0*f/config.closed_loop_gain, 100.0)
+
+    def reading(self):
+        with self._lock:
+            position = self._position(time.perf_counter())
+        return position - self.offset + random.gauss(0.0, config.noise)
+
+    def set_zero(self):
+        with self._lock:
+            self.offset = self._position(time.perf_counter())
+            self.zeroing_until = time.perf_counter() + config.zeroing_time
+
+
+###############################################################################
+#       Devices
+###############################################################################
+class _Struct(object):
+    '''Object with attributes and set_ methods, like the Kinesis settings.'''
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('set_'):
+            attribute = name[4:]
+            return lambda value: setattr(self, attribute, value)
+        if name.startswith('get_'):
+            attribute = name[4:]
+            return lambda: getattr(self, attribute)
+        raise AttributeError(name)
+
+
+class _Device(object):
+    name = 'Simulated device'
+
+    def __init__(self, serial):
+        self.serial = str(serial)
+        self.stage = _stage(serial)
+        self._connected = False
+        self._enabled_at = None
+        # Device polling interval in seconds (None when stopped) and start
+        self._polling = None
+        self._polling_start = None
+
+    def Connect(self, serial):
+        _interop(config.connect_time)
+        if str(serial) != self.serial:
+            raise RuntimeError('Wrong serial number: ' + str(serial))
+        # Like Kinesis, which cannot open a device that is not on the bus
+        if not any(str(serial) in (str(c), str(r)) for c, r in config.pairs):
+            raise RuntimeError('Device not found: ' + str(serial))
+        self._connected = True
+
+    def Disconnect(self, persist):
+        _interop()
+        self._connected = False
+        self._enabled_at = None
+
+    def IsSettingsInitialized(self):
+        _interop()
+        return False
+
+    def WaitForSettingsInitialized(self, timeout):
+        _interop(min(config.settings_time, timeout/1000.0))
+
+    def StartPolling(self, interval):
+        _interop()
+        self._polling = interval/1000.0
+        self._polling_start = time.perf_counter()
+
+    def StopPolling(self):
+        _interop()
+        self._polling = None
+
+    def _poll(self):
+        # Index of the current device poll. Like Kinesis, the Status values
+        # are refreshed once per poll and not at all without polling.
+        if self._polling is None:
+            return None
+        return (self._polling_start,
+                int((time.perf_counter() - self._polling_start)/self._polling))
+
+    def EnableDevice(self):
+        _interop()
+        self._enabled_at = time.perf_counter() + config.enable_time
+
+    @property
+    def IsEnabled(self):
+        return (self._enabled_at is not None and
+                time.perf_counter() >= self._enabled_at)
+
+    def GetDeviceInfo(self):
+        _interop()
+        return _Struct(SerialNumber=self.serial, Name=self.name)
+
+
+class _PiezoStatus(object):
+    def __init__(self, device):
+        self._device = device
+
+    def get_IsClosedLoop(self):
+        _interop()
+        return self._device.stage.closed_loop
+
+    @property
+    def IsEnabled(self):
+        return self._device.IsEnabled
+
+
+class TCubePiezo(_Device):
+    '''Simulated TPZ001 piezo controller.'''
+    name = 'T-Cube Piezo Driver (simulated)'
+
+    def __init__(self, serial):
+        _Device.__init__(self, serial)
+        self.voltage_source = 0
+        self.control_mode = 1
+        self.PiezoDeviceSettings = _Struct(
+            OutputVoltageRange=_Struct(MaxOutputVoltage=Decimal(75)),
+            Control=_Struct(VoltageStepSize=Decimal(1),
+                            PercentageStepSize=Decimal(1)),
+            HubInputSource=_Struct(HubMode=1))
+        self._settings = self.PiezoDeviceSettings
+        self.hub_input = 1
+
+    @staticmethod
+    def CreateDevice(serial):
+        _interop()
+        return TCubePiezo(serial)
+
+    @property
+    def Status(self):
+        return _PiezoStatus(self)
+
+    def GetPiezoConfiguration(self, serial):
+        _interop()
+
+    def SetSettings(self, settings, persist):
+        _interop()
+        self._settings = settings
+        self.hub_input = int(settings.HubInputSource.HubMode)
+        self.stage.max_voltage = float(settings.OutputVoltageRange.MaxOutputVoltage)
+        self.stage.set_closed_loop(self.control_mode == 2 and self.hub_input == 3)
+
+    def GetMaxOutputVoltage(self):
+        _interop()
+        return Decimal(self.stage.max_voltage)
+
+    def GetVoltageSource(self):
+        _interop()
+        return self.voltage_source
+
+    def SetVoltageSource(self, source):
+        _interop()
+        self.voltage_source = int(source)
+
+    def GetIOSettings(self):
+        _interop()
+        return _Struct(HubAnalogueInput=self.hub_input)
+
+    def GetPositionControlMode(self):
+        _interop()
+        return self.control_mode
+
+    def SetPositionControlMode(self, mode):
+        _interop()
+        self.control_mode = int(mode)
+        # The loop closes only with the strain gauge on EXT IN
+        self.stage.set_closed_loop(self.control_mode == 2 and self.hub_input == 3)
+
+    def GetOutputVoltage(self):
+        _interop()
+        return Decimal(self.stage.voltage)
+
+    def SetOutputVoltage(self, voltage):
+        _interop()
+        if not self.stage.closed_loop:
+            self.stage.set_voltage(float(voltage))
+
+    def GetPercentageTravel(self):
+        _interop()
+        return Decimal(self.stage.percentage)
+
+    def SetPercentageTravel(self, percentage):
+        _interop()
+        if self.stage.closed_loop:
+            self.stage.set_percentage(float(percentage))
+
+    def Jog(self, direction):
+        _interop()
+        sign = 1 if int(direction) == 1 else -1
+        control = self._settings.Control
+        if self.stage.closed_loop:
+            self.stage.set_percentage(self.stage.percentage +
+                                      sign*float(control.PercentageStepSize))
+        else:
+            self.stage.set_voltage(self.stage.voltage +
+                                   sign*float(control.VoltageStepSize))
+
+
+class _StrainGaugeStatus(object):
+    def __init__(self, device):
+        self._device = device
+
+    def get_Reading(self):
+        _interop()
+        device = self._device
+        poll = device._poll()
+        if device._reading is None or (poll is not None and poll != device._reading_poll):
+            device._reading = device.stage.reading()
+            device._reading_poll = poll
+        return Decimal(device._reading)
+
+    def get_IsZeroing(self):
+        _interop()
+        return time.perf_counter() < self._device.stage.zeroing_until
+
+    @property
+    def IsEnabled(self):
+        return self._device.IsEnabled
+
+
+class TCubeStrainGauge(_Device):
+    '''Simulated TSG001 strain gauge reader.'''
+    name = 'T-Cube Strain Gauge Reader (simulated)'
+
+    def __init__(self, serial):
+        _Device.__init__(self, serial)
+        self.display_mode = 1
+        # The reading of the last device poll
+        self._reading = None
+        self._reading_poll = None
+
+    @staticmethod
+    def CreateDevice(serial):
+        _interop()
+        return TCubeStrainGauge(serial)
+
+    @property
+    def Status(self):
+        return _StrainGaugeStatus(self)
+
+    def GetStrainGaugeConfiguration(self, serial):
+        _interop()
+
+    def SetLEDs(self, value):
+        _interop()
+
+    def GetDisplayMode(self):
+        _interop()
+        return self.display_mode
+
+    def SetZero(self):
+        _interop()
+        self.stage.set_zero()
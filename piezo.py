@@ -1,21 +1,546 @@
 # -*- coding: utf-8 -*-
-from __future__ import print_function
-from __future__ import division
-
-import clr
+import os
+import threading
 import time
-# Needed for the use of Decimal class of c#. Requires clr to import System in
-# this way.
-from System import Decimal
-clr.AddReference("System")
-clr.AddReference("./libs/kinesis/Thorlabs.MotionControl.DeviceManagerCLI")
-clr.AddReference("./libs/kinesis/Thorlabs.MotionControl.GenericPiezoCLI")
-clr.AddReference("./libs/kinesis/Thorlabs.MotionControl.TCube.PiezoCLI")
-clr.AddReference("./libs/kinesis/Thorlabs.MotionControl.TCube.StrainGaugeCLI")
-from Thorlabs.MotionControl.DeviceManagerCLI import DeviceManagerCLI
-from Thorlabs.MotionControl.GenericPiezoCLI import Piezo
-from Thorlabs.MotionControl.TCube.PiezoCLI import *
-from Thorlabs.MotionControl.TCube.StrainGaugeCLI import *
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import numpy as np
+from acquisition import RingBuffer, Sampler, PollingPolicy
+from calibration import PositionCalibration, CalibrationCache, HysteresisModel
+import instrument
+
+# The device backend, 'kinesis' for the Thorlabs Kinesis .NET API or 'sim'
+# for the simulator of kinesis_sim.py. It is loaded by load_backend when the
+# first device object is created, so importing this module is cheap.
+BACKEND = os.environ.get('KINESIS_BACKEND', 'kinesis')
+Decimal = None
+DeviceManagerCLI = None
+TCubePiezo = None
+TCubeStrainGauge = None
+_backend_loaded = False
+_backend_lock = threading.Lock()
+
+
+class _KinesisBackend(object):
+    '''Loads the Kinesis assemblies through pythonnet.'''
+    def __init__(self):
+        import clr
+        clr.AddReference("System")
+        clr.AddReference("./libs/kinesis/Thorlabs.MotionControl.DeviceManagerCLI")
+        clr.AddReference("./libs/kinesis/Thorlabs.MotionControl.GenericPiezoCLI")
+        clr.AddReference("./libs/kinesis/Thorlabs.MotionControl.TCube.PiezoCLI")
+        clr.AddReference("./libs/kinesis/Thorlabs.MotionControl.TCube.StrainGaugeCLI")
+        # Needed for the use of Decimal class of c#. Requires clr to import
+        # System in this way.
+        from System import Decimal
+        from Thorlabs.MotionControl.DeviceManagerCLI import DeviceManagerCLI
+        from Thorlabs.MotionControl.TCube.PiezoCLI import TCubePiezo
+        from Thorlabs.MotionControl.TCube.StrainGaugeCLI import TCubeStrainGauge
+        self.Decimal = Decimal
+        self.DeviceManagerCLI = DeviceManagerCLI
+        self.TCubePiezo = TCubePiezo
+        self.TCubeStrainGauge = TCubeStrainGauge
+
+
+def load_backend(name=None):
+    '''Load the device backend, if it has not been loaded yet.
+
+    Args
+    -------
+    name : str (optional).
+            'kinesis' or 'sim'. Defaults to BACKEND.
+    '''
+    with _backend_lock:
+        if _backend_loaded:
+            return
+        if name is None:
+            name = BACKEND
+        if name == 'sim':
+            import kinesis_sim
+            backend = kinesis_sim
+        elif name == 'kinesis':
+            backend = _KinesisBackend()
+        else:
+            raise ValueError('Unknown backend: ' + str(name))
+        set_backend(backend)
+
+
+def set_backend(backend):
+    '''Use the device classes of another backend from now on.
+
+    Args
+    -------
+    backend : module or object.
+            Provides Decimal, DeviceManagerCLI, TCubePiezo and
+            TCubeStrainGauge, e.g. kinesis_sim.
+
+    The device registry is reset, so objects created afterwards use the new
+    backend.
+    '''
+    global Decimal, DeviceManagerCLI, TCubePiezo, TCubeStrainGauge, registry
+    global _backend_loaded
+    Decimal = backend.Decimal
+    DeviceManagerCLI = backend.DeviceManagerCLI
+    TCubePiezo = backend.TCubePiezo
+    TCubeStrainGauge = backend.TCubeStrainGauge
+    registry = DeviceRegistry()
+    _backend_loaded = True
+
+
+###############################################################################
+#       Device registry
+###############################################################################
+class DeviceRegistry(object):
+    '''
+    Process-wide registry of the connected Kinesis devices.
+
+    The USB bus is enumerated once and the serial numbers are cached until
+    the ttl expires or a refresh is requested. Connected devices are kept by
+    serial number, so a second object for the same serial reuses the
+    existing connection instead of opening a new one.
+
+    The module creates one instance, piezo.registry, that is used by all the
+    ThorStages objects. It also keeps the state that every object of one
+    device must share, see shared.
+
+    Args
+    ------
+    ttl : float.
+            The time in seconds after which the serial list is enumerated
+            again. None to never refresh automatically.
+    '''
+    def __init__(self, ttl=60.0):
+        self.ttl = ttl
+        self.enumerations = 0
+        self._serials = None
+        self._timestamp = 0.0
+        # serial -> (device, connect_enable result)
+        self._devices = {}
+        # serial -> {name: object shared by the objects of the device}
+        self._shared = {}
+        self._lock = threading.Lock()
+        self._serial_locks = {}
+
+    def serials(self, refresh=False):
+        '''Return the list of the serial numbers of the connected devices.
+
+        Exceptions raised by the device manager are propagated.
+        '''
+        with self._lock:
+            expired = (self.ttl is not None and
+                       time.perf_counter() - self._timestamp > self.ttl)
+            if refresh or self._serials is None or expired:
+                # Ask the device manager to get the list of all devices
+                # connected to the computer
+                DeviceManagerCLI.BuildDeviceList()
+                serial_numbers = DeviceManagerCLI.GetDeviceList()
+                self._serials = [str(serial_numbers[i])
+                                 for i in range(serial_numbers.Count)]
+                self._timestamp = time.perf_counter()
+                self.enumerations += 1
+                print('Kinesis devices: ', ', '.join(self._serials))
+            return list(self._serials)
+
+    def _serial_lock(self, serial):
+        with self._lock:
+            return self._serial_locks.setdefault(serial, threading.Lock())
+
+    def connect(self, serial, create, connect):
+        '''Return a connected device, creating it only the first time.
+
+        Args
+        -------
+        serial : str.
+                The serial number of the device.
+
+        create : callable.
+                Called as create(serial) to create the device object,
+                e.g. TCubePiezo.CreateDevice.
+
+        connect : callable.
+                Called as connect(device, serial) to connect the new device.
+                It returns a connect_enable result dictionary.
+
+        Returns
+        -------
+        device, result :
+                The device and the result of the connection that opened it.
+                Failed connections are not kept.
+        '''
+        serial = str(serial)
+        # Devices with different serials connect concurrently
+        with self._serial_lock(serial):
+            if serial in self._devices:
+                return self._devices[serial]
+            device = create(serial)
+            if device is None:
+                raise RuntimeError('Device ' + serial + ' is a null object')
+            # A new connection starts with new shared state
+            self._shared.pop(serial, None)
+            result = connect(device, serial)
+            if result['ok']:
+                self._devices[serial] = (device, result)
+            return device, result
+
+    def shared(self, serial, name, create):
+        '''Return the object name shared by all the objects of the device
+        with this serial, e.g. its StatusCache. The first call creates it
+        with create().'''
+        serial = str(serial)
+        with self._serial_lock(serial):
+            entries = self._shared.setdefault(serial, {})
+            if name not in entries:
+                entries[name] = create()
+            return entries[name]
+
+    def device(self, serial):
+        '''Return the connected device with this serial or None.'''
+        entry = self._devices.get(str(serial))
+        return entry[0] if entry is not None else None
+
+    def disconnect(self, serial):
+        '''Stop polling, disconnect and forget the device with this serial.'''
+        serial = str(serial)
+        with self._serial_lock(serial):
+            entry = self._devices.pop(serial, None)
+            self._shared.pop(serial, None)
+            if entry is not None:
+                entry[0].StopPolling()
+                entry[0].Disconnect(True)
+
+
+registry = DeviceRegistry()
+
+
+###############################################################################
+#       Status cache
+###############################################################################
+class StatusCache(object):
+    '''
+    Cache of slowly changing device state that is read through the interop
+    layer, e.g. the control mode or the display mode.
+
+    Each entry is read with its loader on the first access and read again
+    when it is older than refresh seconds or has been invalidated. The
+    methods that change the state of the device update the cache with set,
+    so reads on the hot path cost a dictionary lookup instead of a CLR call.
+
+    Args
+    ------
+    loaders : dict.
+            Maps the name of every entry to a function without arguments
+            that reads it from the device.
+
+    refresh : float.
+            The maximum age of an entry in seconds, to pick up changes made
+            outside of this program (e.g. on the front panel).
+    '''
+    def __init__(self, loaders, refresh=1.0):
+        self.loaders = loaders
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        # name -> (value, time of the read)
+        self._entries = {}
+
+    def get(self, name):
+        entry = self._entries.get(name)
+        now = time.perf_counter()
+        if entry is not None and now - entry[1] <= self.refresh:
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        value = self.loaders[name]()
+        self._entries[name] = (value, now)
+        return value
+
+    def set(self, name, value):
+        '''Record a value that we have just written to the device.'''
+        self._entries[name] = (value, time.perf_counter())
+
+    def invalidate(self, *names):
+        '''Forget the given entries, or all of them if no name is given.'''
+        if not names:
+            self._entries.clear()
+        for name in names:
+            self._entries.pop(name, None)
+
+
+###############################################################################
+#       Settings transactions
+###############################################################################
+class SettingsTransaction(object):
+    '''
+    Desired settings of a PiezoController, applied in one batch.
+
+    The desired values are compared with the StatusCache of the controller
+    and only the settings that differ are written: voltage_source and
+    control_mode with their own calls, and hub_input, max_voltage,
+    voltage_step and percentage_step together with one SetSettings call.
+    The loop is closed after its feedback input is set, and opened before
+    the input changes. If a call fails, the settings written so far are
+    restored to their previous values and their cache entries invalidated,
+    so the device is not left half configured.
+
+    Args
+    ------
+    controller : PiezoController.
+            The controller to configure.
+
+    desired : keyword arguments.
+            The desired settings, see SettingsTransaction.names.
+
+    Example
+    -------
+    with mypiezo.settings() as settings:
+        settings.set(max_voltage=100.0)
+        settings.set(voltage_step=0.5)
+    print(settings.report)
+    '''
+    names = ('voltage_source', 'hub_input', 'control_mode', 'max_voltage',
+             'voltage_step', 'percentage_step')
+    # The settings written with SetSettings
+    batched = ('hub_input', 'max_voltage', 'voltage_step', 'percentage_step')
+
+    def __init__(self, controller, **desired):
+        self.controller = controller
+        self.desired = {}
+        self.report = None
+        self.set(**desired)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        return False
+
+    def set(self, **desired):
+        '''Record desired settings. Returns the transaction.'''
+        for name, value in desired.items():
+            if name not in self.names:
+                raise ValueError('Unknown setting: ' + name)
+            self.desired[name] = value
+        return self
+
+    def diff(self):
+        '''Return {name: (current, desired)} for the settings that change.'''
+        status = self.controller.status
+        changes = {}
+        for name, value in self.desired.items():
+            current = status.get(name)
+            if abs(current - value) > 1e-9:
+                changes[name] = (current, value)
+        return changes
+
+    def commit(self):
+        '''Write the changed settings.
+
+        Returns
+        -------
+        report : dict.
+                'ok', 'error', 'changes' ({name: (previous, new)}), 'calls'
+                (the writes), 'reads' (the state reads that missed the
+                cache), 'rolled_back' and 'duration' in seconds.
+        '''
+        start = time.perf_counter()
+        controller = self.controller
+        status = controller.status
+        misses = status.misses
+        changes = self.diff()
+        steps = self._steps(changes)
+        report = {'ok': True, 'error': None, 'changes': changes,
+                  'calls': len(steps), 'reads': status.misses - misses,
+                  'rolled_back': False}
+        done = []
+        try:
+            for step in steps:
+                self._write(step, dict((name, changes[name][1]) for name in step))
+                done.append(step)
+        except Exception as e:
+            report['ok'] = False
+            report['error'] = e
+            print('Settings of ' + controller.serialNo + ' failed: ', e)
+            report['rolled_back'] = self._rollback(done, step, changes)
+        else:
+            for name, (previous, value) in changes.items():
+                status.set(name, value)
+            if 'control_mode' in self.desired or 'hub_input' in self.desired:
+                status.set('closed_loop', status.get('control_mode') == 2 and
+                           status.get('hub_input') == 3)
+        report['duration'] = time.perf_counter() - start
+        self.report = report
+        return report
+
+    def _steps(self, changes):
+        # The device calls as tuples of the setting names they write
+        steps = []
+        if 'voltage_source' in changes:
+            steps.append(('voltage_source',))
+        batch = tuple(name for name in self.batched if name in changes)
+        if 'control_mode' in changes and changes['control_mode'][1] != 2:
+            # Open the loop before its input changes
+            steps.append(('control_mode',))
+            if batch:
+                steps.append(batch)
+        else:
+            if batch:
+                steps.append(batch)
+            if 'control_mode' in changes:
+                steps.append(('control_mode',))
+        return steps
+
+    def _write(self, step, values):
+        device = self.controller.device
+        if step == ('voltage_source',):
+            device.SetVoltageSource(values['voltage_source'])
+        elif step == ('control_mode',):
+            device.SetPositionControlMode(values['control_mode'])
+        else:
+            settings = self.controller.mysettings
+            if 'hub_input' in values:
+                settings.HubInputSource.set_HubMode(values['hub_input'])
+            if 'max_voltage' in values:
+                settings.OutputVoltageRange.set_MaxOutputVoltage(Decimal(values['max_voltage']))
+            if 'voltage_step' in values:
+                settings.Control.set_VoltageStepSize(Decimal(values['voltage_step']))
+            if 'percentage_step' in values:
+                settings.Control.set_PercentageStepSize(Decimal(values['percentage_step']))
+            device.SetSettings(settings, False)  # False for not persistent settings
+
+    def _rollback(self, done, failed, changes):
+        '''Restore the previous values of the written steps, newest first.
+        Returns True if every written step was restored.'''
+        try:
+            # The failed call may have been partly applied
+            self._write(failed, dict((name, changes[name][0]) for name in failed))
+        except Exception:
+            pass
+        restored = True
+        for step in reversed(done):
+            try:
+                self._write(step, dict((name, changes[name][0]) for name in step))
+            except Exception as e:
+                restored = False
+                print('Rollback of ' + ', '.join(step) + ' failed: ', e)
+        # The state of the device is uncertain, read it again when needed
+        self.controller.status.invalidate('closed_loop', *changes)
+        return restored
+
+
+###############################################################################
+#       Command coalescing
+###############################################################################
+class CommandQueue(object):
+    '''
+    Latest-wins queue of the moves of one device, executed in order on a
+    worker thread.
+
+    Commands belong to a domain (e.g. 'pos' for um or 'value' for the
+    output value) and are absolute (move) or relative (jog). A move drops
+    all the pending commands, as only its target matters, and a jog is
+    added to the newest pending command of the same domain. A burst of
+    clicks therefore becomes one net move instead of a backlog of device
+    calls.
+
+    Args
+    ------
+    handlers : dict.
+            Maps every domain to a (move, jog) tuple of functions, called as
+            move(target) and jog(offset) on the worker thread.
+
+    Example
+    -------
+    mypiezo.commands.jog('pos', 1.0)
+    mypiezo.commands.move('value', 0)
+    mypiezo.commands.wait()
+    print(mypiezo.commands.stats())
+    '''
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.submitted = 0
+        self.executed = 0
+        self.merged = 0
+        self.errors = 0
+        self.last_error = None
+        # Pending commands, [domain, target or None, offset], oldest first
+        self._pending = deque()
+        self._busy = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def move(self, domain, target):
+        '''Queue a move to target, replacing all the pending commands.'''
+        with self._condition:
+            self.submitted += 1
+            self.merged += len(self._pending)
+            self._pending.clear()
+            self._pending.append([domain, target, 0.0])
+            self._notify()
+
+    def jog(self, domain, offset):
+        '''Queue a relative move, merged with a pending command of the
+        same domain.'''
+        with self._condition:
+            self.submitted += 1
+            if self._pending and self._pending[-1][0] == domain:
+                self._pending[-1][2] += offset
+                self.merged += 1
+            else:
+                self._pending.append([domain, None, offset])
+            self._notify()
+
+    def _notify(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        self._condition.notify()
+
+    def wait(self, timeout=None):
+        '''Wait until all the queued commands have been executed.
+
+        Returns True if they have, False on timeout.
+        '''
+        with self._condition:
+            end = None if timeout is None else time.perf_counter() + timeout
+            while self._pending or self._busy:
+                remaining = None if end is None else end - time.perf_counter()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def stats(self):
+        with self._condition:
+            return {'submitted': self.submitted,
+                    'executed': self.executed,
+                    'merged': self.merged,
+                    'pending': len(self._pending),
+                    'errors': self.errors}
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._busy = False
+                    self._condition.notify_all()
+                    self._condition.wait()
+                domain, target, offset = self._pending.popleft()
+                self._busy = True
+            move, jog = self.handlers[domain]
+            try:
+                if target is None:
+                    jog(offset)
+                else:
+                    move(target + offset)
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+                print('Command failed: ', e)
+            with self._condition:
+                self.executed += 1
 
 
 class ThorStages(object):
@@ -26,12 +551,18 @@ class ThorStages(object):
         self.num_of_devices = None
         self.serial_numbers = None
         self.device_connencted = False
+        # The CallStats of enable_instrumentation
+        self._instrument_stats = None
+        # Polling rates of the device and its consumers, fast while the
+        # stage moves and slow while it is quiet
+        self.polling = PollingPolicy()
+        load_backend()
 
-    def device_search(self):
-        # Ask the device manager to get the list of all devices connected
-        # to the computer
+    def device_search(self, refresh=False):
+        # Get the list of all devices connected to the computer from the
+        # shared registry. The bus is enumerated only once per process.
         try:
-            DeviceManagerCLI.BuildDeviceList()
+            self.serial_numbers = registry.serials(refresh)
             connected = True
         except Exception as e:
             print('Exception raised by BuildDeviceList \n', e)
@@ -39,20 +570,15 @@ class ThorStages(object):
             connected = False
 
         if connected:
-            # Get a c# list with all the connected kinesis serial numbers
-            self.serial_numbers = DeviceManagerCLI.GetDeviceList()
-            self.num_of_devices = self.serial_numbers.Count
-            if self.num_of_devices != 0:
-                for i in range(self.num_of_devices):
-                    print(self.serial_numbers[i])
-            else:
+            self.num_of_devices = len(self.serial_numbers)
+            if self.num_of_devices == 0:
                 print('No stages found')
                 connected = False
 
         self.device_connencted = connected
         return connected
 
-    def connect_enable(self, device, serialNo):
+    def connect_enable(self, device, serialNo, enable_timeout=2.0):
         '''Connect and enable the communication of the device with the computer.
 
         Args:
@@ -62,36 +588,123 @@ class ThorStages(object):
 
         serialNo : int.
                 The serial number of the device.
+
+        enable_timeout : float.
+                The maximum time in seconds to wait for the device to report
+                that it is enabled.
+
+        Returns
+        -------
+        result : dict.
+                'serial', 'ok', 'error' (the first exception raised or None),
+                'name' and 'timings', the duration in seconds of the
+                'connect', 'settings', 'enable' steps and the 'total'.
         '''
-        # Open a connection to the device
+        result = {'serial': str(serialNo), 'ok': False, 'error': None,
+                  'name': None, 'timings': {}}
+        timings = result['timings']
+        start = time.perf_counter()
         try:
+            # Open a connection to the device
             device.Connect(serialNo)
-        except Exception as e:
-            print('Failed to open device ', serialNo)
-            print(e)
+            timings['connect'] = time.perf_counter() - start
 
-        # Wait for the device settings to initialize
-        if not device.IsSettingsInitialized():
-            try:
-                print('Wait for initialization')
+            # Wait for the device settings to initialize
+            t = time.perf_counter()
+            if not device.IsSettingsInitialized():
                 device.WaitForSettingsInitialized(5000)
-            except Exception as e:
-                print('Settings failed to initialize')
-                print(e)
+            timings['settings'] = time.perf_counter() - t
+
+            # Start the device polling at the idle interval of the polling
+            # policy (250 ms by default). It follows the policy from then on.
+            t = time.perf_counter()
+            device.StartPolling(int(round(1000*self.polling.interval())))
+            self.polling.on_change = lambda interval: self._set_device_polling(device, interval)
+            # Enable the channel otherwise any move is ignored. Instead of
+            # fixed delays, poll until the device reports the enabled state.
+            device.EnableDevice()
+            deadline = t + enable_timeout
+            while not _is_enabled(device):
+                if time.perf_counter() > deadline:
+                    raise RuntimeError('Device ' + str(serialNo) +
+                                       ' was not enabled in time')
+                time.sleep(0.01)
+            timings['enable'] = time.perf_counter() - t
 
-        # Start the device polling (asks for comunication every 250ms).
-        device.StartPolling(250)
-        # Needs a delay so that the current enabled state can be obtained
-        time.sleep(0.500)
-        # Enable the channel otherwise any move is ignored
-        device.EnableDevice()
-        # Needs a delay to give time for the device to be enabled
-        time.sleep(0.500)
-        print('Device is now enabled')
+            # Info about device
+            result['name'] = str(device.GetDeviceInfo().Name)
+            result['ok'] = True
+        except Exception as e:
+            result['error'] = e
+        timings['total'] = time.perf_counter() - start
+        return result
+
+    def _set_device_polling(self, device, interval):
+        try:
+            device.StopPolling()
+            device.StartPolling(int(round(1000*interval)))
+        except Exception as e:
+            print('Failed to change the polling of ', self.serialNo, ': ', e)
+
+    # ### Instrumentation #####################################################
+    def enable_instrumentation(self, stats=None):
+        '''Record the latency of every call made to the device.
+
+        The device is wrapped in an instrument.InstrumentedProxy, and so is
+        the Decimal class, to also record the conversions. Without
+        instrumentation the calls go directly to the device, at no cost.
+
+        Args
+        -------
+        stats : instrument.CallStats (optional).
+                Where the calls are recorded. Defaults to instrument.stats.
+        '''
+        global Decimal, _instrumented_devices
+        if stats is None:
+            stats = instrument.stats
+        device = instrument.unwrap(self.device)
+        if device is not self.device:
+            return
+        self._instrument_stats = stats
+        # Named after the device, also under a datalog.LoggedDevice
+        name = type(getattr(device, 'wrapped', device)).__name__
+        self.device = instrument.InstrumentedProxy(
+            device, stats, name, nested=('Status',))
+        if _instrumented_devices == 0:
+            Decimal = instrument.InstrumentedProxy(Decimal, stats, 'Decimal')
+        _instrumented_devices += 1
 
-        # Display info about device
-        deviceInfo = device.GetDeviceInfo()
-        print("Device ", deviceInfo.SerialNumber, ' = ', deviceInfo.Name)
+    def disable_instrumentation(self):
+        global Decimal, _instrumented_devices
+        if instrument.unwrap(self.device) is self.device:
+            return
+        self.device = instrument.unwrap(self.device)
+        _instrumented_devices -= 1
+        if _instrumented_devices == 0:
+            Decimal = instrument.unwrap(Decimal)
+
+    def _rewrap_device(self, function):
+        # Replace the device by function(device), under the instrumentation
+        # proxy if there is one
+        instrumented = instrument.unwrap(self.device) is not self.device
+        if instrumented:
+            stats = self._instrument_stats
+            ThorStages.disable_instrumentation(self)
+        self.device = function(self.device)
+        if instrumented:
+            ThorStages.enable_instrumentation(self, stats)
+
+
+# Number of devices with instrumentation, to unwrap Decimal after the last
+_instrumented_devices = 0
+
+
+def _is_enabled(device):
+    '''Return the enabled state of a device as reported by its polling.'''
+    try:
+        return bool(device.IsEnabled)
+    except AttributeError:
+        return bool(device.Status.IsEnabled)
 
 
 ###############################################################################
@@ -111,30 +724,242 @@ class StrainReader(ThorStages):
         self.serialNo = str(serial)
         self.device = None
         self.travelmode = None
+        self.connect_result = None
+        self.status = None
+        # Background acquisition
+        self.buffer = None
+        self.sampler = None
+        # The datalog.DataLogger of the readings, see start_logging
+        self.logger = None
+        self._own_logger = False
+        # The analytics.AnalyticsConsumer of the readings, see start_analytics
+        self.analytics = None
         # Initialize
         if self.device_search():
             self.initialize()
 
     def initialize(self):
-        self.device = TCubeStrainGauge.CreateDevice(self.serialNo)
-        if self.device is None:
-            print('Strain Reader is a null object')
-        else:
-            print('Strain Reader, ' + str(self.serialNo) + ', has been created')
-
-        # Connect and enable the device
-        self.connect_enable(self.device, self.serialNo)
+        # Get the connected device from the registry. It is created and
+        # connected only if no other object uses this serial yet.
+        self.device, self.connect_result = registry.connect(
+            self.serialNo, TCubeStrainGauge.CreateDevice, self.connect_enable)
+        print('Strain Reader, ' + str(self.serialNo) + ', is available')
+        if not self.connect_result['ok']:
+            print('Failed to enable device ', self.serialNo)
+            print(self.connect_result['error'])
 
         # Initialize the DeviceUnitConverter object required for real world
         # unit parameters.
         self.device.GetStrainGaugeConfiguration(self.serialNo)
 
+        # State shared by the objects of this device, see initialize of
+        # PiezoController
+        self.status = registry.shared(self.serialNo, 'status', lambda: StatusCache({
+            'display_mode': lambda: int(self.device.GetDisplayMode())}))
+        self.polling = registry.shared(self.serialNo, 'polling', lambda: self.polling)
+
         self.device.SetLEDs(120)
 
     def get_pos(self):
         current_pos = Decimal.ToDouble(self.device.Status.get_Reading())
         return current_pos
 
+    # ### Background acquisition ##############################################
+    def start_sampling(self, rate=100, capacity=100000, adaptive=True):
+        '''Start a thread that reads the strain gauge at a fixed rate.
+
+        The readings are stored with their time.perf_counter() timestamps in
+        a preallocated ring buffer (self.buffer), which is read with the
+        latest, snapshot and since methods. Any number of consumers can read
+        the buffer without polling the device themselves.
+
+        Args
+        -------
+        rate : float.
+                The sampling rate in Hz, the fastest rate if adaptive.
+
+        capacity : int.
+                The number of samples kept in the buffer.
+
+        adaptive : bool.
+                If True the rate follows self.polling: full rate while the
+                stage moves, down to 1/self.polling.slow while it is quiet.
+        '''
+        if self.is_sampling():
+            return
+        if self.buffer is None or self.buffer.capacity != capacity:
+            self.buffer = RingBuffer(capacity)
+        self.sampler = Sampler(self.get_pos, rate, self.buffer,
+                               self.polling if adaptive else None)
+        self.sampler.start()
+
+    def stop_sampling(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+
+    def is_sampling(self):
+        return self.sampler is not None and self.sampler.is_alive()
+
+    def latest(self):
+        '''Return the newest buffered reading as (time, value) or None.'''
+        if self.buffer is None:
+            return None
+        return self.buffer.latest()
+
+    def snapshot(self, n=None):
+        '''Return the newest n buffered readings as (times, values) arrays.'''
+        if self.buffer is None:
+            return np.empty(0), np.empty(0)
+        return self.buffer.snapshot(n)
+
+    def since(self, t):
+        '''Return the buffered readings taken after time t as arrays.'''
+        if self.buffer is None:
+            return np.empty(0), np.empty(0)
+        return self.buffer.since(t)
+
+    # ### Logging #############################################################
+    def start_logging(self, path=None, logger=None, **kwargs):
+        '''Record all the readings in the 'reading' stream of a log.
+
+        Background sampling is started if needed and the logger drains the
+        buffer on every flush, so the sampling thread is not slowed down.
+
+        Args
+        -------
+        path : str.
+                The log directory of a new datalog.DataLogger, created with
+                the keyword arguments.
+
+        logger : datalog.DataLogger (optional).
+                An existing logger to use instead, e.g. that of the
+                controller.
+        '''
+        import datalog
+        self.stop_logging()
+        self._own_logger = logger is None
+        if logger is None:
+            logger = datalog.DataLogger(path, metadata={'reader': self.serialNo},
+                                        **kwargs)
+        self.start_sampling()
+        logger.add_source('reading', self.since)
+        self.logger = logger
+        return logger
+
+    def stop_logging(self):
+        if self.logger is None:
+            return
+        self.logger.remove_source('reading')
+        if self._own_logger:
+            self.logger.close()
+        self.logger = None
+
+    # ### Noise analytics #####################################################
+    def start_analytics(self, rate=100, window=1.0, drift_window=60.0,
+                        max_tau=60.0):
+        '''Compute the noise and drift statistics of the readings in the
+        background, see analytics.StreamAnalytics.
+
+        Background sampling is started if needed, and kept at full rate
+        while the analytics run.
+
+        Args
+        -------
+        rate : float.
+                The sampling rate in Hz if sampling is not running yet.
+
+        window, drift_window : float.
+                The durations in seconds of the rms noise and drift windows.
+
+        max_tau : float.
+                The longest Allan deviation tau in seconds.
+
+        Returns
+        -------
+        consumer : analytics.AnalyticsConsumer.
+                Query it with summary().
+        '''
+        from analytics import StreamAnalytics, AnalyticsConsumer
+        self.stop_analytics()
+        self.start_sampling(rate)
+        tau0 = 1.0/self.sampler.rate
+        stats = StreamAnalytics(tau0, max(int(window/tau0), 2),
+                                max(int(drift_window/tau0), 2),
+                                max(int(max_tau/tau0), 1))
+        self.analytics = AnalyticsConsumer(self, stats)
+        self.analytics.start()
+        return self.analytics
+
+    def stop_analytics(self):
+        if self.analytics is not None:
+            self.analytics.stop()
+            self.analytics = None
+
+    # ### Settle detection ####################################################
+    def wait_settled(self, tolerance=0.02, window=0.1, timeout=5.0, interval=0.005):
+        '''Wait until the readings stay inside a tolerance band for a window.
+
+        The readings come from the background buffer if sampling is running,
+        otherwise the device is polled every interval seconds.
+
+        Args
+        -------
+        tolerance : float.
+                The maximum peak to peak spread of the readings, in the
+                display units of the reader (usually um).
+
+        window : float.
+                The time in seconds that the readings have to stay inside
+                the tolerance band, at least 1.5 device polling intervals.
+
+        timeout : float.
+                The maximum time to wait in seconds.
+
+        Returns
+        -------
+        settle_time : float or None.
+                The time in seconds from the call until the readings entered
+                the band they stayed in, or None if the timeout expired.
+        '''
+        start = time.perf_counter()
+        last_t = start
+        band = deque()
+        # The device refreshes its readings once per poll. The readings of
+        # the first polling interval can still be those from before a move,
+        # so they are skipped until they change, and the window spans more
+        # than one poll so that a held reading does not look settled.
+        polling = self.polling.last_interval()
+        fresh_after = start + polling
+        window = max(window, 1.5*polling)
+        first = None
+        while True:
+            if self.is_sampling():
+                times, values = self.since(last_t)
+                samples = zip(times.tolist(), values.tolist())
+            else:
+                samples = [(time.perf_counter(), self.get_pos())]
+            for t, v in samples:
+                last_t = t
+                if t < fresh_after:
+                    if first is None:
+                        first = v
+                    if v == first:
+                        continue
+                    fresh_after = t
+                band.append((t, v))
+                # Drop the oldest readings until the band fits the tolerance
+                while len(band) > 1:
+                    readings = [x[1] for x in band]
+                    if max(readings) - min(readings) <= tolerance:
+                        break
+                    band.popleft()
+            if band and band[-1][0] - band[0][0] >= window:
+                return max(band[0][0] - start, 0.0)
+            if time.perf_counter() - start > timeout:
+                return None
+            time.sleep(interval)
+
     def set_zero(self):
         self.device.SetZero()
 
@@ -142,11 +967,12 @@ class StrainReader(ThorStages):
         return self.device.Status.get_IsZeroing()
 
     def get_units(self):
-        if self.device.GetDisplayMode() == 1:
+        display_mode = self.status.get('display_mode')
+        if display_mode == 1:
             units = 'μm'
-        elif self.device.GetDisplayMode() == 2:
+        elif display_mode == 2:
             units = 'V'
-        elif self.device.GetDisplayMode() == 3:
+        elif display_mode == 3:
             units = 'N'
         else:
             units = 'Error'
@@ -184,45 +1010,132 @@ class PiezoController(ThorStages):
         self.reader = None
         self.travelmode = None
         self.mysettings = None
+        self.connect_result = None
+        self.status = None
+        # Travel of the stage in um
+        self.travel = 20.0
         # Initialize
         if self.device_search():
             self.initialize()
-        # Calibration variables
+        # Calibration variables. self.a and self.b are the linear terms of
+        # the calibration, percentage = a*position + b.
+        self.calibration = None
+        self.calibration_cache = CalibrationCache()
         self.a = None
         self.b = None
+        # The open loop hysteresis model, see calibrate_open_loop
+        self.hysteresis = None
+        # Settle detection parameters and the measured settle times in
+        # seconds (None for a timeout), newest last.
+        self.settle_tolerance = 0.02
+        self.settle_window = 0.1
+        self.settle_timeout = 5.0
+        self.settle_times = deque(maxlen=100)
+        # The software position servo, see start_servo
+        self.servo = None
+        # The datalog.DataLogger of the stage, see start_logging
+        self.logger = None
+        # Latest-wins queue of the moves, 'pos' in um and 'value' in % or V
+        self.commands = CommandQueue({
+            'pos': (self.move_to_pos, self.jog_pos),
+            'value': (self.set_value, self.jog_value)})
 
     def initialize(self):
-        # Create the device
-        self.device = TCubePiezo.CreateDevice(self.serialNo)
-        if self.device is None:
-            print('Piezo Controller is a null object')
-        else:
-            print('Piezo Controller, ' + str(self.serialNo) + ', has been created')
+        # Bring up the strain reader in parallel with the controller
+        reader_executor = None
+        if self.serial_reader != 'Empty':
+            reader_executor = ThreadPoolExecutor(max_workers=1)
+            reader_future = reader_executor.submit(StrainReader, self.serial_reader)
 
-        # Connect and enable the device
-        self.connect_enable(self.device, self.serialNo)
+        # Get the connected device from the registry. It is created and
+        # connected only if no other object uses this serial yet.
+        self.device, self.connect_result = registry.connect(
+            self.serialNo, TCubePiezo.CreateDevice, self.connect_enable)
+        print('Piezo Controller, ' + str(self.serialNo) + ', is available')
+        if not self.connect_result['ok']:
+            print('Failed to enable device ', self.serialNo)
+            print(self.connect_result['error'])
 
         # Initialize the DeviceUnitConverter object required for real world
         # unit parameters.
         self.device.GetPiezoConfiguration(self.serialNo)
 
-        # Create an instance of device setting.
-        # Change the settings using this object and then use set
-        # settings to load them into the device.
+        # Cached state. Our own mode changes keep it up to date. The cache
+        # and the polling policy (with the device polling hook of
+        # connect_enable) belong to the device, so every object of this
+        # serial sees the mode changes of the others.
+        self.status = registry.shared(self.serialNo, 'status', lambda: StatusCache({
+            'closed_loop': lambda: bool(self.device.Status.get_IsClosedLoop()),
+            'voltage_source': lambda: int(self.device.GetVoltageSource()),
+            'hub_input': lambda: int(self.device.GetIOSettings().HubAnalogueInput),
+            'control_mode': lambda: int(self.device.GetPositionControlMode()),
+            'max_voltage': lambda: Decimal.ToDouble(self.device.GetMaxOutputVoltage()),
+            'voltage_step': lambda: Decimal.ToDouble(
+                self.device.PiezoDeviceSettings.Control.VoltageStepSize),
+            'percentage_step': lambda: Decimal.ToDouble(
+                self.device.PiezoDeviceSettings.Control.PercentageStepSize)}))
+        self.polling = registry.shared(self.serialNo, 'polling', lambda: self.polling)
+
+        # The device settings object. SettingsTransaction changes it and
+        # loads it into the device with SetSettings.
         self.mysettings = self.device.PiezoDeviceSettings
-        # Eg.
-        # self.mysettings.HubInputSource.set_HubMode(2)
-        # self.device.SetSettings(mysettings, False)
-        # False means to not write it in the memory for default on startup
 
-        # Change the Jog steps
-        self.mysettings.OutputVoltageRange.set_MaxOutputVoltage(Decimal(75))
-        self.mysettings.Control.set_VoltageStepSize(Decimal(1))
-        self.mysettings.Control.set_PercentageStepSize(Decimal(1))
-        self.device.SetSettings(self.mysettings, False)  # False for not persistent settings
+        # Maximum voltage and jog steps, written only if they differ
+        self.apply_settings(max_voltage=75.0, voltage_step=1.0,
+                            percentage_step=1.0)
+
+        if reader_executor is not None:
+            self.reader = reader_future.result()
+            reader_executor.shutdown()
+
+    def enable_instrumentation(self, stats=None):
+        ThorStages.enable_instrumentation(self, stats)
+        if self.reader is not None:
+            self.reader.enable_instrumentation(stats)
+
+    def disable_instrumentation(self):
+        ThorStages.disable_instrumentation(self)
+        if self.reader is not None:
+            self.reader.disable_instrumentation()
+
+    def start_logging(self, path, **kwargs):
+        '''Record the stage data in a log directory, see datalog.
+
+        The streams are 'target' (the positions in um of move_to_pos),
+        'percentage' and 'voltage' (every setpoint sent to the controller,
+        also by streams, scans and the servo) and 'reading' (every reading
+        of the strain reader). The keyword arguments are those of
+        datalog.DataLogger.
+
+        Returns
+        -------
+        logger : datalog.DataLogger.
+        '''
+        import datalog
+        self.stop_logging()
+        logger = datalog.DataLogger(path, metadata={
+            'controller': self.serialNo, 'reader': self.serial_reader}, **kwargs)
+        self._rewrap_device(lambda device: datalog.LoggedDevice(device, logger))
+        if self.reader is not None:
+            self.reader.start_logging(logger=logger)
+        self.logger = logger
+        return logger
+
+    def stop_logging(self):
+        if self.logger is None:
+            return
+        if self.reader is not None:
+            self.reader.stop_logging()
+        self._rewrap_device(lambda device: device.wrapped)
+        self.logger.close()
+        self.logger = None
 
-        if self.serial_reader is not 'Empty':
-            self.reader = StrainReader(self.serial_reader)
+    def connect_results(self):
+        '''Return the connect_enable results of the controller and reader.'''
+        results = [self.connect_result]
+        if self.reader is not None:
+            results.append(self.reader.connect_result)
+        return [r for r in results if r is not None]
 
     def get_units(self):
         if self.is_closed_loop():
@@ -238,19 +1151,53 @@ class PiezoController(ThorStages):
             value = Decimal.ToDouble(self.device.GetOutputVoltage())
         return value
 
+    def kick_polling(self, hold=None):
+        '''Poll the controller and the reader fast for hold seconds (by
+        default self.polling.hold), e.g. for a move.'''
+        self.polling.kick(hold)
+        if self.reader is not None:
+            self.reader.polling.kick(hold)
+
+    # The direct moves in % or V stop the servo, which would otherwise
+    # overwrite them on its next cycle
     def set_value(self, Value):
+        self.stop_servo()
+        self.kick_polling()
         if self.is_closed_loop():
             self.device.SetPercentageTravel(Decimal(Value))
         else:
             self.device.SetOutputVoltage(Decimal(Value))
 
     def moveup(self):
+        self.stop_servo()
+        self.kick_polling()
         self.device.Jog(1)
 
     def movedown(self):
+        self.stop_servo()
+        self.kick_polling()
         self.device.Jog(2)
 
+    def jog_value(self, steps):
+        '''Move by a number of jog steps, in one device call.'''
+        if steps == 1:
+            self.moveup()
+        elif steps == -1:
+            self.movedown()
+        elif steps:
+            # The jog step of the device, so that merged jogs move as far
+            # as single ones
+            if self.is_closed_loop():
+                high = 100.0
+                step = self.status.get('percentage_step')
+            else:
+                high = self.status.get('max_voltage')
+                step = self.status.get('voltage_step')
+            self.set_value(min(max(self.get_value() + steps*step, 0.0), high))
+
     def move_to_home(self):
+        self.stop_servo()
+        self.kick_polling()
         if self.is_closed_loop():
             self.device.SetPercentageTravel(Decimal(0))
         else:
@@ -258,88 +1205,498 @@ class PiezoController(ThorStages):
 
     # ### Closed loop #########################################################
     def is_closed_loop(self):
-        return self.device.Status.get_IsClosedLoop()
+        return self.status.get('closed_loop')
 
-    def set_closed_loop(self):
-        # Switch to software and Potentiometer control
-        if self.device.GetVoltageSource() != 2:
-           self.device.SetVoltageSource(2)  # 2 for software and Potentiometer only
+    def settings(self, **desired):
+        '''Return a SettingsTransaction of this controller, to record
+        desired settings and apply them together with commit().'''
+        return SettingsTransaction(self, **desired)
+
+    def apply_settings(self, **desired):
+        '''Write the desired settings that differ from the device state in
+        one transaction, see SettingsTransaction.
+
+        Args
+        -------
+        voltage_source : int.
+                2 for software and potentiometer control.
+
+        hub_input : int.
+                The feedback input, 1 for channel 1 and 3 for the external
+                SMA (EXT IN).
+
+        control_mode : int.
+                1 for open loop and 2 for closed loop.
 
-        # Switch to feedback input from SMA, EXT IN
-        # print(self.device.GetIOSettings().VoltageLimit)
-        if self.device.GetIOSettings().HubAnalogueInput != 3:  # 3 for external SMA
-            self.mysettings.HubInputSource.set_HubMode(3)
-            self.device.SetSettings(self.mysettings, False)  # False for not persistent settings
+        max_voltage : float.
+                The maximum output voltage in V.
 
-        if self.device.GetPositionControlMode() == 1:
-            # Mode=1 => openloop
-            # Mode=2 => closed loop
-            self.device.SetPositionControlMode(2)
+        voltage_step, percentage_step : float.
+                The jog steps in V and %.
+
+        Returns
+        -------
+        report : dict.
+                See SettingsTransaction.commit.
+        '''
+        return SettingsTransaction(self, **desired).commit()
+
+    def set_closed_loop(self):
+        '''Switch to closed loop: software and potentiometer control, the
+        strain gauge feedback on EXT IN and closed loop position control.
+        Returns the report of apply_settings.'''
+        self.stop_servo()
+        report = self.apply_settings(voltage_source=2, hub_input=3,
+                                     control_mode=2)
+        self.kick_polling()
+        return report
 
     def set_open_loop(self):
-        # Switch to software and Potentiometer control
-        if self.device.GetVoltageSource() != 2:
-           self.device.SetVoltageSource(2)  # 2 for software and Potentiometer only
-
-        # Switch to feedback input from Channel1
-        # print(self.device.GetIOSettings().VoltageLimit)
-        if self.device.GetIOSettings().HubAnalogueInput != 1:  # 3 for external SMA
-            self.mysettings.HubInputSource.set_HubMode(1)
-            self.device.SetSettings(self.mysettings, False)  # False for not persistent settings
-
-        if self.device.GetPositionControlMode() == 2:
-            # Mode=1 => openloop
-            # Mode=2 => closed loop
-            self.device.SetPositionControlMode(1)
-
-    def calibrate_pos(self):
+        '''Switch to open loop: software and potentiometer control, the
+        feedback input on channel 1 and open loop position control.
+        Returns the report of apply_settings.'''
+        self.stop_servo()
+        report = self.apply_settings(voltage_source=2, hub_input=1,
+                                     control_mode=1)
+        self.kick_polling()
+        return report
+
+    def wait_settled(self, tolerance=None, window=None, timeout=None):
+        '''Wait until the strain reader shows that the stage has settled.
+
+        The arguments default to self.settle_tolerance, self.settle_window
+        and self.settle_timeout. See StrainReader.wait_settled. The measured
+        settle time is appended to self.settle_times and returned.
+        '''
+        if tolerance is None:
+            tolerance = self.settle_tolerance
+        if window is None:
+            window = self.settle_window
+        if timeout is None:
+            timeout = self.settle_timeout
+        settle_time = self.reader.wait_settled(tolerance, window, timeout)
+        self.settle_times.append(settle_time)
+        if settle_time is None:
+            print('Stage ' + self.serialNo + ' did not settle within ' +
+                  str(timeout) + ' s')
+        return settle_time
+
+    def calibration_state(self):
+        '''Return the device state that a calibration depends on as a
+        (max_voltage, display_mode) tuple.'''
+        max_voltage = self.status.get('max_voltage')
+        display_mode = self.reader.status.get('display_mode')
+        return max_voltage, display_mode
+
+    def load_calibration(self, tolerance=0.1):
+        '''Restore the cached calibration of this controller/reader pair.
+
+        The cached entry is used only if it is not stale, was made with the
+        current maximum voltage and display mode, and a one point
+        verification agrees with it. For the verification the stage moves
+        to the middle calibration point and the reading is compared with
+        the position predicted by the cached model.
+
+        Args
+        -------
+        tolerance : float.
+                The maximum verification error in um.
+
+        Returns
+        -------
+        True if the calibration was restored, otherwise False.
+        '''
+        if not self.is_closed_loop():
+            return False
+        max_voltage, display_mode = self.calibration_state()
+        entry = self.calibration_cache.load(self.serialNo, self.serial_reader,
+                                            max_voltage, display_mode)
+        if entry is None:
+            return False
+        calibration = PositionCalibration.from_dict(entry['calibration'])
+        y = float(np.median(calibration.percentages))
+        self.kick_polling()
+        self.device.SetPercentageTravel(Decimal(y))
+        self.wait_settled()
+        error = self.reader.get_pos() - calibration.to_position(y)
+        if abs(error) > tolerance:
+            print('Cached calibration of ' + self.serialNo + ' failed the '
+                  'verification, error: {0:.4f} um'.format(error))
+            return False
+        self.calibration = calibration
+        self.a, self.b = calibration.linear_terms()
+        print('Using cached calibration of ' + self.serialNo + ' from ' +
+              time.ctime(entry['timestamp']))
+        return True
+
+    def calibrate_pos(self, n_points=9, low=10, high=90, model='poly', degree=3,
+                      use_cache=False, progress=None, cancel=None):
         '''Creates a calibration that translates position to voltage.
 
         The controller takes as input a value that is the percentage of the
         maximum posible voltage. It usefull to be able to use as input a number
-        in um. Hence, a simple calibration procedure is used. The stage moves
-        to 10 and 70 percent of the maximum voltage and the reader value is
-        recorded. Assuming a linear relationship,
+        in um. Hence, a calibration procedure is used. The stage steps through
+        n_points percentages between low and high and the reader value is
+        recorded once the readings have settled. A PositionCalibration model
+        is fitted to the points and stored in self.calibration. The linear
+        terms of the fit,
         percentage = a*position + b
-        the slope a and the constant b are calculated and used to translate
-        position to percentage voltage.
+        are also stored in self.a and self.b.
 
         This function should be called imediately after set_closed_loop.
+
+        Args
+        -------
+        n_points : int.
+                The number of calibration points.
+
+        low, high : float.
+                The percentage travel of the first and the last point.
+
+        model, degree :
+                The model of the fit. See PositionCalibration.
+
+        use_cache : bool.
+                If True, first try to restore a valid cached calibration
+                with load_calibration and skip the sweep if it succeeds.
+                Fresh calibrations are always stored in the cache.
+
+        progress : callable (optional).
+                Called as progress(fraction, message) as the calibration
+                advances, e.g. to update a GUI from another thread.
+
+        cancel : threading.Event (optional).
+                When it is set the calibration stops after the current point
+                and the previous calibration is kept.
+
+        Returns
+        -------
+        report : dict or None.
+                The fit report of the calibration, or None in open loop and
+                when it is cancelled.
         '''
-        y1 = 10
-        y2 = 70
-        time.sleep(1)
+        if progress is None:
+            progress = lambda fraction, message: None
+        if not self.is_closed_loop():
+            return None
+        self.stop_servo()
+        if use_cache:
+            progress(0.0, 'Verifying cached calibration')
+            if self.load_calibration():
+                progress(1.0, 'Calibrated')
+                report = self.calibration.report()
+                report['cached'] = True
+                return report
+        percentages = np.linspace(low, high, n_points)
+        positions = np.empty(n_points)
+        settle_times = []
+        # Let the loop lock after the mode switch
+        settle_times.append(self.wait_settled())
+        for i, y in enumerate(percentages):
+            if cancel is not None and cancel.is_set():
+                print('Calibration of ' + self.serialNo + ' cancelled')
+                return None
+            progress(i/n_points, 'Calibrating')
+            self.kick_polling()
+            self.device.SetPercentageTravel(Decimal(float(y)))
+            settle_times.append(self.wait_settled())
+            positions[i] = self.reader.get_pos()
+        progress(1.0, 'Calibrated')
+        self.calibration = PositionCalibration(positions, percentages,
+                                               model=model, degree=degree)
+        self.a, self.b = self.calibration.linear_terms()
+        max_voltage, display_mode = self.calibration_state()
+        self.calibration_cache.store(self.serialNo, self.serial_reader,
+                                     self.calibration, max_voltage, display_mode)
+        report = self.calibration.report()
+        report['cached'] = False
+        report['settle_times'] = settle_times
+        print('Calibration settle times (s): ', settle_times)
+        print('Calibration residuals, rms: {0:.4f} um, max: {1:.4f} um'.format(
+            report['rms_um'], report['max_abs_um']))
+        # eg go to 1um
+        self.move_to_pos(1.0)
+        return report
+
+    def calibrate_open_loop(self, n_points=40, low=0.0, high=None, window=0.05,
+                            n_operators=10, verify=5, progress=None, cancel=None):
+        '''Learn the open loop hysteresis to move to positions in open loop.
+
+        In open loop the stage drifts with the hysteresis of the piezo, so a
+        single voltage to position map is off by up to a few % of the
+        travel. Here the stage is swept up and down between low and high
+        volts (after a move to both ends, so that the sweep starts from a
+        known state) and a HysteresisModel is fitted to the readings. Then
+        move_to_pos works in open loop by inverting the model from its
+        current state.
+
+        Args
+        -------
+        n_points : int.
+                The number of points of each direction of the sweep.
+
+        low, high : float.
+                The voltage range. high defaults to the maximum voltage.
+
+        window : float.
+                The settle window of every point in seconds, see
+                wait_settled.
+
+        n_operators : int.
+                The number of play operators of the model.
+
+        verify : int.
+                The number of random open loop moves made after the fit to
+                measure the positioning error.
+
+        progress, cancel :
+                See calibrate_pos.
+
+        Returns
+        -------
+        report : dict or None.
+                The HysteresisModel report with the 'verification_errors'
+                in um, or None in closed loop and when it is cancelled.
+        '''
+        if progress is None:
+            progress = lambda fraction, message: None
         if self.is_closed_loop():
-            self.device.SetPercentageTravel(Decimal(y1))
-            time.sleep(4)
-            x1 = self.reader.get_pos()
-            time.sleep(0.01)
-            self.device.SetPercentageTravel(Decimal(y2))
-            time.sleep(4)
-            x2 = self.reader.get_pos()
-            time.sleep(0.01)
-            self.a = (y2-y1)/(x2-x1)
-            self.b = -self.a*x1+y1
-            # eg go to 1um
-            y = self.a*1.0+self.b
-            self.device.SetPercentageTravel(Decimal(y))
-
-    def move_to_pos(self, value):
-        y=self.a*value+self.b
+            return None
+        self.stop_servo()
+        if high is None:
+            high = self.status.get('max_voltage')
+        sweep = np.linspace(low, high, n_points)
+        voltages = np.concatenate(([high, low], sweep, sweep[::-1]))
+        positions = np.full(voltages.size, np.nan)
+        for i, v in enumerate(voltages):
+            if cancel is not None and cancel.is_set():
+                print('Open loop calibration of ' + self.serialNo + ' cancelled')
+                return None
+            progress(i/voltages.size, 'Calibrating open loop')
+            self.kick_polling()
+            self.device.SetOutputVoltage(Decimal(float(v)))
+            self.wait_settled(window=window)
+            if i >= 2:
+                positions[i] = self.reader.get_pos()
+        model = HysteresisModel(voltages, positions, self.status.get('max_voltage'),
+                                n_operators=n_operators)
+        self.hysteresis = model
+        # Positioning error of open loop moves with the model
+        errors = []
+        targets = np.random.RandomState(0).uniform(np.nanmin(positions),
+                                                   np.nanmax(positions), verify)
+        for target in targets:
+            self.move_to_pos(target, wait=True)
+            errors.append(float(self.reader.get_pos() - target))
+        progress(1.0, 'Calibrated')
+        report = model.report()
+        report['verification_errors'] = errors
+        print('Hysteresis model residuals, rms: {0:.4f} um, max: {1:.4f} um '
+              '(without the model: {2:.4f} um, {3:.4f} um)'.format(
+                  report['rms_um'], report['max_abs_um'],
+                  report['static_rms_um'], report['static_max_abs_um']))
+        return report
+
+    def pos_to_percentage(self, positions):
+        '''Translate position(s) in um to percentage travel.
+
+        Works on scalars and on whole numpy arrays, e.g. to precompute a scan.
+        '''
+        return self.calibration.to_percentage(positions)
+
+    def percentage_to_pos(self, percentages):
+        '''Translate percentage travel to position(s) in um.'''
+        return self.calibration.to_position(percentages)
+
+    def move_to_pos(self, value, wait=False):
+        '''Move to a position in um using the calibration.
+
+        If wait is True, return after the stage has settled with the settle
+        time in seconds (None if it timed out). While the servo runs, the
+        target is handed to it instead and wait returns the convergence
+        time once the stage is on target. In open loop the voltage comes
+        from the hysteresis model of calibrate_open_loop.
+        '''
+        if self.logger is not None:
+            self.logger.record('target', value)
+        self.kick_polling()
+        if self.servo_running():
+            self.servo.move_to(value)
+            if wait:
+                return self.servo.wait_on_target(self.settle_timeout)
+            return None
+        if self.hysteresis is not None and not self.is_closed_loop():
+            return self._move_open_loop(value, wait)
+        y = min(max(self.pos_to_percentage(value), 0.0), 100.0)
         self.device.SetPercentageTravel(Decimal(y))
+        if wait:
+            return self.wait_settled()
+
+    def _move_open_loop(self, value, wait):
+        model = self.hysteresis
+        # Catch up with voltages set outside of the model, e.g. by jogs,
+        # as a direct move to the current voltage
+        voltage = Decimal.ToDouble(self.device.GetOutputVoltage())
+        if abs(voltage - model.voltage) > 1e-3:
+            model.apply(voltage)
+        v = model.inverse(value)
+        self.device.SetOutputVoltage(Decimal(v))
+        model.apply(v)
+        if wait:
+            return self.wait_settled()
+
+    def stream(self, trajectory, rate, units='um', wait=True):
+        '''Send a trajectory of setpoints at a fixed rate.
+
+        See streaming.TrajectoryStreamer for the arguments. If wait is True
+        the call blocks and returns the timing report of the run, otherwise
+        it returns the running streamer.
+        '''
+        from streaming import TrajectoryStreamer
+        self.stop_servo()
+        streamer = TrajectoryStreamer(self, trajectory, rate, units)
+        # Full rate feedback for the whole trajectory
+        self.kick_polling(len(streamer.trajectory)/streamer.rate + self.polling.hold)
+        if wait:
+            return streamer.run()
+        streamer.start()
+        return streamer
+
+    def scan(self, positions, acquire, process=None, workers=1):
+        '''Step through positions (um), calling acquire at every settled
+        position and process on worker threads.
+
+        See scan.ScanRunner. Returns the result of the scan.
+        '''
+        from scan import ScanRunner
+        self.stop_servo()
+        return ScanRunner(self, acquire, process, workers).run(positions)
+
+    # ### Software servo #####################################################
+    def start_servo(self, target=None, **kwargs):
+        '''Start a software position servo on the strain reader feedback.
+
+        The servo holds target (um), or the current position, until
+        stop_servo is called, and move_to_pos hands it the new targets. It
+        owns the output of the controller while it runs, so mode switches,
+        calibrations, streams and scans stop it first. The keyword
+        arguments are those of servo.PositionServo.
+
+        Returns
+        -------
+        servo : PositionServo.
+                The running servo.
+        '''
+        from servo import PositionServo
+        self.stop_servo()
+        self.servo = PositionServo(self, **kwargs)
+        self.servo.start(target)
+        return self.servo
+
+    def stop_servo(self):
+        if self.servo is not None:
+            self.servo.stop()
+
+    def servo_running(self):
+        return self.servo is not None and self.servo.running()
+
+    def jog_pos(self, offset):
+        '''Move by offset um, within the travel of the stage.'''
+        if self.servo_running():
+            # Step from the target, not from a noisy reading
+            position = self.servo.target
+        else:
+            position = self.reader.get_pos()
+        self.move_to_pos(min(max(position + offset, 0.0), self.travel))
 
     def move_pos_up(self):
-        if self.reader.get_pos() < 19:
-            self.move_to_pos(self.reader.get_pos()+1)
+        self.jog_pos(1)
 
     def move_pos_down(self):
-        if self.reader.get_pos() > 1:
-            self.move_to_pos(self.reader.get_pos()-1)
+        self.jog_pos(-1)
 
     def move_pos_to_home(self):
         self.move_to_pos(0)
 
 
+###############################################################################
+#       Bring-up of many devices
+###############################################################################
+def bring_up(serials, max_workers=8):
+    '''Create and connect a set of piezo controllers concurrently.
+
+    Every controller (and its strain reader) is connected on a thread pool,
+    so the startup time of a rig does not grow with the number of stages.
+
+    Args
+    -------
+    serials : list.
+            Pairs (serial_controller, serial_reader) or single controller
+            serial numbers.
+
+    max_workers : int.
+            The maximum number of controllers connected at the same time.
+
+    Returns
+    -------
+    controllers : list.
+            The PiezoController objects, or None where the construction
+            raised an exception, in the order of serials.
+
+    results : list of dict.
+            For every controller, the 'serial', 'ok', 'error' and 'time' of
+            the bring-up and the 'devices', a list with the connect_enable
+            results of the controller and its reader.
+    '''
+    pairs = [p if isinstance(p, (tuple, list)) else (p,) for p in serials]
+
+    def create(pair):
+        start = time.perf_counter()
+        result = {'serial': str(pair[0]), 'ok': False, 'error': None,
+                  'devices': []}
+        controller = None
+        try:
+            controller = PiezoController(*pair)
+            result['devices'] = controller.connect_results()
+            result['ok'] = (controller.device_connencted and
+                            all(r['ok'] for r in result['devices']))
+            if not result['ok']:
+                errors = [r['error'] for r in result['devices'] if r['error']]
+                result['error'] = errors[0] if errors else 'No stages found'
+        except Exception as e:
+            result['error'] = e
+        result['time'] = time.perf_counter() - start
+        return controller, result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        done = list(executor.map(create, pairs))
+    return [d[0] for d in done], [d[1] for d in done]
+
+
+def set_loop_mode(controllers, closed_loop, max_workers=8):
+    '''Switch a set of controllers to closed or open loop concurrently.
+
+    Returns
+    -------
+    reports : list of dict.
+            The apply_settings report of every controller, with its
+            'serial', in the order of controllers.
+    '''
+    def switch(controller):
+        try:
+            if closed_loop:
+                report = controller.set_closed_loop()
+            else:
+                report = controller.set_open_loop()
+        except Exception as e:
+            report = {'ok': False, 'error': e}
+        report['serial'] = controller.serialNo
+        return report
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(switch, controllers))
+
+
 if __name__ == "__main__":
     # Create an object of the PiezoController class. The numbers, are the
     # serial numbers of the controller and the reader respectively.
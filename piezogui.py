@@ -1,21 +1,14 @@
 # -*- coding: utf-8 -*-
-from __future__ import print_function
-from __future__ import division
-
+import abc
 import piezo
-from PIL import ImageTk, Image
-import sys
+import threading
+import time
+import numpy as np
+from acquisition import MultiResolutionHistory
 
-if sys.version_info[0] == 3:
-    # python 3
-    import tkinter as tk
-    from tkinter import ttk
-    from tkinter import messagebox
-else:
-    # python 2
-    import Tkinter as tk
-    import ttk
-    import tkMessageBox as messagebox
+import tkinter as tk
+from tkinter import ttk
+from tkinter import messagebox
 
 
 class StageGUIIndependent():
@@ -48,14 +41,347 @@ class StageGUIIndependent():
             self.motorframe.destroy()
 
 
+###############################################################################
+#       Background polling of the devices
+###############################################################################
+class StagePoller(threading.Thread):
+    '''
+    Thread that reads the state of a stage at a fixed interval.
+
+    The newest state is published in self.snapshot, which the Tk thread
+    reads without ever waiting for the device. A slow USB response delays
+    only this thread, not the GUI.
+
+    Args
+    ------
+    read : callable.
+            Function without arguments that reads the device and returns
+            the state as a dictionary.
+
+    interval : float.
+            The time between reads in seconds, the shortest time if there
+            is a policy.
+
+    policy : acquisition.PollingPolicy (optional).
+            The polling policy of the device. The reads slow down while the
+            stage is quiet and speed up on the next command.
+    '''
+    def __init__(self, read, interval=0.1, policy=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.read = read
+        self.interval = interval
+        self.policy = policy
+        self.snapshot = None
+        self.errors = 0
+        self.last_error = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                # Replacing the reference is atomic, readers never see a
+                # half written state
+                self.snapshot = self.read()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+            if self.policy is None:
+                self._stop_event.wait(self.interval)
+            else:
+                self.policy.polled('gui', self.interval)
+                self.policy.wait(self.policy.interval(self.interval))
+
+    def stop(self):
+        self._stop_event.set()
+        if self.policy is not None:
+            self.policy.wake()
+
+
+class BackgroundJob(threading.Thread):
+    '''
+    Runs a long device operation, e.g. a calibration, on its own thread so
+    that the GUI and the other stages stay live.
+
+    The function is called as function(job). It reports its progress with
+    job.report(fraction, message) and should stop early when
+    job.cancel_event is set. The Tk thread reads job.progress.
+
+    Args
+    ------
+    function : callable.
+            The operation. Its return value is stored in job.result and an
+            exception it raises in job.error.
+    '''
+    def __init__(self, function):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.function = function
+        self.progress = (0.0, '')
+        self.result = None
+        self.error = None
+        self.cancel_event = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.function(self)
+        except Exception as e:
+            self.error = e
+            print(e)
+
+    def report(self, fraction, message):
+        self.progress = (fraction, message)
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def running(self):
+        return self.is_alive()
+
+
+###############################################################################
+#       Change driven rendering
+###############################################################################
+class WidgetRenderer(object):
+    '''
+    Applies widget options only when they differ from the last rendered
+    ones, so an unchanged panel costs no Tk calls.
+
+    Attributes updates and skipped count the widget options that were
+    applied and those that were skipped because nothing changed.
+    '''
+    def __init__(self):
+        # widget -> {option: last rendered value}
+        self._rendered = {}
+        self.updates = 0
+        self.skipped = 0
+
+    def config(self, widget, **options):
+        '''Like widget.config(**options), for the changed options only.'''
+        rendered = self._rendered.setdefault(widget, {})
+        changed = {}
+        for key, value in options.items():
+            if key in rendered and rendered[key] == value:
+                self.skipped += 1
+            else:
+                changed[key] = value
+        if changed:
+            widget.config(**changed)
+            rendered.update(changed)
+            self.updates += len(changed)
+
+    def set_text(self, entry, text):
+        '''Replace the text of an Entry if it changed.'''
+        rendered = self._rendered.setdefault(entry, {})
+        if rendered.get('text') == text:
+            self.skipped += 1
+            return
+        entry.delete(0, 'end')
+        entry.insert('end', text)
+        rendered['text'] = text
+        self.updates += 1
+
+    def invalidate(self, widget):
+        '''Forget what was rendered, e.g. after the user edited the widget.'''
+        self._rendered.pop(widget, None)
+
+    def stats(self):
+        return {'updates': self.updates, 'skipped': self.skipped}
+
+
+###############################################################################
+#       Shared resources of the panels
+###############################################################################
+# Button images, name -> (file in Source_files/GUI_images, rotation)
+IMAGE_FILES = {'home': ('home1.jpg', 0),
+               'back': ('back.png', 0),
+               'up': ('arrow.png', 270),
+               'down': ('arrow.png', 90),
+               'move': ('arrow2.png', 0),
+               'stop': ('stop.png', 0),
+               'closedloop': ('closed_loop.png', 0),
+               'openloop': ('open_loop.png', 0)}
+_gui_images = None
+
+
+def gui_images():
+    '''Return the button images as a dictionary, name -> PhotoImage.
+
+    The images are loaded and resized once per process and shared by all
+    the panels. Images that fail to load are None. PIL is imported here so
+    that importing this module stays cheap when no panel is created.
+    '''
+    global _gui_images
+    if _gui_images is not None:
+        return _gui_images
+    images = dict.fromkeys(IMAGE_FILES)
+    try:
+        from PIL import ImageTk, Image
+        resized = {}
+        for name, (filename, rotation) in IMAGE_FILES.items():
+            if filename not in resized:
+                im_temp = Image.open("./Source_files/GUI_images/" + filename)
+                resized[filename] = im_temp.resize((25, 25), Image.LANCZOS)
+            im_temp = resized[filename]
+            if rotation:
+                im_temp = im_temp.rotate(rotation)
+            images[name] = ImageTk.PhotoImage(im_temp)
+    except Exception as e:
+        print(e)
+        print('Failed to load GUI images')
+    _gui_images = images
+    return images
+
+
+class GUIScheduler(object):
+    '''
+    A single Tk after() loop that renders many panels.
+
+    Args
+    ------
+    master : Tk widget.
+            The widget used for after().
+
+    rate : float.
+            The number of ticks per second.
+    '''
+    def __init__(self, master, rate=10):
+        self.master = master
+        self.rate = rate
+        self.callbacks = []
+        # Duration in seconds of the last tick, to watch the GUI load
+        self.tick_time = 0.0
+        self.errors = 0
+        self.last_error = None
+        self._running = False
+        # Callbacks whose last call raised, to print every failure once
+        self._failing = set()
+
+    def add(self, callback):
+        if callback not in self.callbacks:
+            self.callbacks.append(callback)
+
+    def remove(self, callback):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+        self._failing.discard(callback)
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            self._tick()
+
+    def stop(self):
+        self._running = False
+
+    def _tick(self):
+        if not self._running:
+            return
+        # Schedule the next tick first, so that a failing panel does not
+        # stop the rendering of the others
+        self.master.after(int(1000/self.rate), self._tick)
+        start = time.perf_counter()
+        for callback in list(self.callbacks):
+            try:
+                callback()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+                if callback not in self._failing:
+                    self._failing.add(callback)
+                    print('GUI render failed: ', e)
+            else:
+                self._failing.discard(callback)
+        self.tick_time = time.perf_counter() - start
+
+
+###############################################################################
+#       Position trace
+###############################################################################
+class TracePlot(object):
+    '''
+    Canvas that plots the last span seconds of a MultiResolutionHistory.
+
+    Every pixel column shows the min and max of the samples in its time
+    bin, so short spikes stay visible and a redraw costs one coords() call
+    of at most 2 points per column, whatever the number of samples. The
+    mouse wheel zooms the time span in and out.
+
+    Args
+    ------
+    frame : Tk widget.
+            The parent widget.
+
+    history : MultiResolutionHistory.
+            The plotted history.
+
+    span : float.
+            The plotted time span in seconds.
+    '''
+    spans = (10, 60, 600, 3600, 6*3600, 24*3600)
+
+    def __init__(self, frame, history, width=300, height=60, span=60):
+        self.history = history
+        self.width = width
+        self.height = height
+        self.span = span
+        self.canvas = tk.Canvas(frame, width=width, height=height,
+                                background='white', highlightthickness=0)
+        self.line = self.canvas.create_line(0, 0, 0, 0, fill='blue')
+        self.label = self.canvas.create_text(2, 2, anchor='nw', text='',
+                                             font='Helvetica 7')
+        self.canvas.bind('<MouseWheel>', self.zoom)
+        # X11 reports the wheel as buttons 4 and 5
+        self.canvas.bind('<Button-4>', self.zoom)
+        self.canvas.bind('<Button-5>', self.zoom)
+
+    def zoom(self, event):
+        i = self.spans.index(self.span) if self.span in self.spans else 1
+        if getattr(event, 'num', None) == 4 or getattr(event, 'delta', 0) > 0:
+            i = max(i - 1, 0)
+        else:
+            i = min(i + 1, len(self.spans) - 1)
+        self.span = self.spans[i]
+        self.draw()
+
+    def draw(self, now=None):
+        '''Redraw the trace up to now (a perf_counter time).'''
+        now = time.perf_counter() if now is None else now
+        columns, lows, highs = self.history.decimate(now - self.span, now,
+                                                     self.width)
+        if columns.size == 0:
+            return
+        low = lows.min()
+        high = highs.max()
+        scale = (self.height - 4)/(high - low) if high > low else 0.0
+        # Down then up in every column, as one polyline
+        xs = columns.repeat(2)
+        ys = np.column_stack((lows, highs)).ravel()
+        ys = self.height - 2 - (ys - low)*scale
+        if xs.size == 2:
+            xs = np.append(xs, xs + 1)
+            ys = np.append(ys, ys)
+        self.canvas.coords(self.line, *np.column_stack((xs, ys)).ravel().tolist())
+        self.canvas.itemconfig(self.label, text='{0} s  {1:.3f} .. {2:.3f}'.format(
+            self.span, low, high))
+
+
 ###############################################################################
 #       Basic Class for Stages GUI
 ###############################################################################
-class Stage():
-    '''A general stage GUI class with a monitor and general buttons'''
-    def __init__(self, master, frame):
+class Stage(abc.ABC):
+    '''A general stage GUI class with a monitor and general buttons.
+
+    The stages implement read_state and monitor. The class is abstract, so
+    a stage without them cannot be created.
+
+    If a GUIScheduler is given the panel is rendered by its shared tick,
+    otherwise the panel runs its own after() loop.
+    '''
+    def __init__(self, master, frame, scheduler=None):
         self.master = master
         self.frame = frame
+        self.scheduler = scheduler
         # Class variables
         self.btnwidth = 5
         # Since I am using self variables for the images, I probably don't
@@ -72,6 +398,14 @@ class Stage():
         self.previous_pos = 0
         self.units = None
         self.stage = None
+        self.poller = None
+        # Only changed widget options are rendered, at most render_rate
+        # times per second
+        self.renderer = WidgetRenderer()
+        self.render_rate = 10
+        self.rendered_state = None
+        # The value history for the trace plot, filled by the poller
+        self.history = MultiResolutionHistory()
         self.load_images()
         self.motor_panel(self.frame)
 
@@ -84,50 +418,86 @@ class Stage():
         self.btn_down.config(command=movedown)
         self.labelunits.config(text=units)
 
+# =============================================================================
+#       Monitor
+# =============================================================================
+    @abc.abstractmethod
+    def read_state(self):
+        '''Read the device state. Runs on the poller thread.
+
+        The state may hold the new 'samples' as a (times, values) tuple,
+        otherwise its 'value' is recorded in the history.
+        '''
+
+    def poll(self):
+        '''Read the state and record it in the history.'''
+        state = self.read_state()
+        if 'samples' in state:
+            self.history.extend(*state['samples'])
+        elif state['value'] is not None:
+            self.history.append(time.perf_counter(), state['value'])
+        return state
+
+    @abc.abstractmethod
+    def monitor(self, state):
+        '''Show a state returned by read_state. Runs on the Tk thread.'''
+
+    def polling_policy(self):
+        '''Return the PollingPolicy of the polled device, or None.'''
+        return None
+
+    def start_polling(self, interval=0.1):
+        '''Start reading the device on a poller thread.'''
+        self.poller = StagePoller(self.poll, interval, self.polling_policy())
+        self.poller.start()
+        self.stagefrm.bind('<Destroy>', self.stop_polling, add='+')
+
+    def stop_polling(self, event=None):
+        if self.poller is not None:
+            self.poller.stop()
+        if self.scheduler is not None:
+            self.scheduler.remove(self.render)
+
+    def render(self):
+        '''Render the newest state of the poller. A state that has already
+        been rendered is skipped.'''
+        state = self.poller.snapshot
+        if state is not None and state is not self.rendered_state:
+            self.monitor(state)
+            self.trace.draw()
+            self.rendered_state = state
+
+    def stagemonitor(self):
+        '''Render the panel render_rate times per second, or on every tick
+        of the scheduler.'''
+        if self.scheduler is not None:
+            self.scheduler.add(self.render)
+            return
+        self.render()
+        self.master.after(int(1000/self.render_rate), self.stagemonitor)
+
+    def edit_disp(self):
+        '''Clear the display for the user to type a value.'''
+        self.set_disp_value_flag = True
+        self.disp.delete(0, 'end')
+        self.renderer.invalidate(self.disp)
+
 # =============================================================================
 #       GUI widgets
 # =============================================================================
     def load_images(self):
         '''Load the images for the GUI buttons'''
-        # Try to load all the images. If it fails, the GUI will show text
-        # on the buttons.
-        try:
-            im_temp = Image.open("./Source_files/GUI_images/home1.jpg")
-            im_temp = im_temp.resize((25, 25), Image.ANTIALIAS)
-            self.imghome = ImageTk.PhotoImage(im_temp)
-
-            im_temp = Image.open("./Source_files/GUI_images/back.png")
-            im_temp = im_temp.resize((25, 25), Image.ANTIALIAS)
-            self.imgback = ImageTk.PhotoImage(im_temp)
-
-            im_temp = Image.open("./Source_files/GUI_images/arrow.png")
-            im_temp = im_temp.resize((25, 25), Image.ANTIALIAS)
-            im_temp = im_temp.rotate(270)
-            self.imgup = ImageTk.PhotoImage(im_temp)
-
-            im_temp = Image.open("./Source_files/GUI_images/arrow.png")
-            im_temp = im_temp.resize((25, 25), Image.ANTIALIAS)
-            im_temp = im_temp.rotate(90)
-            self.imgdown = ImageTk.PhotoImage(im_temp)
-
-            im_temp = Image.open("./Source_files/GUI_images/arrow2.png")
-            im_temp = im_temp.resize((25, 25), Image.ANTIALIAS)
-            self.imgmove = ImageTk.PhotoImage(im_temp)
-
-            im_temp = Image.open("./Source_files/GUI_images/stop.png")
-            im_temp = im_temp.resize((25, 25), Image.ANTIALIAS)
-            self.imgstop = ImageTk.PhotoImage(im_temp)
-
-            im_temp = Image.open("./Source_files/GUI_images/closed_loop.png")
-            im_temp = im_temp.resize((25, 25), Image.ANTIALIAS)
-            self.imgclosedloop = ImageTk.PhotoImage(im_temp)
-
-            im_temp = Image.open("./Source_files/GUI_images/open_loop.png")
-            im_temp = im_temp.resize((25, 25), Image.ANTIALIAS)
-            self.imgopenloop = ImageTk.PhotoImage(im_temp)
-        except Exception as e:
-            print(e)
-            print('Failed to load GUI images')
+        # The images are shared by all the panels. If they failed to load,
+        # they are None and the GUI will show text on the buttons.
+        images = gui_images()
+        self.imghome = images['home']
+        self.imgback = images['back']
+        self.imgup = images['up']
+        self.imgdown = images['down']
+        self.imgmove = images['move']
+        self.imgstop = images['stop']
+        self.imgclosedloop = images['closedloop']
+        self.imgopenloop = images['openloop']
 
     def motor_panel(self, frame):
         '''Positioning of the widgets in the main motor frame'''
@@ -178,27 +548,49 @@ class Stage():
                                     font="Helvetica 10 bold")
         self.labelstate.grid(row=2, column=2, padx=5, pady=5, columnspan=2)
 
+        self.trace = TracePlot(self.stagefrm, self.history)
+        self.trace.canvas.grid(row=3, column=1, padx=5, pady=5, columnspan=3)
+
 
 ###############################################################################
 #       Class for Strain Gauge Reader GUI
 ###############################################################################
 class StageStrainReader(Stage):
     '''Strain reader GUI for the Thorlabs piezoelectric stage.'''
-    def __init__(self, master, frame):
-        Stage.__init__(self, master, frame)
+    def __init__(self, master, frame, scheduler=None):
+        Stage.__init__(self, master, frame, scheduler)
         self.set_disp_value_flag = False
+        # Time of the newest sample already recorded in the history
+        self.last_sample_time = 0.0
+        # The StagePiezo panel of the controller, whose job blocks the moves
+        self.owner = None
 
     def connect_stage(self, piezo, reader):
         '''Connect the strain reader object to the GUI'''
         self.stage = piezo
         self.reader = reader
+        # Read the strain gauge from the shared background buffer instead
+        # of polling the device from the Tk thread
+        self.reader.start_sampling()
+        self.start_polling()
         self.stagemonitor()
+        # Moves go through the latest-wins queue of the controller, so
+        # rapid clicks merge into one move
+        commands = piezo.commands
         self.connect_btns(reader.serialNo, self.homebtn,
-                          piezo.move_pos_to_home, piezo.move_pos_up,
-                          piezo.move_pos_down, reader.get_units())
+                          lambda: commands.move('pos', 0),
+                          lambda: commands.jog('pos', 1),
+                          lambda: commands.jog('pos', -1), reader.get_units())
         self.btn_move.config(image=self.imgmove)
         self.btn_move.config(command=self.btn_move_act)
         self.btn_set_home.config(text='Zero')
+        # Noise and drift readout, a right click on the trace starts and
+        # stops the analytics of the reader
+        self.units = reader.get_units()
+        self.labelnoise = ttk.Label(self.stagefrm, text='',
+                                    font="Helvetica 9")
+        self.labelnoise.grid(row=4, column=1, padx=5, columnspan=3)
+        self.trace.canvas.bind('<Button-3>', self.toggle_analytics)
 
     def homebtn(self):
         '''Perform the zeroing function of the strain reader'''
@@ -209,34 +601,64 @@ class StageStrainReader(Stage):
 
     def btn_move_act(self):
         if self.set_disp_value_flag:
-            self.stage.move_to_pos(float(self.disp.get()))
+            self.stage.commands.move('pos', float(self.disp.get()))
             self.set_disp_value_flag = False
         else:
-            self.set_disp_value_flag = True
-            self.disp.delete(0, 'end')
+            self.edit_disp()
 
-    def monitor(self, currentVal):
-        if not self.set_disp_value_flag:
-            self.disp.delete(0, 'end')
-            self.disp.insert('', round(currentVal, 3))
-
-        if self.stage.is_closed_loop():
-            self.btn_back.config(state="normal")
-            self.btn_up.config(state="normal")
-            self.btn_down.config(state="normal")
+    def toggle_analytics(self, event=None):
+        if self.reader.analytics is None:
+            self.reader.start_analytics()
         else:
-            self.btn_back.config(state="disabled")
-            self.btn_up.config(state="disabled")
-            self.btn_down.config(state="disabled")
-
-        if self.reader.is_zeroing():
-            self.labelstate.config(text='Zeroing', foreground="red")
+            self.reader.stop_analytics()
+
+    def read_state(self):
+        # All the samples of the buffer since the last poll, for the trace
+        times, values = self.reader.since(self.last_sample_time)
+        if times.size:
+            self.last_sample_time = times[-1]
+        analytics = self.reader.analytics
+        return {'value': values[-1] if values.size else None,
+                'samples': (times, values),
+                'closed_loop': self.stage.is_closed_loop(),
+                'zeroing': self.reader.is_zeroing(),
+                'busy': self.owner is not None and self.owner.busy(),
+                'analytics': analytics.summary() if analytics is not None else None}
+
+    def polling_policy(self):
+        return self.reader.polling
+
+    def monitor(self, state):
+        render = self.renderer
+        if not self.set_disp_value_flag and state['value'] is not None:
+            render.set_text(self.disp, round(state['value'], 3))
+
+        if state['closed_loop'] and not state['busy']:
+            render.config(self.btn_back, state="normal")
+            render.config(self.btn_up, state="normal")
+            render.config(self.btn_down, state="normal")
         else:
-            self.labelstate.config(text='', foreground="black")
+            render.config(self.btn_back, state="disabled")
+            render.config(self.btn_up, state="disabled")
+            render.config(self.btn_down, state="disabled")
+        # No moves or zeroing while the job of the controller panel runs
+        controls = "disabled" if state['busy'] else "normal"
+        render.config(self.btn_move, state=controls)
+        render.config(self.btn_set_home, state=controls)
+
+        if state['zeroing']:
+            render.config(self.labelstate, text='Zeroing', foreground="red")
+        else:
+            render.config(self.labelstate, text='', foreground="black")
 
-    def stagemonitor(self):
-        self.monitor(self.reader.get_pos())
-        self.master.after(100, self.stagemonitor)
+        analytics = state['analytics']
+        if analytics is None or analytics['window_rms'] is None:
+            render.config(self.labelnoise, text='')
+        else:
+            render.config(self.labelnoise,
+                          text='Noise {0:.4f} {2} rms, drift {1:+.4f} {2}/s'.format(
+                              analytics['window_rms'],
+                              analytics['drift_rate'] or 0.0, self.units))
 
 
 ###############################################################################
@@ -244,9 +666,11 @@ class StageStrainReader(Stage):
 ###############################################################################
 class StagePiezo(Stage):
     '''Piezo stage GUI for the Thorlabs piezoelectric stages'''
-    def __init__(self, master, frame):
-        Stage.__init__(self, master, frame)
+    def __init__(self, master, frame, scheduler=None):
+        Stage.__init__(self, master, frame, scheduler)
         self.set_disp_value_flag = False
+        # The mode switch and calibration job
+        self.job = None
         self.btn_set_home.imagecl = self.imgclosedloop
         self.btn_set_home.imageol = self.imgopenloop
         self.btn_set_home.config(image=self.imgclosedloop)
@@ -255,50 +679,168 @@ class StagePiezo(Stage):
     def connect_stage(self, stage):
         '''Connect the stage object to the GUI'''
         self.stage = stage
+        self.start_polling()
         self.stagemonitor()
-        self.connect_btns(stage.serialNo, self.closed_loop, stage.move_to_home,
-                          stage.moveup, stage.movedown, stage.get_units())
+        commands = stage.commands
+        self.connect_btns(stage.serialNo, self.closed_loop,
+                          lambda: commands.move('value', 0),
+                          lambda: commands.jog('value', 1),
+                          lambda: commands.jog('value', -1), stage.get_units())
         self.btn_move.config(image=self.imgmove)
         self.btn_move.config(command=self.btn_move_act)
-        if self.stage.serial_reader is not 'Empty':
-            self.readerGUI = StageStrainReader(self.master, self.frame)
+        if self.stage.serial_reader != 'Empty':
+            self.readerGUI = StageStrainReader(self.master, self.frame,
+                                               self.scheduler)
+            self.readerGUI.owner = self
             self.readerGUI.connect_stage(self.stage, self.stage.reader)
             self.btn_set_home.config(state="normal")
 
     def btn_move_act(self):
         if self.set_disp_value_flag:
-            self.stage.set_value(float(self.disp.get()))
+            self.stage.commands.move('value', float(self.disp.get()))
             self.set_disp_value_flag = False
         else:
-            self.set_disp_value_flag = True
-            self.disp.delete(0, 'end')
+            self.edit_disp()
 
     def closed_loop(self):
+        '''Switch the loop mode on a background job. Pressing the button
+        again while the job runs cancels it.'''
+        if self.job is not None and self.job.running():
+            self.job.cancel()
+            return
+        self.job = BackgroundJob(self.switch_mode)
+        self.job.start()
+
+    def busy(self):
+        '''True while the mode switch and calibration job runs.'''
+        return self.job is not None and self.job.running()
+
+    def switch_mode(self, job):
+        '''Runs on the job thread.'''
         if self.stage.is_closed_loop():
+            job.report(0.0, 'Opening loop')
             self.stage.set_open_loop()
-        else:
-            self.labelstate.config(text='Calibrating')
-            self.stage.set_closed_loop()
-            self.stage.calibrate_pos()
-            self.labelstate.config(text='')
+            return None
+        job.report(0.0, 'Closing loop')
+        self.stage.set_closed_loop()
+        report = self.stage.calibrate_pos(use_cache=True, progress=job.report,
+                                          cancel=job.cancel_event)
+        if report is None and self.stage.calibration is None:
+            # Cancelled before any calibration exists. Positions in um
+            # cannot be used, so go back to open loop.
+            self.stage.set_open_loop()
+        return report
 
-    def monitor(self, currentVal):
-        self.labelunits.config(text=self.stage.get_units())
+    def polling_policy(self):
+        return self.stage.polling
 
-        if not self.set_disp_value_flag:
-            self.disp.delete(0, 'end')
-            self.disp.insert('', round(currentVal, 2))
+    def read_state(self):
+        return {'value': self.stage.get_value(),
+                'units': self.stage.get_units(),
+                'closed_loop': self.stage.is_closed_loop(),
+                'busy': self.busy()}
 
-        if self.stage.is_closed_loop():
-            self.labelstate.config(text='Closed Loop')
-            self.btn_set_home.config(image=self.imgopenloop, text='CL')
+    def monitor(self, state):
+        render = self.renderer
+        render.config(self.labelunits, text=state['units'])
+
+        if not self.set_disp_value_flag:
+            render.set_text(self.disp, round(state['value'], 2))
+
+        # A move between the calibration points would corrupt the fit
+        controls = "disabled" if state['busy'] else "normal"
+        for button in (self.btn_back, self.btn_up, self.btn_down, self.btn_move):
+            render.config(button, state=controls)
+
+        if state['busy']:
+            fraction, message = self.job.progress
+            render.config(self.labelstate,
+                          text='{0} {1:.0f}%'.format(message, 100*fraction))
+        elif state['closed_loop']:
+            render.config(self.labelstate, text='Closed Loop')
+            render.config(self.btn_set_home, image=self.imgopenloop, text='CL')
         else:
-            self.labelstate.config(text='Open Loop')
-            self.btn_set_home.config(image=self.imgclosedloop, text='OL')
+            render.config(self.labelstate, text='Open Loop')
+            render.config(self.btn_set_home, image=self.imgclosedloop, text='OL')
 
-    def stagemonitor(self):
-        self.monitor(self.stage.get_value())
-        self.master.after(100, self.stagemonitor)
+
+###############################################################################
+#       Dashboard of many stages
+###############################################################################
+class StageDashboard(object):
+    '''
+    A grid of StagePiezo panels (with their strain reader panels) for many
+    stages, rendered by one shared scheduler tick.
+
+    The panels are created immediately and the devices are connected
+    concurrently in the background with piezo.bring_up.
+
+    Args
+    ------
+    master : Tk widget.
+            The root of the GUI.
+
+    frame : Tk widget.
+            The frame that holds the dashboard. It can be part of a bigger GUI.
+
+    serials : list.
+            Pairs (serial_controller, serial_reader) or single controller
+            serial numbers.
+
+    columns : int.
+            The number of panels in a row.
+
+    rate : float.
+            The render rate of the panels in Hz.
+
+    Example
+    -------
+    root = tk.Tk()
+    StageDashboard(root, root, [(81858318, 84858066), (81858319, 84858067)])
+    root.mainloop()
+    '''
+    def __init__(self, master, frame, serials, columns=4, rate=10):
+        self.master = master
+        self.serials = list(serials)
+        self.scheduler = GUIScheduler(master, rate)
+        self.panels = []
+        self.controllers = []
+        self.results = []
+
+        self.labelstatus = ttk.Label(frame, text='Connecting {0} stages'.format(
+            len(self.serials)), font="Helvetica 10 bold")
+        self.labelstatus.pack(side='top', anchor='w', padx=10)
+        self.gridfrm = ttk.Frame(frame)
+        self.gridfrm.pack(side='top', padx=10, pady=10, anchor='n')
+        for i in range(len(self.serials)):
+            cell = ttk.Frame(self.gridfrm)
+            cell.grid(row=i//columns, column=i % columns, padx=5, pady=5, sticky='n')
+            self.panels.append(StagePiezo(master, cell, self.scheduler))
+
+        self.job = BackgroundJob(lambda job: piezo.bring_up(self.serials))
+        self.job.start()
+        self.wait_connected()
+        self.scheduler.start()
+
+    def wait_connected(self):
+        '''Connect the panels once the bring-up job is done.'''
+        if self.job.running():
+            self.master.after(100, self.wait_connected)
+            return
+        if self.job.error is not None:
+            self.labelstatus.config(text='Connection failed', foreground="red")
+            return
+        self.controllers, self.results = self.job.result
+        connected = 0
+        for panel, controller, result in zip(self.panels, self.controllers,
+                                             self.results):
+            if controller is not None and result['ok']:
+                panel.connect_stage(controller)
+                connected += 1
+            else:
+                print('Stage ' + result['serial'] + ' failed: ', result['error'])
+        self.labelstatus.config(text='{0} of {1} stages connected'.format(
+            connected, len(self.panels)))
 
 
 if __name__ == "__main__":
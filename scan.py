@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+# Per step record of a scan
+STEP_DTYPE = np.dtype([('index', np.int64),
+                       ('commanded', np.float64),   # um
+                       ('measured', np.float64),    # um, after the settle
+                       ('settle_time', np.float64),  # s, nan on timeout
+                       ('start', np.float64),        # perf_counter time
+                       ('move_time', np.float64),    # s, move and settle
+                       ('acquire_time', np.float64),  # s
+                       ('process_time', np.float64)])  # s, in the worker
+
+
+###############################################################################
+#       Step and acquire scan
+###############################################################################
+class ScanRunner(object):
+    '''
+    Step-and-acquire scan on a calibrated PiezoController in closed loop.
+
+    For every position the stage moves, waits until the strain reader shows
+    that it has settled and the acquire callback is called. The optional
+    process callback runs on worker threads, so the post-processing of one
+    step overlaps with the move and acquisition of the next ones.
+
+    Args
+    ------
+    controller : PiezoController.
+            The controller of the stage, calibrated and in closed loop, with
+            a strain reader.
+
+    acquire : callable.
+            Called as acquire(index, position) once the stage has settled,
+            e.g. to trigger a camera. Its return value is passed to process.
+
+    process : callable (optional).
+            Called as process(index, data) on a worker thread. The return
+            values are collected in the 'results' of the scan.
+
+    workers : int.
+            The number of processing threads.
+
+    max_pending : int (optional).
+            The maximum number of steps waiting for processing. When it is
+            reached the scan waits for the oldest one, so that a slow
+            process callback does not accumulate unbounded data. Defaults to
+            twice the number of workers.
+
+    Example
+    -------
+    runner = ScanRunner(mypiezo, camera.snap, process=analyse)
+    result = runner.run(np.linspace(2, 18, 161))
+    print(result['steps_per_second'])
+    '''
+    def __init__(self, controller, acquire, process=None, workers=1,
+                 max_pending=None):
+        self.controller = controller
+        self.acquire = acquire
+        self.process = process
+        self.workers = workers
+        self.max_pending = max_pending if max_pending is not None else 2*workers
+
+    def run(self, positions, tolerance=None, window=None, timeout=None):
+        '''Scan through the positions (um).
+
+        The settle arguments default to those of the controller, see
+        PiezoController.wait_settled.
+
+        Returns
+        -------
+        result : dict.
+                'steps', a structured numpy array with dtype STEP_DTYPE,
+                'results', the return values of process (or of acquire if
+                there is no process callback), 'duration' in seconds and
+                'steps_per_second'.
+        '''
+        from piezo import Decimal
+        controller = self.controller
+        reader = controller.reader
+        if reader is None:
+            raise RuntimeError('Scans require a strain reader for the settle '
+                               'detection')
+        if not controller.is_closed_loop():
+            raise RuntimeError('Scans require closed loop')
+        if controller.calibration is None:
+            raise RuntimeError('Scans require a position calibration, see '
+                               'PiezoController.calibrate_pos')
+        positions = np.atleast_1d(np.asarray(positions, dtype=float))
+        # Convert the whole scan to device values up front
+        percentages = np.clip(controller.pos_to_percentage(positions), 0.0, 100.0)
+        setpoints = [Decimal(float(y)) for y in percentages]
+
+        n = positions.size
+        steps = np.zeros(n, dtype=STEP_DTYPE)
+        steps['index'] = np.arange(n)
+        steps['commanded'] = positions
+        steps['process_time'] = np.nan
+        results = [None]*n
+        pending = deque()
+
+        def timed_process(k, data):
+            t = time.perf_counter()
+            out = self.process(k, data)
+            steps['process_time'][k] = time.perf_counter() - t
+            return out
+
+        start = time.perf_counter()
+        executor = ThreadPoolExecutor(max_workers=self.workers) if self.process else None
+        try:
+            for k in range(n):
+                t0 = time.perf_counter()
+                steps['start'][k] = t0
+                controller.kick_polling()
+                controller.device.SetPercentageTravel(setpoints[k])
+                settle_time = controller.wait_settled(tolerance, window, timeout)
+                steps['settle_time'][k] = np.nan if settle_time is None else settle_time
+                sample = reader.latest() if reader.is_sampling() else None
+                steps['measured'][k] = sample[1] if sample is not None else reader.get_pos()
+                t1 = time.perf_counter()
+                steps['move_time'][k] = t1 - t0
+
+                data = self.acquire(k, positions[k])
+                steps['acquire_time'][k] = time.perf_counter() - t1
+
+                if executor is None:
+                    results[k] = data
+                    continue
+                # Hand the data over and go on with the next move
+                pending.append((k, executor.submit(timed_process, k, data)))
+                while len(pending) > self.max_pending:
+                    i, future = pending.popleft()
+                    results[i] = future.result()
+            for i, future in pending:
+                results[i] = future.result()
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+        duration = time.perf_counter() - start
+        return {'steps': steps,
+                'results': results,
+                'duration': duration,
+                'steps_per_second': n/duration if duration > 0 else None}
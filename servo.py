@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import deque
+
+
+###############################################################################
+#       Software position servo
+###############################################################################
+class PositionServo(object):
+    '''
+    Software PID position servo that drives a PiezoController to a target
+    in um from the StrainReader feedback, and holds it there.
+
+    The output is a feedforward guess of the setpoint plus a PID correction
+    of the measured error. In closed loop the output is the percentage
+    travel and the feedforward comes from the calibration, so the servo
+    removes the remaining calibration error. In open loop the output is the
+    voltage and the feedforward is linear in the position unless a
+    feedforward function is given. The integral term stops integrating
+    while the output is saturated (anti-windup) and the derivative term
+    acts on the measurement, so target changes do not kick the output.
+
+    The gains are normalized: a gain of 1 changes the output by the amount
+    that moves the stage by 1 um per um of error (kp), per um*s of error
+    (ki) or per um/s of motion (kd).
+
+    Args
+    ------
+    controller : PiezoController.
+            The controller of the stage, with a strain reader.
+
+    kp, ki, kd : float.
+            The proportional, integral and derivative gains.
+
+    rate : float.
+            The servo rate in Hz, at most the fast polling rate of the
+            reader (1/reader.polling.fast, 100 Hz by default), as the
+            strain gauge readings are refreshed once per device poll. A
+            faster rate is reduced by start(). Every cycle makes one
+            reader and one controller interop call.
+
+    tolerance : float.
+            The maximum error in um for the stage to be on target.
+
+    hold : float.
+            The time in seconds that the error has to stay within the
+            tolerance for the stage to be on target.
+
+    travel : float.
+            The travel of the stage in um, for the linear open loop
+            feedforward and the output scale without a calibration.
+
+    feedforward : callable (optional).
+            Called as feedforward(position) to get the open loop voltage of
+            a position in um.
+
+    Example
+    -------
+    servo = mypiezo.start_servo(kp=2.0, ki=50.0)
+    convergence_time = mypiezo.move_to_pos(10.0, wait=True)
+    print(servo.report())
+    '''
+    def __init__(self, controller, kp=2.0, ki=50.0, kd=0.0, rate=100,
+                 tolerance=0.01, hold=0.02, travel=20.0, feedforward=None):
+        self.controller = controller
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.rate = float(rate)
+        self.tolerance = tolerance
+        self.hold = hold
+        self.travel = travel
+        self.feedforward = feedforward
+        # Set by start() from the loop mode of the controller
+        self.closed_loop = None
+        self.limits = None
+        self.scale = None
+        self.target = None
+        self.position = None
+        self.output = None
+        self.integral = 0.0
+        self.cycles = 0
+        self.overruns = 0
+        self.saturated = 0
+        self.errors = 0
+        self.last_error = None
+        # Convergence times in seconds of the moves (None if not reached
+        # before the next move), newest last
+        self.convergence_times = deque(maxlen=100)
+        self.thread = None
+        self._lock = threading.Lock()
+        self._move_start = None
+        self._band_start = None
+        # False while holding the start position, which is not a timed move
+        self._timed = False
+        self._on_target = threading.Event()
+        self._stop_event = threading.Event()
+
+    # ### Control ############################################################
+    def start(self, target=None):
+        '''Start the servo thread, holding target (um) or the current
+        position.'''
+        if self.running():
+            return
+        controller = self.controller
+        self.closed_loop = controller.is_closed_loop()
+        if self.closed_loop:
+            self.limits = (0.0, 100.0)
+        else:
+            self.limits = (0.0, controller.status.get('max_voltage'))
+        self.output = controller.get_value()
+        self.scale = self._scale()
+        # Faster cycles would reuse the reading of the previous one,
+        # integrating its error twice with a derivative of 0
+        self.rate = min(self.rate, 1.0/controller.reader.polling.fast)
+        self.integral = 0.0
+        self._stop_event.clear()
+        self.move_to(controller.reader.get_pos() if target is None else target)
+        self._timed = target is not None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def move_to(self, target):
+        '''Set a new target in um. Returns immediately.'''
+        with self._lock:
+            if self._timed and not self._on_target.is_set():
+                self.convergence_times.append(None)
+            self._timed = True
+            self.target = float(target)
+            self._move_start = time.perf_counter()
+            self._band_start = None
+            self._on_target.clear()
+
+    def wait_on_target(self, timeout=5.0):
+        '''Wait until the stage is on target.
+
+        Returns
+        -------
+        convergence_time : float or None.
+                The time in seconds from the move until the error entered
+                the tolerance band it stayed in, or None on timeout.
+        '''
+        if not self._on_target.wait(timeout):
+            return None
+        return self.convergence_times[-1] if self.convergence_times else 0.0
+
+    def on_target(self):
+        return self._on_target.is_set()
+
+    def report(self):
+        '''Return the state and statistics of the servo as a dictionary.'''
+        times = [t for t in self.convergence_times if t is not None]
+        return {'target': self.target,
+                'position': self.position,
+                'error': (self.target - self.position
+                          if self.position is not None else None),
+                'on_target': self.on_target(),
+                'output': self.output,
+                'integral': self.integral,
+                'rate': self.rate,
+                'cycles': self.cycles,
+                'overruns': self.overruns,
+                'saturated_cycles': self.saturated,
+                'errors': self.errors,
+                'convergence_time': self.convergence_times[-1] if self.convergence_times else None,
+                'mean_convergence_time': sum(times)/len(times) if times else None,
+                'missed_targets': len(self.convergence_times) - len(times)}
+
+    # ### Loop ###############################################################
+    def _scale(self):
+        # Output units per um
+        controller = self.controller
+        if self.closed_loop:
+            if controller.calibration is not None:
+                return controller.a
+            return 100.0/self.travel
+        return self.limits[1]/self.travel
+
+    def _feedforward(self, target):
+        controller = self.controller
+        if self.closed_loop:
+            if controller.calibration is not None:
+                return float(controller.pos_to_percentage(target))
+            return target*self.scale
+        if self.feedforward is not None:
+            return float(self.feedforward(target))
+        return target*self.scale
+
+    def _run(self):
+        from piezo import Decimal
+        controller = self.controller
+        reader = controller.reader
+        if self.closed_loop:
+            setter = controller.device.SetPercentageTravel
+        else:
+            setter = controller.device.SetOutputVoltage
+        low, high = self.limits
+        period = 1.0/self.rate
+        perf_counter = time.perf_counter
+        previous = reader.get_pos()
+        last_time = perf_counter()
+        next_time = last_time + period
+        while not self._stop_event.is_set():
+            try:
+                # Fresh feedback needs the strain gauge polled at full rate
+                reader.polling.keep_fast(period + 0.1)
+                position = reader.get_pos()
+                now = perf_counter()
+                dt = now - last_time
+                last_time = now
+                with self._lock:
+                    target = self.target
+                error = target - position
+                derivative = (position - previous)/dt if dt > 0 else 0.0
+                previous = position
+                ideal = (self._feedforward(target) + self.scale*(
+                    self.kp*error + self.ki*self.integral - self.kd*derivative))
+                output = min(max(ideal, low), high)
+                if output == ideal or (error > 0) == (output > ideal):
+                    # Integrate only when it does not push the output
+                    # further into saturation
+                    self.integral += error*dt
+                else:
+                    self.saturated += 1
+                setter(Decimal(output))
+                self.output = output
+                self.position = position
+                self.cycles += 1
+                self._check_target(target, error, now)
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+            # Keep the cycles on an absolute time grid
+            delay = next_time - perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+                next_time += period
+            else:
+                self.overruns += 1
+                next_time = perf_counter() + period
+
+    def _check_target(self, target, error, now):
+        with self._lock:
+            if target != self.target:
+                # Moved during the cycle
+                return
+            if abs(error) > self.tolerance:
+                self._band_start = None
+                return
+            if self._band_start is None:
+                self._band_start = now
+            if (not self._on_target.is_set() and
+                    now - self._band_start >= self.hold):
+                if self._timed:
+                    self.convergence_times.append(
+                        max(self._band_start - self._move_start, 0.0))
+                self._on_target.set()
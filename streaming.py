@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+import sys
+import threading
+import time
+import numpy as np
+
+
+###############################################################################
+#       Waveforms
+###############################################################################
+def ramp(start, stop, n):
+    '''n equally spaced points from start to stop.'''
+    return np.linspace(start, stop, int(n))
+
+
+def triangle(low, high, n_per_period, periods=1):
+    '''A triangle wave from low to high and back, repeated periods times.'''
+    half = int(n_per_period) // 2
+    up = np.linspace(low, high, half, endpoint=False)
+    down = np.linspace(high, low, int(n_per_period) - half, endpoint=False)
+    return np.tile(np.concatenate((up, down)), int(periods))
+
+
+def sine(center, amplitude, frequency, rate, duration):
+    '''A sine wave sampled at rate (Hz) for duration seconds.'''
+    t = np.arange(int(round(rate*duration))) / rate
+    return center + amplitude*np.sin(2*np.pi*frequency*t)
+
+
+###############################################################################
+#       Streaming engine
+###############################################################################
+class TrajectoryStreamer(object):
+    '''
+    Sends a precomputed trajectory of setpoints to a PiezoController at a
+    fixed rate from a dedicated thread.
+
+    The setpoints are converted to device values before the thread starts,
+    so the loop only makes one interop call per point. The send instants
+    are scheduled on an absolute time grid (no accumulated drift): the
+    thread sleeps until shortly before each deadline and spins for the rest.
+
+    Args
+    ------
+    controller : PiezoController.
+            The controller of the stage.
+
+    trajectory : array like.
+            The setpoints.
+
+    rate : float.
+            The target rate in setpoints per second.
+
+    units : str.
+            'um' for positions converted with the calibration of the
+            controller, 'percent' for percentage travel (both closed loop)
+            or 'V' for the output voltage (open loop).
+
+    skip_late : bool.
+            If True, setpoints whose deadline passed more than one period
+            ago are skipped, keeping the trajectory aligned with time.
+            Otherwise every setpoint is sent, late or not.
+
+    Example
+    -------
+    streamer = TrajectoryStreamer(mypiezo, streaming.triangle(2, 18, 200, 5), 200)
+    report = streamer.run()
+    '''
+    spin_time = 0.002
+
+    def __init__(self, controller, trajectory, rate, units='um', skip_late=True):
+        if units not in ('um', 'percent', 'V'):
+            raise ValueError('Unknown units: ' + str(units))
+        self.controller = controller
+        self.trajectory = np.asarray(trajectory, dtype=float)
+        self.rate = float(rate)
+        self.units = units
+        self.skip_late = skip_late
+        self.thread = None
+        self.report = None
+        self._stop_event = threading.Event()
+
+    def _prepare(self):
+        # Returns the setter and the list of the device values
+        from piezo import Decimal
+        if self.units == 'V':
+            if self.controller.is_closed_loop():
+                raise RuntimeError('Voltage trajectories require open loop')
+            values = self.trajectory
+            setter = self.controller.device.SetOutputVoltage
+        else:
+            if not self.controller.is_closed_loop():
+                raise RuntimeError('Position trajectories require closed loop')
+            if self.units == 'um':
+                values = self.controller.pos_to_percentage(self.trajectory)
+            else:
+                values = self.trajectory
+            values = np.clip(values, 0.0, 100.0)
+            setter = self.controller.device.SetPercentageTravel
+        return setter, [Decimal(float(v)) for v in np.atleast_1d(values)]
+
+    def start(self):
+        '''Start streaming in the background. Use wait to get the report.'''
+        setter, values = self._prepare()
+        self._stop_event.clear()
+        self.thread = threading.Thread(target=self._run, args=(setter, values))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''Stop streaming before the end of the trajectory.'''
+        self._stop_event.set()
+
+    def wait(self, timeout=None):
+        '''Wait for the end of the trajectory and return the report.'''
+        if self.thread is not None:
+            self.thread.join(timeout)
+        return self.report
+
+    def run(self):
+        '''Stream the whole trajectory and return the report.'''
+        self.start()
+        return self.wait()
+
+    def _run(self, setter, values):
+        raised = _raise_thread_priority()
+        try:
+            self._stream(setter, values)
+        finally:
+            if raised:
+                _restore_timer_resolution()
+
+    def _stream(self, setter, values):
+        n = len(values)
+        period = 1.0 / self.rate
+        reader = self.controller.reader
+        use_feedback = reader is not None and reader.is_sampling()
+        deadlines = np.empty(n)
+        send_times = np.full(n, np.nan)
+        feedback = np.full(n, np.nan)
+        stop_event = self._stop_event
+        spin_time = self.spin_time
+        perf_counter = time.perf_counter
+        start = perf_counter() + period
+        missed = 0
+        sent = 0
+        count = 0
+        for k in range(n):
+            if stop_event.is_set():
+                break
+            deadline = start + k*period
+            deadlines[k] = deadline
+            count += 1
+            delay = deadline - perf_counter()
+            if delay > spin_time:
+                time.sleep(delay - spin_time)
+            while perf_counter() < deadline:
+                pass
+            now = perf_counter()
+            if now - deadline > period:
+                missed += 1
+                if self.skip_late:
+                    continue
+            send_times[k] = now
+            setter(values[k])
+            sent += 1
+            if use_feedback:
+                sample = reader.latest()
+                if sample is not None:
+                    feedback[k] = sample[1]
+        self.report = self._make_report(deadlines[:count], send_times[:count],
+                                        feedback[:count], sent, missed,
+                                        use_feedback, start)
+
+    def _make_report(self, deadlines, send_times, feedback, sent, missed,
+                     use_feedback, start):
+        ok = ~np.isnan(send_times)
+        lateness = send_times[ok] - deadlines[ok]
+        duration = send_times[ok][-1] - send_times[ok][0] if sent > 1 else 0.0
+        report = {'rate': self.rate,
+                  'points': int(self.trajectory.size),
+                  'sent': sent,
+                  'missed': missed,
+                  'achieved_rate': float((sent - 1)/duration) if duration > 0 else None,
+                  'jitter_rms': float(np.sqrt(np.mean(lateness**2))) if sent else None,
+                  'jitter_max': float(np.max(lateness)) if sent else None,
+                  'commanded': self.trajectory[:deadlines.size],
+                  'deadlines': deadlines,
+                  'send_times': send_times,
+                  'feedback': feedback}
+        if use_feedback:
+            # The full rate reader record of the run
+            report['reader_times'], report['reader_values'] = \
+                self.controller.reader.since(start)
+        return report
+
+
+def _raise_thread_priority():
+    '''Raise the priority of the calling thread where it is supported.
+
+    On Windows the thread becomes time critical and the system timer
+    resolution is set to 1 ms for time.sleep. Returns True on success.
+    '''
+    if not sys.platform.startswith('win'):
+        return False
+    try:
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        THREAD_PRIORITY_TIME_CRITICAL = 15
+        kernel32.SetThreadPriority(kernel32.GetCurrentThread(),
+                                   THREAD_PRIORITY_TIME_CRITICAL)
+        ctypes.windll.winmm.timeBeginPeriod(1)
+        return True
+    except Exception as e:
+        print('Failed to raise the streaming thread priority: ', e)
+        return False
+
+
+def _restore_timer_resolution():
+    import ctypes
+    ctypes.windll.winmm.timeEndPeriod(1)
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+import pytest
+
+# The tests run on the simulated backend, which has to be selected before
+# piezo is imported
+os.environ['KINESIS_BACKEND'] = 'sim'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import kinesis_sim  # noqa: E402
+import piezo  # noqa: E402
+from calibration import CalibrationCache  # noqa: E402
+
+SERIALS = ('81858318', '84858066')
+
+
+@pytest.fixture(scope='session')
+def connected():
+    '''A PiezoController with its strain reader on fresh simulated stages,
+    connected once for the session.'''
+    kinesis_sim.configure(latency=0.0002, jitter=0.0, enumerate_time=0.0,
+                          connect_time=0.0, settings_time=0.0, enable_time=0.0)
+    return piezo.PiezoController(*SERIALS)
+
+
+@pytest.fixture
+def controller(connected, tmp_path, monkeypatch):
+    '''The session controller with a calibration cache of its own test.'''
+    monkeypatch.setattr(connected, 'calibration_cache',
+                        CalibrationCache(str(tmp_path/'calibration.json')))
+    monkeypatch.setattr(connected, 'calibration', None)
+    return connected
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from acquisition import RingBuffer
+
+
+def filled(capacity, n):
+    buffer = RingBuffer(capacity)
+    for i in range(n):
+        buffer.append(float(i), 10.0*i)
+    return buffer
+
+
+def test_empty_buffer():
+    buffer = RingBuffer(4)
+    assert buffer.latest() is None
+    for times, values in (buffer.snapshot(), buffer.since(-1.0)):
+        assert times.size == 0 and values.size == 0
+
+
+def test_snapshot_before_wrap():
+    buffer = filled(8, 5)
+    times, values = buffer.snapshot()
+    np.testing.assert_array_equal(times, [0, 1, 2, 3, 4])
+    np.testing.assert_array_equal(values, [0, 10, 20, 30, 40])
+    times, _ = buffer.snapshot(2)
+    np.testing.assert_array_equal(times, [3, 4])
+    # More samples than stored
+    times, _ = buffer.snapshot(100)
+    np.testing.assert_array_equal(times, [0, 1, 2, 3, 4])
+
+
+def test_snapshot_after_wrap():
+    buffer = filled(4, 10)
+    assert len(buffer) == 4
+    assert buffer.count == 10
+    assert buffer.latest() == (9.0, 90.0)
+    times, values = buffer.snapshot()
+    np.testing.assert_array_equal(times, [6, 7, 8, 9])
+    np.testing.assert_array_equal(values, [60, 70, 80, 90])
+    # The newest 3 samples wrap around the end of the arrays
+    times, _ = buffer.snapshot(3)
+    np.testing.assert_array_equal(times, [7, 8, 9])
+
+
+def test_snapshot_returns_copies():
+    buffer = filled(4, 3)
+    times, values = buffer.snapshot()
+    values[:] = -1.0
+    np.testing.assert_array_equal(buffer.snapshot()[1], [0, 10, 20])
+
+
+def test_since_before_wrap():
+    buffer = filled(8, 5)
+    times, values = buffer.since(2.0)
+    np.testing.assert_array_equal(times, [3, 4])
+    np.testing.assert_array_equal(values, [30, 40])
+    assert buffer.since(4.0)[0].size == 0
+    np.testing.assert_array_equal(buffer.since(-1.0)[0], [0, 1, 2, 3, 4])
+
+
+def test_since_after_wrap():
+    buffer = filled(4, 10)
+    # Every stored sample, split over both segments
+    np.testing.assert_array_equal(buffer.since(0.0)[0], [6, 7, 8, 9])
+    # Part of the older segment and all of the newer one
+    np.testing.assert_array_equal(buffer.since(6.5)[0], [7, 8, 9])
+    # Only samples of the newer segment
+    buffer.append(10.0, 100.0)
+    times, values = buffer.since(8.0)
+    np.testing.assert_array_equal(times, [9, 10])
+    np.testing.assert_array_equal(values, [90, 100])
+    assert buffer.since(10.0)[0].size == 0
+
+
+def test_since_follows_new_samples():
+    buffer = filled(4, 3)
+    last_t = buffer.latest()[0]
+    for i in range(3, 12):
+        buffer.append(float(i), 10.0*i)
+        times, _ = buffer.since(last_t)
+        np.testing.assert_array_equal(times, [i])
+        last_t = times[-1]
+
+
+def test_clear():
+    buffer = filled(4, 6)
+    buffer.clear()
+    assert len(buffer) == 0
+    assert buffer.latest() is None
+    assert buffer.since(-1.0)[0].size == 0
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from calibration import PositionCalibration
+
+PERCENTAGES = np.linspace(10, 90, 9)
+
+
+def gauge(sign):
+    noise = np.random.RandomState(1).normal(0.0, 0.005, PERCENTAGES.size)
+    return sign*(0.2*PERCENTAGES + 0.001*PERCENTAGES**2) + noise
+
+
+@pytest.mark.parametrize('model', ['poly', 'table'])
+@pytest.mark.parametrize('sign', [1, -1])
+def test_either_sign(model, sign):
+    positions = gauge(sign)
+    calibration = PositionCalibration(positions, PERCENTAGES, model=model)
+    assert calibration.sign == sign
+    assert calibration.to_percentage(calibration.to_position(50.0)) == pytest.approx(50.0)
+    x = calibration.to_position(PERCENTAGES)
+    assert np.all(sign*np.diff(x) > 0)
+    np.testing.assert_allclose(calibration.to_position(PERCENTAGES), positions, atol=0.05)
+    report = calibration.report()
+    assert np.isfinite(report['rms_um']) and report['rms_um'] < 0.3
+
+
+def test_flat_gauge():
+    with pytest.raises(ValueError):
+        PositionCalibration(np.ones(5), np.linspace(10, 90, 5))
+
+
+def test_table_residuals_are_leave_one_out():
+    calibration = PositionCalibration(gauge(1), PERCENTAGES, model='table')
+    r = calibration.residuals()
+    assert np.all(np.isfinite(r)) and np.any(np.abs(r) > 1e-3)
+    # A straight line is predicted exactly without any of its points
+    line = PositionCalibration(0.2*PERCENTAGES, PERCENTAGES, model='table')
+    np.testing.assert_allclose(line.residuals(), 0.0, atol=1e-9)
+    assert np.all(np.isnan(PositionCalibration([1.0, 2.0], [10, 20], model='table').residuals()))
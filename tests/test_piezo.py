@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+import piezo
+from piezo import CommandQueue
+
+
+@pytest.fixture
+def closed_loop(controller):
+    controller.set_closed_loop()
+    controller.set_value(0)
+    controller.wait_settled()
+    return controller
+
+
+def settled_move(controller, percentage):
+    '''Move without kicking the polling and wait for the settle.
+
+    Returns the settle time, the position at the settle and the final
+    position of the simulated stage.
+    '''
+    stage = controller.reader.device.stage
+    controller.device.SetPercentageTravel(piezo.Decimal(percentage))
+    settle_time = controller.reader.wait_settled(tolerance=0.02, window=0.1)
+    position = stage.reading()
+    time.sleep(0.5)
+    return settle_time, position, stage.reading()
+
+
+###############################################################################
+#       Connection
+###############################################################################
+def test_absent_device(controller):
+    controllers, results = piezo.bring_up(['99999999'])
+    assert not results[0]['ok']
+    assert 'not found' in str(results[0]['error'])
+    assert not results[0]['devices'][0]['ok']
+
+
+###############################################################################
+#       Settle detection
+###############################################################################
+def test_settle_fast_polling(closed_loop):
+    closed_loop.kick_polling()
+    settle_time, position, final = settled_move(closed_loop, 50)
+    assert settle_time is not None and settle_time > 0.1
+    assert abs(position - final) < 0.03
+
+
+def test_settle_with_held_readings(closed_loop, monkeypatch):
+    # At the slow interval the device refreshes its readings every 250 ms,
+    # and a move must not look settled on the reading held from before it
+    polling = closed_loop.reader.polling
+    monkeypatch.setattr(polling, 'fast', polling.slow)
+    polling.interval()
+    assert closed_loop.reader.device._polling == pytest.approx(polling.slow)
+    settle_time, position, final = settled_move(closed_loop, 50)
+    assert settle_time is not None
+    assert abs(position - final) < 0.03
+
+
+def test_settle_timeout(closed_loop):
+    # The noise never fits a band of 1 nm
+    assert closed_loop.reader.wait_settled(tolerance=0.001, timeout=0.2) is None
+
+
+###############################################################################
+#       Settings
+###############################################################################
+def device_state(device):
+    return (device.voltage_source, device.hub_input, device.control_mode)
+
+
+def test_settings_write_only_changes(controller):
+    controller.set_open_loop()
+    report = controller.set_closed_loop()
+    assert report['ok']
+    assert set(report['changes']) == {'hub_input', 'control_mode'}
+    assert controller.is_closed_loop()
+    report = controller.set_closed_loop()
+    assert report['ok'] and report['calls'] == 0
+
+
+def test_settings_rollback(controller, monkeypatch):
+    controller.set_open_loop()
+    device = controller.device
+    before = device_state(device)
+
+    def fail(mode):
+        raise RuntimeError('bus error')
+    monkeypatch.setattr(device, 'SetPositionControlMode', fail)
+    report = controller.set_closed_loop()
+    assert not report['ok']
+    assert isinstance(report['error'], RuntimeError)
+    assert report['rolled_back']
+    # The hub input written before the failure is restored
+    assert device_state(device) == before
+    assert not controller.is_closed_loop()
+
+
+def test_settings_failed_rollback(controller, monkeypatch):
+    controller.set_open_loop()
+    device = controller.device
+    calls = []
+
+    def fail_after_first(settings, persist):
+        calls.append(settings)
+        if len(calls) > 1:
+            raise RuntimeError('bus error')
+    monkeypatch.setattr(device, 'SetSettings', fail_after_first)
+    monkeypatch.setattr(device, 'SetPositionControlMode', fail_after_first)
+    report = controller.apply_settings(hub_input=3, control_mode=2)
+    assert not report['ok']
+    assert not report['rolled_back']
+
+
+def test_settings_transaction(controller):
+    with controller.settings() as settings:
+        settings.set(max_voltage=100.0)
+        settings.set(voltage_step=0.5)
+    assert settings.report['ok']
+    assert settings.report['calls'] == 1
+    assert controller.status.get('max_voltage') == pytest.approx(100.0)
+    assert controller.device.stage.max_voltage == pytest.approx(100.0)
+    controller.apply_settings(max_voltage=75.0, voltage_step=1.0)
+    with pytest.raises(ValueError):
+        controller.settings(speed=1.0)
+
+
+###############################################################################
+#       Command merging
+###############################################################################
+class Recorder(object):
+    '''Handlers of a CommandQueue that record their calls. The first call
+    blocks until release() so that the next commands stay pending.'''
+    def __init__(self):
+        self.calls = []
+        self.started = threading.Event()
+        self._release = threading.Event()
+
+    def handlers(self):
+        return {'pos': (lambda target: self._call('move', target),
+                        lambda offset: self._call('jog', offset)),
+                'value': (lambda target: self._call('move value', target),
+                          lambda offset: self._call('jog value', offset))}
+
+    def _call(self, kind, argument):
+        self.started.set()
+        self._release.wait(5.0)
+        self.calls.append((kind, argument))
+
+    def release(self):
+        self._release.set()
+
+
+def blocked_queue():
+    recorder = Recorder()
+    queue = CommandQueue(recorder.handlers())
+    queue.move('pos', 1.0)
+    assert recorder.started.wait(5.0)
+    return queue, recorder
+
+
+def test_jogs_merge():
+    queue, recorder = blocked_queue()
+    for i in range(5):
+        queue.jog('pos', 0.5)
+    recorder.release()
+    assert queue.wait(5.0)
+    assert recorder.calls == [('move', 1.0), ('jog', 2.5)]
+    stats = queue.stats()
+    assert stats['submitted'] == 6
+    assert stats['executed'] == 2
+    assert stats['merged'] == 4
+    assert stats['pending'] == 0
+
+
+def test_jogs_of_other_domains_do_not_merge():
+    queue, recorder = blocked_queue()
+    queue.jog('pos', 1.0)
+    queue.jog('value', 2.0)
+    queue.jog('pos', 3.0)
+    recorder.release()
+    assert queue.wait(5.0)
+    assert recorder.calls == [('move', 1.0), ('jog', 1.0),
+                              ('jog value', 2.0), ('jog', 3.0)]
+
+
+def test_move_replaces_pending():
+    queue, recorder = blocked_queue()
+    queue.jog('pos', 1.0)
+    queue.jog('value', 2.0)
+    queue.move('pos', 7.0)
+    queue.jog('pos', 0.5)
+    recorder.release()
+    assert queue.wait(5.0)
+    assert recorder.calls == [('move', 1.0), ('move', 7.5)]
+    assert queue.stats()['merged'] == 3
+
+
+def test_failed_command():
+    def fail(value):
+        raise RuntimeError('bus error')
+    queue = CommandQueue({'pos': (fail, fail)})
+    queue.move('pos', 1.0)
+    assert queue.wait(5.0)
+    assert queue.stats()['errors'] == 1
+    assert isinstance(queue.last_error, RuntimeError)
+
+
+def test_controller_commands(closed_loop):
+    commands = closed_loop.commands
+    closed_loop.apply_settings(percentage_step=2.5)
+    for i in range(5):
+        commands.jog('value', 1)
+    assert commands.wait(5.0)
+    assert closed_loop.get_value() == pytest.approx(12.5)
+    # A single jog moves by the same step
+    closed_loop.moveup()
+    assert closed_loop.get_value() == pytest.approx(15.0)
+    closed_loop.apply_settings(percentage_step=1.0)
+    commands.move('value', 0)
+    assert commands.wait(5.0)
+    assert closed_loop.get_value() == pytest.approx(0.0)
+
+
+###############################################################################
+#       Scans
+###############################################################################
+def test_scan_requirements(controller):
+    acquire = lambda index, position: None
+    controller.set_open_loop()
+    with pytest.raises(RuntimeError, match='closed loop'):
+        controller.scan([1.0, 2.0], acquire)
+    controller.set_closed_loop()
+    with pytest.raises(RuntimeError, match='calibration'):
+        controller.scan([1.0, 2.0], acquire)